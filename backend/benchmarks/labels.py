@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""
+Label sheet benchmark for GET /api/labels (render_label_pdf in server.py).
+
+Renders --labels synthetic batches twice: cold (every QR code encoded in the
+worker pool) and cached (codes from the per-batch LRU, pages only). Reports
+wall time, pages and PDF size. Set --workers to compare pool sizes; the
+service reads LABEL_RENDER_WORKERS.
+
+No MongoDB is needed.
+
+Usage:
+    python benchmarks/labels.py --labels 500 --workers 4
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+
+def synthetic_batches(count: int) -> list:
+    intake = datetime(2026, 2, 18, 6, 0)
+    return [
+        {
+            "batch_id": f"BATCH20260218{i + 1:06d}",
+            "farmer_id": f"farmer_{i % 97:012x}",
+            "weight_kg": round(80 + (i * 7.3) % 120, 1),
+            "size_grade": ("Small", "Medium", "Large", "Jumbo")[i % 4],
+            "intake_date": intake + timedelta(minutes=i),
+        }
+        for i in range(count)
+    ]
+
+
+async def run(labels: int, output: Path):
+    import server
+
+    batches = synthetic_batches(labels)
+    # Start the pool outside the timings, as a running worker would have
+    server.label_render_pool().submit(int).result()
+
+    for name in ("cold", "cached"):
+        started = time.perf_counter()
+        pdf = await server.render_label_pdf(batches)
+        elapsed = time.perf_counter() - started
+        pages = -(-labels // (server.LABEL_GRID[0] * server.LABEL_GRID[1]))
+        print(f"{name:>8} {elapsed:>8.2f}s {pages:>6} pages {len(pdf) / 1024:>9.0f} KB "
+              f"({labels / elapsed:.0f} labels/s)")
+
+    output.write_bytes(pdf)
+    print(f"📄 {output}")
+    server.label_render_pool().shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--labels", type=int, default=500)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--output", type=Path, default=Path("labels_benchmark.pdf"))
+    args = parser.parse_args()
+
+    os.environ["LABEL_RENDER_WORKERS"] = str(args.workers)
+    print(f"🏷️  {args.labels} labels, {args.workers} render workers")
+    asyncio.run(run(args.labels, args.output))
+
+
+if __name__ == "__main__":
+    main()
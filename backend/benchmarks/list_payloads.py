@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+List payload benchmark for GET /api/batches, /api/payments and /api/dispatch.
+
+Serves --rows synthetic documents per endpoint through the real app (auth,
+middleware, response models, content negotiation and compression) and
+reports, for each representation:
+  bytes       body size on the wire
+  ms          median request time over --requests calls
+Representations: full JSON or MessagePack rows, or sparse rows (fields=,
+the columns a mobile list shows), each uncompressed, gzip and brotli.
+
+The collections are replaced by in-memory loaders that apply the same
+projection, so this measures encoding and transfer, not MongoDB reads; the
+read side saving of fields= is the bytes not fetched. No MongoDB is needed.
+
+Usage:
+    python benchmarks/list_payloads.py --rows 1000 --requests 20
+"""
+
+import argparse
+import random
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from fastapi.testclient import TestClient
+
+import server
+
+SPARSE_FIELDS = {
+    "/api/batches": "size_grade,weight_kg,status",
+    "/api/payments": "net_amount,payment_status",
+    "/api/dispatch": "customer_name,country,status",
+}
+REPRESENTATIONS = [
+    ("json", False, "application/json"),
+    ("msgpack", False, "application/msgpack"),
+    ("json fields", True, "application/json"),
+    ("msgpack fields", True, "application/msgpack"),
+]
+ENCODINGS = ["identity", "gzip", "br"]
+
+
+def synthetic_collections(rows: int) -> dict:
+    rng = random.Random(7)
+    start = datetime(2026, 2, 18, 6, 0)
+    grades = ["Small", "Medium", "Large", "Jumbo"]
+    batches, payments, dispatches = [], [], []
+    for i in range(rows):
+        batch_id = f"BATCH20260218{i:06d}"
+        farmer_id = f"farmer_{rng.getrandbits(48):012x}"
+        intake = start + timedelta(minutes=7 * i)
+        weight = round(rng.uniform(40, 400), 2)
+        batches.append({
+            "batch_id": batch_id, "farmer_id": farmer_id, "weight_kg": weight,
+            "size_grade": rng.choice(grades), "intake_date": intake, "intake_time": intake.strftime("%H:%M:%S"),
+            "location": f"Dock {rng.choice('ABCD')}", "status": rng.choice(["RECEIVED", "PROCESSED", "STORED"]),
+            "qr_code": server.generate_qr_code(server.encode_batch_qr(batch_id)), "created_at": intake
+        })
+        price = rng.choice([320.0, 360.0, 410.0, 480.0])
+        deductions = round(weight * price * 0.02, 2)
+        payments.append({
+            "payment_id": f"payment_{rng.getrandbits(48):012x}", "farmer_id": farmer_id, "batch_id": batch_id,
+            "total_prawns": weight, "price_per_kg": price, "gross_amount": round(weight * price, 2),
+            "deductions": deductions, "net_amount": round(weight * price - deductions, 2),
+            "payment_status": rng.choice(["pending", "paid"]), "payment_date": None, "created_at": intake
+        })
+        dispatches.append({
+            "dispatch_id": f"dispatch_{rng.getrandbits(48):012x}", "batch_id": batch_id,
+            "customer_name": rng.choice(["Ocean Foods", "Tokyo Seafood Co", "Nordic Catch"]),
+            "country": rng.choice(["Japan", "USA", "Norway"]), "selling_price": round(rng.uniform(8, 20), 2),
+            "dispatch_date": intake + timedelta(days=3), "weight_kg": weight, "size_grade": rng.choice(grades),
+            "status": "SHIPPED", "created_at": intake
+        })
+    return {"batches": batches, "payments": payments, "dispatches": dispatches}
+
+
+def in_memory_loader(docs: list):
+    async def load(projection=None):
+        if not projection:
+            return [dict(doc) for doc in docs]
+        keep = [field for field, include in projection.items() if include and field != "_id"]
+        return [{field: doc[field] for field in keep if field in doc} for doc in docs]
+    return load
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=1000)
+    parser.add_argument("--requests", type=int, default=20)
+    args = parser.parse_args()
+
+    collections = synthetic_collections(args.rows)
+    server.load_batches = in_memory_loader(collections["batches"])
+    server.load_payments = in_memory_loader(collections["payments"])
+    server.load_dispatches = in_memory_loader(collections["dispatches"])
+    server.response_cache.default_ttl = 0  # every request encodes
+    server.app.dependency_overrides[server.get_current_user] = lambda: {"user_id": "bench", "role": "admin"}
+    client = TestClient(server.app)
+
+    print(f"📦 {args.rows} rows per endpoint, median of {args.requests} requests")
+    print(f"{'endpoint':>14} {'representation':>15} " + " ".join(f"{e + ' B':>10} {e + ' ms':>11}" for e in ENCODINGS))
+    for path, fields in SPARSE_FIELDS.items():
+        for name, sparse, accept in REPRESENTATIONS:
+            url = f"{path}?fields={fields}" if sparse else path
+            cells = []
+            for encoding in ENCODINGS:
+                timings, size = [], 0
+                for _ in range(args.requests):
+                    started = time.perf_counter()
+                    response = client.get(url, headers={"Accept": accept, "Accept-Encoding": encoding})
+                    timings.append((time.perf_counter() - started) * 1000)
+                    response.raise_for_status()
+                    size = response.num_bytes_downloaded
+                cells.append(f"{size:>10} {statistics.median(timings):>11.1f}")
+            print(f"{path[5:]:>14} {name:>15} " + " ".join(cells))
+
+
+if __name__ == "__main__":
+    main()
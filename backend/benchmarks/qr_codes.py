@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""
+QR payload benchmark for batch codes (encode_batch_qr / render_qr_image in
+server.py).
+
+Compares the old JSON payload (five fields with a full ISO timestamp) with
+the compact AQ1 reference at every error correction level:
+  version     QR version (size is 17 + 4 * version modules)
+  png/svg     render time and size of the image stored on a batch / served
+              by GET /api/batches/{id}/qr
+  scan rates  share of simulated phone captures that decode, per condition
+
+Captures assume the same printed size for every code (a label's 33 mm
+square) seen by a camera at --capture-px pixels across, so denser codes get
+fewer pixels per module. Conditions, each with --trials random draws:
+  clean   slight defocus
+  far     the same code from twice the distance (half the pixels)
+  wet     bright specular droplets over the code
+  frost   low contrast, sensor noise and blur
+  smudge  dark smears
+
+Scan rates need a decoder: pip install zxing-cpp. Without it only render
+time and size are reported. No MongoDB is needed.
+
+Usage:
+    python benchmarks/qr_codes.py --trials 200 --capture-px 140
+"""
+
+import argparse
+import json
+import random
+import sys
+import time
+from datetime import datetime, timezone
+from io import BytesIO
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFilter
+
+import server
+
+try:
+    import zxingcpp
+except ImportError:
+    zxingcpp = None
+
+BATCH_ID = "BATCH20260218000123"
+CONDITIONS = ("clean", "far", "wet", "frost", "smudge")
+
+
+def legacy_payload() -> str:
+    # What generate_qr_code was given before AQ1
+    return json.dumps({
+        "batch_id": BATCH_ID,
+        "farmer_id": "farmer_3f9a1c2b7d4e",
+        "weight_kg": 152.34,
+        "size_grade": "Medium",
+        "intake_date": datetime(2026, 2, 18, 6, 41, 9, 512734, tzinfo=timezone.utc).isoformat()
+    })
+
+
+def timed(fn, repeat: int):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        result = fn()
+    return (time.perf_counter() - started) / repeat * 1000, result
+
+
+def capture(code: Image.Image, condition: str, size: int, rng: random.Random) -> Image.Image:
+    # Printed code at 8x, degraded, then sampled down to what the camera sees
+    printed = code.resize((code.size[0] * 8, code.size[1] * 8), Image.NEAREST).convert("L")
+    width = printed.size[0]
+    draw = ImageDraw.Draw(printed)
+    blur = 0.6
+    if condition == "far":
+        size //= 2
+    elif condition == "wet":
+        for _ in range(rng.randint(3, 6)):
+            r = rng.uniform(0.02, 0.06) * width
+            x, y = rng.uniform(0, width), rng.uniform(0, width)
+            draw.ellipse((x - r, y - r, x + r, y + r), fill=rng.randint(215, 255))
+    elif condition == "smudge":
+        for _ in range(rng.randint(2, 4)):
+            x, y = rng.uniform(0, width), rng.uniform(0, width)
+            dx, dy = rng.uniform(-0.25, 0.25) * width, rng.uniform(-0.25, 0.25) * width
+            draw.line((x, y, x + dx, y + dy), fill=rng.randint(30, 90), width=int(rng.uniform(0.03, 0.06) * width))
+    elif condition == "frost":
+        blur = 0.9
+
+    seen = printed.resize((size, size), Image.BILINEAR).filter(ImageFilter.GaussianBlur(blur))
+    if condition == "frost":
+        pixels = np.asarray(seen, dtype=np.float32) / 255 * 120 + 110
+        pixels += np.random.default_rng(rng.getrandbits(32)).normal(0, 12, pixels.shape)
+        seen = Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8))
+    # Quiet zone around the code, as on the label
+    framed = Image.new("L", (size * 3 // 2, size * 3 // 2), 255 if condition != "frost" else 210)
+    framed.paste(seen, (size // 4, size // 4))
+    return framed
+
+
+def scan_rate(payload: str, level: str, condition: str, args) -> float:
+    code = Image.open(BytesIO(server.render_qr_image(payload, error_correction=level, box_size=1, border=0)))
+    rng = random.Random(f"{payload}{level}{condition}")
+    decoded = 0
+    for _ in range(args.trials):
+        results = zxingcpp.read_barcodes(capture(code, condition, args.capture_px, rng))
+        decoded += any(result.text == payload for result in results)
+    return decoded / args.trials
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--trials", type=int, default=200, help="captures per payload, level and condition")
+    parser.add_argument("--capture-px", type=int, default=140, help="camera pixels across the code")
+    parser.add_argument("--repeat", type=int, default=50, help="renders per timing")
+    args = parser.parse_args()
+
+    payloads = [("json", legacy_payload()), ("AQ1", server.encode_batch_qr(BATCH_ID))]
+    print(f"📐 json payload {len(payloads[0][1])} chars, AQ1 payload {len(payloads[1][1])} chars ({payloads[1][1]})")
+    if zxingcpp is None:
+        print("⚠️  zxing-cpp not installed; skipping scan rates (pip install zxing-cpp)")
+
+    header = f"{'payload':>7} {'level':>5} {'version':>7} {'png ms':>7} {'png B':>6} {'svg ms':>7} {'svg B':>6}"
+    if zxingcpp is not None:
+        header += "".join(f" {condition:>7}" for condition in CONDITIONS)
+    print(header)
+
+    for name, payload in payloads:
+        for level in server.QR_ERROR_LEVELS:
+            png_ms, png = timed(lambda: server.render_qr_image(payload, "png", level), args.repeat)
+            svg_ms, svg = timed(lambda: server.render_qr_image(payload, "svg", level), args.repeat)
+            version = (len(server.qr_matrix(payload, level)) - 17) // 4
+            row = f"{name:>7} {level:>5} {version:>7} {png_ms:>7.1f} {len(png):>6} {svg_ms:>7.1f} {len(svg):>6}"
+            if zxingcpp is not None:
+                row += "".join(f" {scan_rate(payload, level, condition, args):>7.0%}" for condition in CONDITIONS)
+            print(row)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+Cold start benchmark for the AquaFlow backend.
+
+Imports server.py in fresh interpreters and reports import time and resident
+memory for three cases:
+  eager   qrcode, PIL, numpy, openpyxl, httpx, brotli and msgpack imported
+          up front, as server.py did before they were loaded lazily
+  lazy    plain `import server`, what a worker pays before it can serve
+  warmed  lazy import followed by warm_up_modules(), the state a worker
+          reaches shortly after startup
+
+No MongoDB is needed; nothing connects at import time.
+
+Usage:
+    python benchmarks/startup.py --runs 5
+"""
+
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+
+CHILD = r'''
+import json, sys, time
+
+def rss_mb():
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+mode = sys.argv[1]
+before = rss_mb()
+started = time.perf_counter()
+if mode == "eager":
+    import qrcode, PIL.Image, numpy, openpyxl, httpx, brotli, msgpack
+import server
+import_ms = (time.perf_counter() - started) * 1000
+
+warmup_ms = 0.0
+if mode == "warmed":
+    import asyncio
+    started = time.perf_counter()
+    asyncio.run(server.warm_up_modules())
+    warmup_ms = (time.perf_counter() - started) * 1000
+
+print(json.dumps({"import_ms": import_ms, "warmup_ms": warmup_ms, "rss_before_mb": before, "rss_after_mb": rss_mb()}))
+'''
+
+
+def measure(mode: str) -> dict:
+    output = subprocess.run(
+        [sys.executable, "-c", CHILD, mode],
+        cwd=BACKEND_DIR, capture_output=True, text=True, check=True
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"🔧 import server, median of {args.runs} fresh interpreters")
+    print(f"{'mode':>8} {'import ms':>10} {'warm-up ms':>11} {'RSS before MB':>14} {'RSS after MB':>13}")
+
+    for mode in ("eager", "lazy", "warmed"):
+        runs = [measure(mode) for _ in range(args.runs)]
+        median = {key: statistics.median(run[key] for run in runs) for key in runs[0]}
+        print(f"{mode:>8} {median['import_ms']:>10.1f} {median['warmup_ms']:>11.1f} "
+              f"{median['rss_before_mb']:>14.1f} {median['rss_after_mb']:>13.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+"""
+Worker scaling benchmark for the AquaFlow backend.
+
+Starts `uvicorn server:app --workers N` for N = 1, 2, 4 ... up to the core
+count, drives GET /api/batches with a fixed number of concurrent clients and
+prints requests/second and latency per worker count. Needs a running MongoDB
+(MONGO_URL / DB_NAME from backend/.env or the environment); a benchmark user
+and session are inserted before the run and removed afterwards.
+
+Usage:
+    python benchmarks/worker_scaling.py --duration 15 --concurrency 64
+"""
+
+import argparse
+import asyncio
+import multiprocessing
+import os
+import statistics
+import subprocess
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+import httpx
+from dotenv import load_dotenv
+from pymongo import MongoClient
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+load_dotenv(BACKEND_DIR / '.env')
+
+
+def worker_counts(max_workers: int) -> list:
+    counts = [1]
+    while counts[-1] * 2 <= max_workers:
+        counts.append(counts[-1] * 2)
+    if counts[-1] != max_workers:
+        counts.append(max_workers)
+    return counts
+
+
+def create_bench_session(db) -> str:
+    user_id = f"bench_{uuid.uuid4().hex[:12]}"
+    session_token = f"bench_session_{uuid.uuid4().hex}"
+    db.users.insert_one({
+        "user_id": user_id,
+        "email": f"{user_id}@bench.local",
+        "name": "Benchmark",
+        "picture": None,
+        "role": "admin",
+        "created_at": datetime.now(timezone.utc)
+    })
+    db.user_sessions.insert_one({
+        "user_id": user_id,
+        "session_token": session_token,
+        "expires_at": datetime.now(timezone.utc) + timedelta(hours=1),
+        "created_at": datetime.now(timezone.utc)
+    })
+    return session_token
+
+
+def remove_bench_session(db, session_token: str):
+    session = db.user_sessions.find_one({"session_token": session_token})
+    if session:
+        db.users.delete_one({"user_id": session["user_id"]})
+        db.user_sessions.delete_many({"user_id": session["user_id"]})
+
+
+def start_server(workers: int, port: int) -> subprocess.Popen:
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "server:app",
+         "--host", "127.0.0.1", "--port", str(port),
+         "--workers", str(workers), "--log-level", "warning"],
+        cwd=BACKEND_DIR,
+    )
+
+
+def wait_until_ready(base_url: str, timeout: float = 60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(f"{base_url}/api/health", timeout=2).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.25)
+    raise RuntimeError("Server did not become ready")
+
+
+async def drive_load(url: str, token: str, concurrency: int, duration: float) -> list:
+    latencies = []
+    deadline = time.monotonic() + duration
+    headers = {"Authorization": f"Bearer {token}"}
+    limits = httpx.Limits(max_connections=concurrency)
+
+    async with httpx.AsyncClient(headers=headers, limits=limits, timeout=30) as http:
+        async def client_loop():
+            while time.monotonic() < deadline:
+                started = time.perf_counter()
+                response = await http.get(url)
+                response.raise_for_status()
+                latencies.append(time.perf_counter() - started)
+
+        await asyncio.gather(*(client_loop() for _ in range(concurrency)))
+
+    return latencies
+
+
+def load_process(url, token, concurrency, duration, results):
+    # Each load process runs its own event loop so the client side is not
+    # the bottleneck when the server has several workers
+    results.extend(asyncio.run(drive_load(url, token, concurrency, duration)))
+
+
+def run_level(workers: int, args, token: str) -> dict:
+    base_url = f"http://127.0.0.1:{args.port}"
+    server = start_server(workers, args.port)
+    try:
+        wait_until_ready(base_url)
+
+        with multiprocessing.Manager() as manager:
+            results = manager.list()
+            per_process = max(1, args.concurrency // args.load_processes)
+            processes = [
+                multiprocessing.Process(
+                    target=load_process,
+                    args=(f"{base_url}/api/batches", token, per_process, args.duration, results)
+                )
+                for _ in range(args.load_processes)
+            ]
+            for process in processes:
+                process.start()
+            for process in processes:
+                process.join()
+            latencies = sorted(results)
+    finally:
+        server.terminate()
+        server.wait()
+
+    quantiles = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else [0] * 99
+    return {
+        "workers": workers,
+        "requests": len(latencies),
+        "rps": len(latencies) / args.duration,
+        "p50_ms": quantiles[49] * 1000,
+        "p99_ms": quantiles[98] * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--max-workers", type=int, default=os.cpu_count())
+    parser.add_argument("--duration", type=float, default=15)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--load-processes", type=int, default=max(1, (os.cpu_count() or 2) // 2))
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+
+    mongo = MongoClient(os.environ['MONGO_URL'])
+    db = mongo[os.environ['DB_NAME']]
+    token = create_bench_session(db)
+
+    print(f"🔧 GET /api/batches, {args.concurrency} concurrent clients, {args.duration:.0f}s per level")
+    print(f"{'workers':>8} {'requests':>10} {'req/s':>10} {'p50 ms':>9} {'p99 ms':>9} {'scaling':>8}")
+
+    try:
+        baseline = None
+        for workers in worker_counts(args.max_workers):
+            result = run_level(workers, args, token)
+            baseline = baseline or result["rps"]
+            print(f"{result['workers']:>8} {result['requests']:>10} {result['rps']:>10.1f} "
+                  f"{result['p50_ms']:>9.1f} {result['p99_ms']:>9.1f} {result['rps'] / baseline:>7.2f}x")
+    finally:
+        remove_bench_session(db, token)
+        mongo.close()
+
+
+if __name__ == "__main__":
+    main()
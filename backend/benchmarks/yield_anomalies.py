@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""
+Scoring benchmark for the yield anomaly job (score_yields in server.py).
+
+Generates synthetic processing stage columns (4 stages, --operators people,
+4 size grades, yields around 85% with a few injected losses) and times the
+NumPy scoring step on them. Loading from MongoDB is not included; the job
+logs its own load_ms next to score_ms on every pass.
+
+No MongoDB is needed.
+
+Usage:
+    python benchmarks/yield_anomalies.py --rows 2000000 --operators 60
+"""
+
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import server  # noqa: E402
+
+
+def synthetic_columns(rows: int, operators: int, seed: int = 7) -> dict:
+    rng = np.random.default_rng(seed)
+    yields = 85 + rng.normal(0, 2, rows)
+    injected = rng.choice(rows, size=max(1, rows // 10_000), replace=False)
+    yields[injected] -= rng.uniform(15, 30, len(injected))
+    input_weight = rng.uniform(50, 200, rows)
+    labels = {
+        "stage_name": ["Peeling", "Deveining", "Grading", "Packing"],
+        "assigned_person": [f"Operator {i}" for i in range(operators)],
+        "size_grade": ["Small", "Medium", "Large", "Jumbo"],
+    }
+    columns = {
+        "stage_id": np.array([f"stage_{i:012x}" for i in range(rows)], dtype=object),
+        "batch_id": np.array([f"BATCH{i // 4:012d}" for i in range(rows)], dtype=object),
+        **{field: rng.integers(0, len(values), rows) for field, values in labels.items()},
+        "input_weight": input_weight,
+        "output_weight": input_weight * yields / 100,
+        "created_at": np.datetime64("2026-01-01", "ms") + (np.arange(rows) * 7).astype("timedelta64[s]"),
+    }
+    return columns, labels, len(injected)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=2_000_000)
+    parser.add_argument("--operators", type=int, default=60)
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+
+    columns, labels, injected = synthetic_columns(args.rows, args.operators)
+    print(f"🔧 {args.rows} stages, {args.operators} operators, {injected} injected losses")
+
+    timings = []
+    for _ in range(args.runs):
+        started = time.perf_counter()
+        flags = server.score_yields(columns, labels)
+        timings.append(time.perf_counter() - started)
+
+    low = sum(flag["direction"] == "low" for flag in flags)
+    best = min(timings)
+    print(f"⏱️  best of {args.runs}: {best:.2f}s ({args.rows / best / 1e6:.1f}M stages/s)")
+    print(f"🚩 {len(flags)} flagged, {low} low yield")
+
+
+if __name__ == "__main__":
+    main()
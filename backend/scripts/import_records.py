@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+Bulk import of historical records from CSV or Excel.
+
+Streams the file row by row and writes it in chunks, the same code path as
+POST /api/import/{kind}, but straight against MongoDB. This is the one to
+use for very large migrations. The first row holds the column names, i.e. the
+fields of the matching *ImportRow model in server.py:
+
+  farmers            name, contact, address [, farmer_id, created_at]
+  batches            farmer_id, weight_kg, size_grade, location [, batch_id, intake_date, status]
+  processing_stages  batch_id, stage_name, assigned_person, input_weight, output_weight
+                     [, started_at, completed_at]
+  payments           farmer_id, batch_id, price_per_kg [, deductions, payment_status, payment_date]
+
+Import farmers, then batches, then stages and payments, so references
+resolve. Rejected rows are written to --errors as CSV (row, error).
+Re-running the same file skips the rows it already imported.
+
+    python scripts/import_records.py batches ~/migration/batches_2019_2025.xlsx --errors batch_errors.csv
+    python scripts/import_records.py payments payments.csv --dry-run
+"""
+
+import argparse
+import asyncio
+import csv
+import hashlib
+import os
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import server  # noqa: E402
+
+
+def file_sha256(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(1 << 20):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+async def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("kind", choices=list(server.IMPORT_KINDS))
+    parser.add_argument("path", type=Path)
+    parser.add_argument("--format", choices=server.IMPORT_FORMATS,
+                        help="defaults to the file extension")
+    parser.add_argument("--errors", type=Path, default=Path("import_errors.csv"))
+    parser.add_argument("--dry-run", action="store_true", help="validate and resolve references only")
+    args = parser.parse_args()
+
+    file_format = args.format or args.path.suffix.lstrip(".").lower()
+    if file_format not in server.IMPORT_FORMATS:
+        parser.error("use a .csv or .xlsx file, or pass --format")
+
+    client = server.create_mongo_client()
+    server.db = client[os.environ['DB_NAME']]
+    server.analytics_db = server.db
+    await server.ensure_indexes()
+
+    summary = {}
+    try:
+        with open(args.errors, "w", newline="") as errors_file:
+            errors = csv.writer(errors_file)
+            errors.writerow(["row", "error"])
+            async for line in server.import_records(args.kind, args.path, file_format,
+                                                    file_sha256(args.path), args.dry_run):
+                if "summary" in line:
+                    summary = line["summary"]
+                    continue
+                for message in line["errors"]:
+                    errors.writerow([line["row"], message])
+    finally:
+        client.close()
+
+    print(f"📥 {summary['rows']} rows in {summary['seconds']}s: {summary['inserted']} "
+          f"{'valid' if args.dry_run else 'inserted'}, {summary['already_imported']} already imported, "
+          f"{summary['failed']} rejected" + (f" (see {args.errors})" if summary["failed"] else ""))
+    return 1 if summary["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+Rebuild a database from the mutation event log.
+
+Reads the events collection of DB_NAME, oldest first, and applies every
+created / updated / deleted / archived event to --target (a fresh database,
+or one holding a copy to bring forward); archived rows are removed, as they
+were from the hot tier. An updated event whose document was never created
+(its created event lost) is skipped and reported, not upserted. Then derives what is not logged:
+  - storage location occupancy, from the STORED inventory
+  - operator shift rollups, from the processing stages
+  - the sales cube, from the dispatches and their lineage
+  - the per-day batch ID counters, past the highest replayed id
+
+--until replays the log up to a moment, e.g. to inspect the plant's state
+before a bad edit. Documents that predate the log come from its baseline
+events (written once on first start). Archived rows live on in the archive
+files: copy ARCHIVE_DIR and the archive_partitions collection along with it
+to keep them readable.
+
+    DB_NAME=aquaflow python scripts/replay_events.py --target aquaflow_replay
+    DB_NAME=aquaflow python scripts/replay_events.py --target aquaflow_0218 --until 2026-02-18T12:00:00+00:00
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import server  # noqa: E402
+
+
+async def seed_batch_counters(db) -> int:
+    # BATCH{YYYYMMDD}{seq:06d}: each day's counter starts past its highest id
+    days = await db.batches.aggregate([
+        {"$match": {"batch_id": {"$regex": r"^BATCH\d{14}$"}}},
+        {"$group": {
+            "_id": {"$substrCP": ["$batch_id", 5, 8]},
+            "seq": {"$max": {"$toInt": {"$substrCP": ["$batch_id", 13, 6]}}}
+        }}
+    ]).to_list(None)
+    for day in days:
+        await db.counters.update_one({"_id": f"batch_id:{day['_id']}"}, {"$max": {"seq": day["seq"]}}, upsert=True)
+    return len(days)
+
+
+async def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--target", required=True, help="database to replay into")
+    parser.add_argument("--until", type=datetime.fromisoformat, help="replay events up to this time (UTC)")
+    parser.add_argument("--force", action="store_true", help="replay into a database that already has documents")
+    args = parser.parse_args()
+
+    if args.target == os.environ['DB_NAME']:
+        parser.error("--target must not be the source database")
+
+    client = server.create_mongo_client()
+    source = client[os.environ['DB_NAME']]
+    target = client[args.target]
+    try:
+        existing = [name for name in server.EVENT_KEYS if await target[name].estimated_document_count()]
+        if existing and not args.force:
+            print(f"⚠️  {args.target} already has {', '.join(existing)}; pass --force to replay over them")
+            return 1
+
+        # Unique indexes first, so a replay that goes wrong fails loudly
+        server.db = server.analytics_db = target
+        await server.ensure_indexes()
+
+        server.db = source
+        applied, orphans = await server.replay_events(target, args.until)
+        print(f"🔁 Replayed {sum(applied.values())} events: " +
+              ", ".join(f"{entity} {count}" for entity, count in sorted(applied.items())))
+        if orphans:
+            print(f"⚠️  {len(orphans)} updated events without their document were skipped: " +
+                  ", ".join(f"{event['entity']} {event['entity_id']}" for event in orphans[:20]) +
+                  (" ..." if len(orphans) > 20 else ""))
+
+        server.db = server.analytics_db = target
+        await target.dispatches.update_many({}, {"$unset": {"in_sales_cube": ""}})
+        await target.sales_cube.delete_many({})
+        await target.counters.delete_one({"_id": "sales_cube:backfill"})
+        await server.backfill_sales_cube(in_flight=timedelta(0))  # nothing is live in the target
+        await target.operator_shift_stats.delete_many({})
+        shifts = await server.rebuild_operator_stats()
+        # rebuild_operator_stats leaves the current shift to live updates
+        current = [stage async for stage in target.processing_stages.find(
+            {"completed_at": {"$gte": server.shift_of(datetime.now(timezone.utc))["shift_start"]}}, {"_id": 0})]
+        await server.record_operator_stats_many(current)
+        await server.reconcile_location_occupancy()
+        days = await seed_batch_counters(target)
+        print(f"📊 Rebuilt sales cube, {shifts} operator shifts (+{len(current)} current-shift stages), "
+              f"location occupancy and {days} batch ID counters in {args.target}")
+    finally:
+        client.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""
+Verify read-replica routing against a local replica set.
+
+Runs the app in-process, records which replica set member served every
+MongoDB command, and checks that:
+  - analytics routes (/dashboard/admin, /export/*) read from secondaries
+  - intake writes (POST /farmers) go to the primary
+  - session lookups (read-your-own-write) stay on the primary
+
+Start a throwaway three-member replica set first, for example:
+
+    for port in 27017 27018 27019; do
+      mkdir -p /tmp/rs0-$port
+      mongod --replSet rs0 --port $port --dbpath /tmp/rs0-$port --fork --logpath /tmp/rs0-$port.log
+    done
+    mongosh --port 27017 --eval 'rs.initiate({_id: "rs0", members: [
+      {_id: 0, host: "localhost:27017"}, {_id: 1, host: "localhost:27018"},
+      {_id: 2, host: "localhost:27019"}]})'
+
+Then:
+
+    MONGO_URL="mongodb://localhost:27017,localhost:27018,localhost:27019/?replicaSet=rs0" \\
+    DB_NAME=routing_check python scripts/verify_read_routing.py
+"""
+
+import os
+import sys
+import uuid
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+from pymongo import MongoClient, monitoring
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+
+class CommandRecorder(monitoring.CommandListener):
+    def __init__(self):
+        self.commands = []
+
+    def started(self, event):
+        self.commands.append((event.command_name, event.command.get(event.command_name), event.connection_id[:2]))
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+def main() -> int:
+    recorder = CommandRecorder()
+    # Must be registered before the app creates its client in lifespan
+    monitoring.register(recorder)
+
+    from fastapi.testclient import TestClient
+    import server
+
+    admin = MongoClient(os.environ['MONGO_URL'])
+    admin.admin.command("ping")
+    primary = admin.primary
+    secondaries = admin.secondaries
+    if not primary or not secondaries:
+        print("❌ MONGO_URL must point at a replica set with at least one secondary")
+        return 1
+
+    db = admin[os.environ['DB_NAME']]
+    user_id = f"routing_{uuid.uuid4().hex[:12]}"
+    session_token = f"routing_session_{uuid.uuid4().hex}"
+    db.users.insert_one({
+        "user_id": user_id, "email": f"{user_id}@routing.local", "name": "Routing Check",
+        "picture": None, "role": "admin", "created_at": datetime.now(timezone.utc)
+    })
+    db.user_sessions.insert_one({
+        "user_id": user_id, "session_token": session_token,
+        "expires_at": datetime.now(timezone.utc) + timedelta(hours=1),
+        "created_at": datetime.now(timezone.utc)
+    })
+
+    checks = [
+        ("GET", "/api/dashboard/admin", None, "secondary", {"find", "aggregate"}),
+        ("POST", "/api/export/batches", None, "secondary", {"find"}),
+        ("POST", "/api/export/payments", None, "secondary", {"find"}),
+        ("POST", "/api/export/processing", None, "secondary", {"find"}),
+        ("POST", "/api/farmers", {"name": "Routing Farmer", "contact": "0", "address": "-"}, "primary", {"insert"}),
+    ]
+
+    failures = 0
+    try:
+        with TestClient(server.app, headers={"Authorization": f"Bearer {session_token}"}) as http:
+            for method, path, body, expected, command_names in checks:
+                recorder.commands.clear()
+                response = http.request(method, path, json=body)
+                response.raise_for_status()
+
+                served_by = defaultdict(set)
+                for name, collection, address in recorder.commands:
+                    role = "primary" if address == primary else "secondary" if address in secondaries else "?"
+                    served_by[(name, collection)].add(role)
+
+                session_roles = served_by.get(("find", "user_sessions"), set())
+                routed = {
+                    key: roles for key, roles in served_by.items()
+                    if key[0] in command_names and key[1] not in ("user_sessions", "users")
+                }
+
+                ok = bool(routed) and all(roles == {expected} for roles in routed.values())
+                ok = ok and session_roles == {"primary"}
+                failures += not ok
+                print(f"{'✅' if ok else '❌'} {method} {path}: "
+                      + ", ".join(f"{n}:{c}→{'/'.join(sorted(r))}" for (n, c), r in sorted(routed.items()))
+                      + f" | session lookup→{'/'.join(sorted(session_roles)) or 'none'}")
+    finally:
+        db.users.delete_one({"user_id": user_id})
+        db.user_sessions.delete_many({"user_id": user_id})
+        db.farmers.delete_many({"name": "Routing Farmer"})
+        admin.close()
+
+    print("Routing verified" if not failures else f"{failures} route(s) misrouted")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+Scale simulator for the weighbridge ingestion service (weighbridge.py).
+
+Opens one TCP connection per scale and streams newline-JSON readings at a
+fixed rate: an empty platform, a crate being loaded (the weight overshoots
+and settles with noise), a steady period, then unloading. Each delivery of
+--crates crates is bracketed by start/end events, so every delivery should
+come out as one batch.
+
+    python weighbridge.py &
+    python scripts/weighbridge_simulator.py --scales 4 --rate 2000 --duration 30 --farmer-id farmer_abc123
+
+Prints readings sent per second and the weighings the service captured.
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+
+def crate_profile(weight: float):
+    # (seconds, weight function) phases for loading and unloading one crate
+    return [
+        (0.4, lambda t: random.uniform(-0.02, 0.02)),
+        (0.3, lambda t: weight * min(1.0, t / 0.3) * 1.08),
+        (0.4, lambda t: weight * (1 + 0.08 * max(0.0, 1 - t / 0.4)) + random.uniform(-0.5, 0.5) * (1 - t / 0.4)),
+        (1.0, lambda t: weight + random.uniform(-0.02, 0.02)),
+        (0.3, lambda t: weight * max(0.0, 1 - t / 0.3)),
+    ]
+
+async def run_scale(scale_id: str, args, sent: list, captured: list):
+    reader, writer = await asyncio.open_connection(args.host, args.port)
+    interval = 1 / args.rate
+    deadline = time.monotonic() + args.duration
+    
+    async def read_replies():
+        while line := await reader.readline():
+            captured.append(json.loads(line))
+    
+    replies = asyncio.create_task(read_replies())
+    
+    def send(message: dict):
+        writer.write(json.dumps(message).encode() + b"\n")
+    
+    while time.monotonic() < deadline:
+        send({"scale_id": scale_id, "event": "start", "farmer_id": args.farmer_id,
+              "size_grade": random.choice(["Small", "Medium", "Large", "Jumbo"]), "location": f"Dock {scale_id}"})
+        
+        for _ in range(args.crates):
+            weight = round(random.uniform(15, 40), 2)
+            for seconds, curve in crate_profile(weight):
+                phase_start = time.time()
+                steps = int(seconds * args.rate)
+                # Send in 10 ms slices so the rate holds without a sleep per reading
+                for step in range(steps):
+                    ts = phase_start + step * interval
+                    send({"scale_id": scale_id, "weight_kg": round(curve(step * interval), 3), "ts": ts})
+                    sent[0] += 1
+                    if step % max(1, args.rate // 100) == 0:
+                        await writer.drain()
+                        await asyncio.sleep(max(0.0, ts - time.time()))
+        
+        send({"scale_id": scale_id, "event": "end"})
+        await writer.drain()
+    
+    await asyncio.sleep(1)
+    replies.cancel()
+    writer.close()
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--scales", type=int, default=2)
+    parser.add_argument("--rate", type=int, default=1000, help="readings per second per scale")
+    parser.add_argument("--duration", type=float, default=20)
+    parser.add_argument("--crates", type=int, default=5, help="crates per delivery")
+    parser.add_argument("--farmer-id", default="farmer_simulator")
+    args = parser.parse_args()
+    
+    sent = [0]
+    captured = []
+    started = time.monotonic()
+    await asyncio.gather(*(run_scale(f"S{i + 1}", args, sent, captured) for i in range(args.scales)))
+    elapsed = time.monotonic() - started
+    
+    print(f"📡 {args.scales} scales, {sent[0]} readings in {elapsed:.1f}s "
+          f"({sent[0] / elapsed:.0f}/s total, {sent[0] / elapsed / args.scales:.0f}/s per scale)")
+    print(f"⚖️  {len(captured)} weighings captured")
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,31 +1,124 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, Response, Request
-from fastapi.responses import StreamingResponse
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, Response, Request, Header
+from fastapi.responses import StreamingResponse, JSONResponse
 from dotenv import load_dotenv
+from bson import ObjectId
+from bson.errors import InvalidId
+from starlette.datastructures import MutableHeaders
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import DeleteOne, ReplaceOne, UpdateOne, ReturnDocument
+from pymongo.read_preferences import Primary, PrimaryPreferred, Secondary, SecondaryPreferred, Nearest
+from pymongo.errors import BulkWriteError, CollectionInvalid, DuplicateKeyError, OperationFailure
+import asyncio
+import base64
+import bisect
+import csv
+import hashlib
+import hmac
+import importlib
+import gzip
+import itertools
+import math
+import multiprocessing
 import os
+import re
+import socket
+import sys
+import tempfile
+import time
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import asynccontextmanager
+from functools import lru_cache
 import logging
 from pathlib import Path
-from pydantic import BaseModel, Field, field_validator
-from typing import List, Optional
+from pydantic import BaseModel, Field, field_validator, ValidationError
+from typing import Dict, List, Optional
 import uuid
 from datetime import datetime, timezone, timedelta
-import qrcode
 from io import BytesIO
+from zoneinfo import ZoneInfo
 import json
-from openpyxl import Workbook
-from openpyxl.styles import Font, PatternFill, Alignment
+
+class LazyModule:
+    # Stands in for a heavy module until an attribute is first used, so
+    # workers that only serve JSON never import it. warm_up_modules() loads
+    # them in the background after startup.
+    def __init__(self, name: str):
+        self._name = name
+        self._module = None
+    
+    # Underscored so it never shadows a module attribute (numpy.load)
+    def _load(self):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return self._module
+    
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+qrcode = LazyModule("qrcode")  # Pulls in PIL when an image is made
+np = LazyModule("numpy")
+openpyxl = LazyModule("openpyxl")
+httpx = LazyModule("httpx")
+brotli = LazyModule("brotli")  # Only for Accept-Encoding: br
+msgpack = LazyModule("msgpack")  # Only for Accept: application/msgpack
+
+HEAVY_MODULES = ["qrcode", "PIL", "numpy", "openpyxl", "httpx", "brotli", "msgpack"]
+
+# Filled in by warm_up_modules (see App Lifecycle); reported by /api/ready
+warmup_state = {"warmed": False, "started_at": None, "finished_at": None, "steps_ms": {}}
+# Unique indexes ensure_indexes could not build ("payments.batch_id": reason);
+# reported by /api/health until the duplicates are resolved
+missing_unique_indexes: Dict[str, str] = {}
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
-# MongoDB connection
-mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
-db = client[os.environ['DB_NAME']]
+# MongoDB connection. The client is created in lifespan, once per worker
+# process: a Motor client must not be carried across a fork, so nothing is
+# opened at import time.
+client: Optional[AsyncIOMotorClient] = None
+db = None
+# Same database, but reads go to secondaries (see analytics_read_preference).
+# Only for heavy read-only routes that tolerate bounded staleness: dashboards,
+# exports and farmer stats. Writes and read-your-own-write paths use db.
+analytics_db = None
 
-# Create the main app without a prefix
-app = FastAPI()
+def create_mongo_client() -> AsyncIOMotorClient:
+    options = {
+        "maxPoolSize": int(os.environ.get('MONGO_MAX_POOL_SIZE', '100')),
+        "minPoolSize": int(os.environ.get('MONGO_MIN_POOL_SIZE', '0')),
+        "connectTimeoutMS": int(os.environ.get('MONGO_CONNECT_TIMEOUT_MS', '20000')),
+        "serverSelectionTimeoutMS": int(os.environ.get('MONGO_SERVER_SELECTION_TIMEOUT_MS', '30000')),
+    }
+    # Unset by default (no limit), matching the driver defaults
+    for option, env_var in [
+        ("socketTimeoutMS", 'MONGO_SOCKET_TIMEOUT_MS'),
+        ("maxIdleTimeMS", 'MONGO_MAX_IDLE_TIME_MS'),
+        ("waitQueueTimeoutMS", 'MONGO_WAIT_QUEUE_TIMEOUT_MS'),
+    ]:
+        if os.environ.get(env_var):
+            options[option] = int(os.environ[env_var])
+    
+    return AsyncIOMotorClient(os.environ['MONGO_URL'], **options)
+
+def analytics_read_preference():
+    mode = os.environ.get('MONGO_ANALYTICS_READ_PREFERENCE', 'secondaryPreferred')
+    # MongoDB requires at least 90 seconds; -1 disables the staleness bound
+    max_staleness = int(os.environ.get('MONGO_MAX_STALENESS_SECONDS', '90'))
+    
+    modes = {
+        "primaryPreferred": PrimaryPreferred,
+        "secondary": Secondary,
+        "secondaryPreferred": SecondaryPreferred,
+        "nearest": Nearest,
+    }
+    if mode == "primary":
+        return Primary()
+    if mode not in modes:
+        raise ValueError(f"Invalid MONGO_ANALYTICS_READ_PREFERENCE: {mode}")
+    return modes[mode](max_staleness=max_staleness)
 
 # Create a router with the /api prefix
 api_router = APIRouter(prefix="/api")
@@ -73,6 +166,12 @@ class Farmer(BaseModel):
     address: str
     created_at: datetime
 
+class FarmerRef(BaseModel):
+    # A farmer as embedded by expand=farmer
+    farmer_id: str
+    name: str
+    contact: Optional[str] = None
+
 class BatchCreate(BaseModel):
     farmer_id: str
     weight_kg: float
@@ -95,8 +194,20 @@ class Batch(BaseModel):
     intake_time: str
     location: str
     status: str
-    qr_code: str
+    qr_code: Optional[str] = None  # None for imported historical batches
     created_at: datetime
+    farmer: Optional[FarmerRef] = None  # expand=farmer
+
+class BatchRef(BaseModel):
+    # A batch as embedded by expand=batch
+    batch_id: str
+    farmer_id: str
+    weight_kg: float
+    size_grade: str
+    status: str
+    location: Optional[str] = None
+    intake_date: Optional[datetime] = None
+    farmer: Optional[FarmerRef] = None  # expand=batch.farmer
 
 class ProcessingStageCreate(BaseModel):
     batch_id: str
@@ -104,6 +215,7 @@ class ProcessingStageCreate(BaseModel):
     assigned_person: str
     input_weight: float
     output_weight: float
+    started_at: Optional[datetime] = None  # When work began, for throughput
 
 class ProcessingStage(BaseModel):
     stage_id: str
@@ -115,12 +227,22 @@ class ProcessingStage(BaseModel):
     wastage: float
     status: str
     created_at: datetime
+    started_at: Optional[datetime] = None
     completed_at: Optional[datetime] = None
+    batch: Optional[BatchRef] = None  # expand=batch
 
 class InventoryCreate(BaseModel):
     batch_id: str
     location: str
     quantity: float
+    lot_id: Optional[str] = None  # Graded lot being stored, if split
+
+    @field_validator('quantity')
+    @classmethod
+    def validate_quantity(cls, v):
+        if v <= 0:
+            raise ValueError('Quantity must be positive')
+        return v
 
 class Inventory(BaseModel):
     inventory_id: str
@@ -130,6 +252,24 @@ class Inventory(BaseModel):
     batch_age: int
     status: str
     created_at: datetime
+    batch: Optional[BatchRef] = None  # expand=batch
+
+class StorageLocation(BaseModel):
+    location: str
+    capacity_kg: Optional[float] = None
+    occupied_kg: float
+    item_count: int
+    updated_at: datetime
+
+class StorageLocationUpdate(BaseModel):
+    capacity_kg: Optional[float] = None
+
+    @field_validator('capacity_kg')
+    @classmethod
+    def validate_capacity(cls, v):
+        if v is not None and v <= 0:
+            raise ValueError('Capacity must be positive')
+        return v
 
 class DispatchCreate(BaseModel):
     batch_id: str
@@ -137,6 +277,7 @@ class DispatchCreate(BaseModel):
     country: str
     selling_price: float
     dispatch_date: datetime
+    lot_ids: List[str] = []  # Lots / cartons shipped, for recall tracing
 
 class Dispatch(BaseModel):
     dispatch_id: str
@@ -145,8 +286,42 @@ class Dispatch(BaseModel):
     country: str
     selling_price: float
     dispatch_date: datetime
+    weight_kg: Optional[float] = None  # Shipped volume
+    size_grade: Optional[str] = None
     status: str
     created_at: datetime
+    batch: Optional[BatchRef] = None  # expand=batch
+
+class LotPart(BaseModel):
+    size_grade: str
+    weight_kg: float
+
+    @field_validator('weight_kg')
+    @classmethod
+    def validate_weight(cls, v):
+        if v <= 0:
+            raise ValueError('Weight must be positive')
+        return v
+
+class LotSplit(BaseModel):
+    source_id: str  # batch_id or lot_id
+    lots: List[LotPart]
+
+class LotSource(BaseModel):
+    id: str  # batch_id or lot_id
+    weight_kg: float
+
+class LotMerge(BaseModel):
+    sources: List[LotSource]
+    size_grade: Optional[str] = None
+
+class Lot(BaseModel):
+    lot_id: str
+    size_grade: Optional[str] = None
+    weight_kg: float
+    origin: str  # split, merge
+    source_ids: List[str]
+    created_at: datetime
 
 class PaymentCreate(BaseModel):
     farmer_id: str
@@ -165,28 +340,1012 @@ class Payment(BaseModel):
     net_amount: float
     payment_status: str
     payment_date: Optional[datetime] = None
+    pay_cycle_id: Optional[str] = None
+    created_at: datetime
+    batch: Optional[BatchRef] = None  # expand=batch
+    farmer: Optional[FarmerRef] = None  # expand=farmer
+
+class PriceTableUpdate(BaseModel):
+    prices: Dict[str, float]  # size_grade -> price per kg
+
+    @field_validator('prices')
+    @classmethod
+    def validate_prices(cls, v):
+        if any(price <= 0 for price in v.values()):
+            raise ValueError('Prices must be positive')
+        return v
+
+class PayCycleCreate(BaseModel):
+    start_date: datetime
+    end_date: datetime
+    prices: Optional[Dict[str, float]] = None  # Overrides the stored price table
+    deduction_percent: float = 0
+    deduction_per_kg: float = 0
+    dry_run: bool = False
+
+class BulkPaymentStatusUpdate(BaseModel):
+    payment_ids: List[str] = []
+    pay_cycle_id: Optional[str] = None
+    status: str
+
+class TemperatureReading(BaseModel):
+    sensor_id: str
+    location: str  # Matches inventory.location
+    temperature_c: float
+    ts: Optional[datetime] = None  # Defaults to the time received
+
+class TelemetryUpload(BaseModel):
+    readings: List[TemperatureReading]
+
+# Bulk import rows: the create models plus what historical records carry
+class FarmerImportRow(FarmerCreate):
+    farmer_id: Optional[str] = None  # Keep the legacy ID so batch rows can refer to it
+    created_at: Optional[datetime] = None
+
+class BatchImportRow(BatchCreate):
+    batch_id: Optional[str] = None  # Allocated when missing
+    intake_date: Optional[datetime] = None
+    status: str = "RECEIVED"
+
+    @field_validator('status')
+    @classmethod
+    def validate_status(cls, v):
+        if v not in ("RECEIVED", "PROCESSED", "STORED", "SHIPPED"):
+            raise ValueError('status must be RECEIVED, PROCESSED, STORED or SHIPPED')
+        return v
+
+class ProcessingStageImportRow(ProcessingStageCreate):
+    completed_at: Optional[datetime] = None
+
+class PaymentImportRow(PaymentCreate):
+    payment_status: str = "paid"
+    payment_date: Optional[datetime] = None
+
+    @field_validator('payment_status')
+    @classmethod
+    def validate_payment_status(cls, v):
+        if v not in ("pending", "paid"):
+            raise ValueError('payment_status must be pending or paid')
+        return v
+
+class SyncOperation(BaseModel):
+    client_request_id: str
+    kind: str  # batch, processing_stage
+    payload: dict
+
+class SyncUpload(BaseModel):
+    operations: List[SyncOperation]
+
+class ExportJob(BaseModel):
+    job_id: str
+    kind: str
+    status: str  # queued, running, done, failed
+    rows: Optional[int] = None
+    size_bytes: Optional[int] = None
+    filename: Optional[str] = None
+    error: Optional[str] = None
     created_at: datetime
+    started_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+    expires_at: Optional[datetime] = None
+    start: Optional[datetime] = None
+    end: Optional[datetime] = None
 
 # ============ Helper Functions ============
 
-def generate_qr_code(data: dict) -> str:
-    qr = qrcode.QRCode(
-        version=1,
-        error_correction=qrcode.constants.ERROR_CORRECT_H,
-        box_size=10,
-        border=4,
+_auth_http_client = None
+
+def auth_http_client():
+    # Shared client for the auth provider, created on first login (or warm-up)
+    global _auth_http_client
+    if _auth_http_client is None:
+        _auth_http_client = httpx.AsyncClient(timeout=15)
+    return _auth_http_client
+
+# Batch QR codes hold a short versioned reference, not the batch itself:
+#
+#     AQ1:20260218000123:Z43V
+#
+# payload version, batch ID without its "BATCH" prefix (other IDs, such as
+# imported legacy ones, are kept whole behind a "-"), and a check code.
+# Everything is in the QR alphanumeric set, so codes stay at version 2-3
+# instead of 11-13 for the old JSON payload. The scanner page resolves the
+# reference with GET /api/qr/resolve; codes already printed with JSON still
+# resolve there.
+QR_PAYLOAD_VERSION = "AQ1"
+# Keys the check code, so a hand-made code for another batch ID fails.
+# Changing it invalidates every printed code. Unset, load_qr_check_key uses
+# one generated on first start and kept in the database.
+QR_CHECK_KEY = os.environ.get('QR_CHECK_KEY', '').encode()
+QR_ERROR_LEVELS = ("L", "M", "Q", "H")  # ~7%, 15%, 25%, 30% of the code recoverable
+QR_ERROR_CORRECTION = os.environ.get('QR_ERROR_CORRECTION', 'Q').upper()
+QR_IMAGE_FORMATS = {"png": "image/png", "svg": "image/svg+xml"}
+
+async def load_qr_check_key():
+    # With an empty key anyone could make a code that passes for any batch.
+    # Without QR_CHECK_KEY, the first worker to start generates a key into
+    # counters and every worker (and the weighbridge) uses that one, so
+    # labels stay valid across restarts.
+    global QR_CHECK_KEY
+    if QR_CHECK_KEY:
+        return
+    try:
+        stored = await db.counters.find_one_and_update(
+            {"_id": "qr_check_key"},
+            {"$setOnInsert": {"key": os.urandom(32).hex(), "created_at": datetime.now(timezone.utc)}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+    except DuplicateKeyError:
+        # Another worker generated it at the same moment
+        stored = await db.counters.find_one({"_id": "qr_check_key"})
+    QR_CHECK_KEY = stored["key"].encode()
+    logger.warning("QR_CHECK_KEY is not set; signing batch QR codes with the generated key in counters "
+                   "(qr_check_key). Set QR_CHECK_KEY to that value to keep labels valid on another database.")
+
+def qr_check_code(ref: str) -> str:
+    digest = hmac.new(QR_CHECK_KEY, ref.encode(), hashlib.sha256).digest()
+    return base64.b32encode(digest[:5]).decode()[:4]
+
+def encode_batch_qr(batch_id: str) -> str:
+    ref = batch_id[5:] if re.fullmatch(r"BATCH\d+", batch_id) else f"-{batch_id}"
+    return f"{QR_PAYLOAD_VERSION}:{ref}:{qr_check_code(ref)}"
+
+def decode_batch_qr(text: str) -> str:
+    # Batch ID from a scanned code; ValueError if it isn't one of ours
+    text = text.strip()
+    if text.startswith("{"):
+        # Labels printed before AQ1
+        try:
+            batch_id = json.loads(text).get("batch_id")
+        except (ValueError, AttributeError):
+            batch_id = None
+        if not isinstance(batch_id, str):
+            raise ValueError("Not a batch QR code")
+        return batch_id
+    
+    version, _, rest = text.partition(":")
+    ref, _, check = rest.rpartition(":")
+    if version != QR_PAYLOAD_VERSION or not ref:
+        raise ValueError("Not a batch QR code")
+    if not hmac.compare_digest(check.encode(), qr_check_code(ref).encode()):
+        raise ValueError("QR code failed its integrity check")
+    return ref[1:] if ref.startswith("-") else f"BATCH{ref}"
+
+def qr_error_level(level: Optional[str] = None) -> int:
+    level = (level or QR_ERROR_CORRECTION).upper()
+    if level not in QR_ERROR_LEVELS:
+        raise ValueError(f"error_correction must be one of {', '.join(QR_ERROR_LEVELS)}")
+    return getattr(qrcode.constants, f"ERROR_CORRECT_{level}")
+
+def qr_matrix(payload: str, error_correction: Optional[str] = None) -> List[List[bool]]:
+    qr = qrcode.QRCode(error_correction=qr_error_level(error_correction), border=0)
+    qr.add_data(payload)
+    qr.make(fit=True)
+    return qr.get_matrix()
+
+def qr_svg(matrix: List[List[bool]], border: int = 4) -> str:
+    # One path of horizontal runs in module units; scales to any print size.
+    # qrcode's own SVG factories write mm coordinates and come out ~2x larger.
+    size = len(matrix) + 2 * border
+    runs = []
+    for y, row in enumerate(matrix):
+        x = 0
+        while x < len(row):
+            if row[x]:
+                start = x
+                while x < len(row) and row[x]:
+                    x += 1
+                runs.append(f"M{start + border} {y + border}h{x - start}v1h-{x - start}z")
+            else:
+                x += 1
+    return (
+        f'<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 {size} {size}" shape-rendering="crispEdges">'
+        f'<rect width="{size}" height="{size}" fill="#fff"/><path d="{"".join(runs)}"/></svg>'
     )
-    qr.add_data(json.dumps(data))
+
+def render_qr_image(payload: str, image_format: str = "png", error_correction: Optional[str] = None,
+                    box_size: int = 10, border: int = 4) -> bytes:
+    if image_format == "svg":
+        return qr_svg(qr_matrix(payload, error_correction), border).encode()
+    qr = qrcode.QRCode(error_correction=qr_error_level(error_correction), box_size=box_size, border=border)
+    qr.add_data(payload)
     qr.make(fit=True)
-    
-    img = qr.make_image(fill_color="black", back_color="white")
     buffer = BytesIO()
-    img.save(buffer, format='PNG')
-    buffer.seek(0)
+    qr.make_image(fill_color="black", back_color="white").save(buffer, format="PNG")
+    return buffer.getvalue()
+
+def generate_qr_code(payload: str, image_format: str = "png", error_correction: Optional[str] = None) -> str:
+    image = render_qr_image(payload, image_format, error_correction)
+    return f"data:{QR_IMAGE_FORMATS[image_format]};base64,{base64.b64encode(image).decode()}"
+
+class ResponseCache:
+    """Single-flight, TTL and size bounded cache for hot read endpoints.
+    
+    Concurrent identical requests share one in-flight computation. Results
+    are kept for a few seconds and dropped as soon as a write touches one of
+    the collections (tags) they were built from. The cache is per process, so
+    another worker can serve a result for up to its TTL after a write it did
+    not see.
+    """
+    
+    def __init__(self, max_entries: int, default_ttl: float):
+        self.max_entries = max_entries
+        self.default_ttl = default_ttl
+        self.entries = OrderedDict()  # key -> (expires_at, tags, value)
+        self.inflight = {}  # key -> (task, tags)
+        self.generations = defaultdict(int)  # tag -> write counter
+        self.stats = defaultdict(int)
+    
+    async def get_or_compute(self, key: tuple, tags: set, compute, ttl: Optional[float] = None, db_queries: int = 1):
+        entry = self.entries.get(key)
+        if entry and entry[0] > time.monotonic():
+            self.entries.move_to_end(key)
+            self.stats["hits"] += 1
+            self.stats["db_queries_saved"] += db_queries
+            return entry[2]
+        
+        if key in self.inflight:
+            self.stats["coalesced"] += 1
+            self.stats["db_queries_saved"] += db_queries
+            return await asyncio.shield(self.inflight[key][0])
+        
+        self.stats["misses"] += 1
+        generations = {tag: self.generations[tag] for tag in tags}
+        # Runs as its own task so a disconnecting first caller does not
+        # cancel the computation for everyone waiting on it
+        task = asyncio.create_task(compute())
+        self.inflight[key] = (task, tags)
+        task.add_done_callback(
+            lambda done: self._store(key, done, tags, generations, self.default_ttl if ttl is None else ttl)
+        )
+        return await asyncio.shield(task)
+    
+    def _store(self, key: tuple, task: asyncio.Task, tags: set, generations: dict, ttl: float):
+        if self.inflight.get(key, (None,))[0] is task:
+            del self.inflight[key]
+        
+        if task.cancelled() or task.exception() is not None or ttl <= 0:
+            return
+        
+        # A write landed while computing: the result may already be stale
+        if any(self.generations[tag] != generation for tag, generation in generations.items()):
+            return
+        
+        self.entries[key] = (time.monotonic() + ttl, tags, task.result())
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.stats["evictions"] += 1
+    
+    def invalidate(self, *tags: str):
+        for tag in tags:
+            self.generations[tag] += 1
+        
+        stale = [key for key, entry in self.entries.items() if entry[1] & set(tags)]
+        for key in stale:
+            del self.entries[key]
+        self.stats["invalidations"] += len(stale)
+        
+        # New requests must not join a computation that started before the write
+        for key in [key for key, (_, key_tags) in self.inflight.items() if key_tags & set(tags)]:
+            del self.inflight[key]
+    
+    def report(self) -> dict:
+        served = self.stats["hits"] + self.stats["coalesced"]
+        requests = served + self.stats["misses"]
+        
+        return {
+            "pid": os.getpid(),
+            "entries": len(self.entries),
+            "max_entries": self.max_entries,
+            "inflight": len(self.inflight),
+            "hits": self.stats["hits"],
+            "coalesced": self.stats["coalesced"],
+            "misses": self.stats["misses"],
+            "hit_rate": served / requests if requests else 0,
+            "db_queries_saved": self.stats["db_queries_saved"],
+            "invalidations": self.stats["invalidations"],
+            "evictions": self.stats["evictions"]
+        }
+
+response_cache = ResponseCache(
+    max_entries=int(os.environ.get('RESPONSE_CACHE_MAX_ENTRIES', '512')),
+    default_ttl=float(os.environ.get('RESPONSE_CACHE_TTL_SECONDS', '5'))
+)
+
+# expand= on list endpoints: name -> (reference field, collection, key,
+# embedded fields). "batch.farmer" expands the farmer of each embedded batch.
+EXPANSIONS = {
+    "batch": ("batch_id", "batches", "batch_id", ["farmer_id", "weight_kg", "size_grade", "status", "location", "intake_date"]),
+    "farmer": ("farmer_id", "farmers", "farmer_id", ["name", "contact"]),
+}
+EXPANSION_CHILDREN = {"batch": {"farmer"}}
+
+class ReferenceLoader:
+    """Batched lookup of referenced documents for one request.
+    
+    load() fetches every key it has not seen yet with a single $in query on
+    the collection; keys already loaded, or known to be missing, come from
+    memory. So a page of 1000 dispatches over 40 batches costs one query for
+    the batches, however the expansions are nested. Batches that have moved
+    to the cold tier are looked up there.
+    """
+    
+    def __init__(self):
+        self.documents = defaultdict(dict)  # collection -> key -> doc or None
+        self.queries = 0
+    
+    async def load(self, collection: str, key: str, values: List[str], fields: List[str]) -> Dict[str, Optional[dict]]:
+        known = self.documents[collection]
+        missing = list({value for value in values if value is not None and value not in known})
+        if missing:
+            projection = {"_id": 0, key: 1, **{field: 1 for field in fields}}
+            found = await db[collection].find({key: {"$in": missing}}, projection).to_list(None)
+            self.queries += 1
+            archived = set(missing) - {doc[key] for doc in found}
+            if archived and collection in ARCHIVE_SPECS:
+                found += await find_archived(collection, {key: list(archived)}, columns=fields)
+            for doc in found:
+                known[doc[key]] = doc
+            for value in missing:
+                known.setdefault(value, None)
+        return {value: known.get(value) for value in values}
+
+def parse_expand(expand: Optional[str], allowed: set) -> dict:
+    # "batch,batch.farmer" -> {"batch": {"farmer": {}}}; 400 for anything the
+    # endpoint's documents don't reference
+    tree = {}
+    for path in filter(None, (part.strip() for part in (expand or "").split(","))):
+        names = path.split(".")
+        valid = names[0] in allowed and all(
+            child in EXPANSION_CHILDREN.get(parent, ()) for parent, child in zip(names, names[1:])
+        )
+        if not valid:
+            raise HTTPException(status_code=400, detail=f"Cannot expand '{path}' here")
+        node = tree
+        for name in names:
+            node = node.setdefault(name, {})
+    return tree
+
+def expansion_tags(tree: dict) -> set:
+    # Response cache tags for the collections an expansion reads
+    tags = set()
+    for name, children in tree.items():
+        tags |= {EXPANSIONS[name][1]} | expansion_tags(children)
+    return tags
+
+async def expand_references(docs: List[dict], tree: dict, loader: Optional[ReferenceLoader] = None) -> List[dict]:
+    # Embeds referenced documents in place, one level at a time, so each
+    # level costs at most one query per collection
+    loader = loader or ReferenceLoader()
+    for name, children in tree.items():
+        field, collection, key, fields = EXPANSIONS[name]
+        found = await loader.load(collection, key, [doc.get(field) for doc in docs], fields)
+        for doc in docs:
+            doc[name] = found.get(doc.get(field))
+        if children:
+            embedded = {id(ref): ref for ref in found.values() if ref is not None}
+            await expand_references(list(embedded.values()), children, loader)
+    return docs
+
+def parse_fields(fields: Optional[str], model, key: str, tree: dict) -> Optional[dict]:
+    # fields=batch_id,status,weight_kg -> Mongo projection, so other fields
+    # are never read. The id and any expanded references are always kept.
+    if not fields:
+        return None
+    names = [name.strip() for name in fields.split(",") if name.strip()]
+    unknown = [name for name in names if name not in model.model_fields or name in EXPANSIONS]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown field(s): {', '.join(unknown)}")
+    return {"_id": 0, key: 1, **{name: 1 for name in names}, **{EXPANSIONS[name][0]: 1 for name in tree}}
+
+async def cached_list(route: str, user: dict, tags: set, load, tree: dict, projection: Optional[dict] = None) -> List[dict]:
+    # A cached list endpoint, with its fields= projection and expand= tree
+    # applied. Each variant is cached separately and dropped on writes to
+    # the collections it read.
+    key = (route, user["role"])
+    if projection:
+        key += (json.dumps(projection, sort_keys=True),)
+    if tree:
+        key += (json.dumps(tree, sort_keys=True),)
+    
+    async def compute():
+        docs = await (load(projection) if projection else load())
+        return await expand_references(docs, tree) if tree else docs
+    
+    tree_tags = expansion_tags(tree)
+    return await response_cache.get_or_compute(key, tags | tree_tags, compute, db_queries=1 + len(tree_tags))
+
+MSGPACK_TYPES = ("application/msgpack", "application/x-msgpack")
+
+def wants_msgpack(request: Request) -> bool:
+    accept = request.headers.get("accept", "")
+    return any(media_type in accept for media_type in MSGPACK_TYPES)
+
+def encode_json_value(value):
+    # Matches how the response models serialize datetimes
+    if isinstance(value, datetime):
+        return value.isoformat().replace("+00:00", "Z")
+    raise TypeError(f"Cannot serialize {type(value).__name__}")
+
+def encode_msgpack_value(value):
+    # Datetimes as the msgpack timestamp extension; clients decode to dates
+    if isinstance(value, datetime):
+        return msgpack.Timestamp.from_datetime(value if value.tzinfo else value.replace(tzinfo=timezone.utc))
+    raise TypeError(f"Cannot serialize {type(value).__name__}")
+
+def encode_list_body(docs: List[dict], media_type: str = "application/json") -> bytes:
+    if media_type in MSGPACK_TYPES:
+        return msgpack.packb(docs, default=encode_msgpack_value)
+    return json.dumps(docs, default=encode_json_value, separators=(",", ":")).encode()
+
+def list_response(request: Request, response: Response, docs: List[dict], model, partial: bool):
+    # Full JSON rows go through the endpoint's response model as before.
+    # Sparse rows (fields=) and MessagePack are encoded here: the model would
+    # reject the former and can only render JSON. Every representation varies
+    # on Accept, so shared caches never hand JSON to a MessagePack client.
+    msgpack_requested = wants_msgpack(request)
+    if not partial and not msgpack_requested:
+        response.headers["Vary"] = "Accept"
+        return docs
+    if not partial:
+        docs = [model(**doc).model_dump() for doc in docs]
+    media_type = "application/msgpack" if msgpack_requested else "application/json"
+    return Response(content=encode_list_body(docs, media_type), media_type=media_type, headers={"Vary": "Accept"})
+
+class BatchIdAllocator:
+    # Hands out BATCH{YYYYMMDD}{seq:06d} ids from a per-day counter in the
+    # counters collection, the day being the plant's (PLANT_TIMEZONE). Every
+    # call is one atomic $inc of count, so ids sort in the order they were
+    # issued across all workers, and a bulk call (sync upload, import,
+    # weighbridge flush) gets a contiguous run.
+    async def allocate(self, count: int = 1) -> List[str]:
+        if count <= 0:
+            return []
+        day = datetime.now(PLANT_TIMEZONE).strftime("%Y%m%d")
+        counter = await db.counters.find_one_and_update(
+            {"_id": f"batch_id:{day}"},
+            {"$inc": {"seq": count}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        return [f"BATCH{day}{seq:06d}" for seq in range(counter["seq"] - count + 1, counter["seq"] + 1)]
+
+batch_id_allocator = BatchIdAllocator()
+
+class AdmissionRejected(Exception):
+    def __init__(self, route_class: str, retry_after: int):
+        super().__init__(route_class)
+        self.route_class = route_class
+        self.retry_after = retry_after
+
+class AdmissionController:
+    """Per route class concurrency limits with bounded wait queues.
+    
+    Heavy classes (exports, dashboards, bulk endpoints) each get a number of
+    concurrent slots and a short queue; overflow and queue timeouts are
+    rejected with 429. Latency-critical requests are never queued, and while
+    any are in flight the heavy classes together are held to
+    pressure_limit slots so intake keeps the event loop.
+    """
+    
+    def __init__(self, classes: dict, pressure_limit: int, queue_timeout: float):
+        self.classes = {
+            name: {
+                "limit": limit,
+                "queue": queue,
+                "running": 0,
+                "waiting": 0,
+                "admitted": 0,
+                "rejected": 0,
+                "timed_out": 0,
+                "avg_seconds": None
+            }
+            for name, (limit, queue) in classes.items()
+        }
+        self.pressure_limit = pressure_limit
+        self.queue_timeout = queue_timeout
+        self.critical_inflight = 0
+        self.condition = asyncio.Condition()
+    
+    def _has_capacity(self, name: str) -> bool:
+        route_class = self.classes[name]
+        if route_class["running"] >= route_class["limit"]:
+            return False
+        
+        if self.critical_inflight:
+            heavy_running = sum(c["running"] for c in self.classes.values())
+            return heavy_running < self.pressure_limit
+        
+        return True
+    
+    def _retry_after(self, name: str) -> int:
+        route_class = self.classes[name]
+        avg_seconds = route_class["avg_seconds"] or 1
+        return max(1, math.ceil(avg_seconds * (route_class["waiting"] + 1) / route_class["limit"]))
+    
+    async def acquire(self, name: str):
+        route_class = self.classes[name]
+        
+        async with self.condition:
+            if not (route_class["waiting"] == 0 and self._has_capacity(name)):
+                if route_class["waiting"] >= route_class["queue"]:
+                    route_class["rejected"] += 1
+                    raise AdmissionRejected(name, self._retry_after(name))
+                
+                route_class["waiting"] += 1
+                try:
+                    await asyncio.wait_for(
+                        self.condition.wait_for(lambda: self._has_capacity(name)),
+                        timeout=self.queue_timeout
+                    )
+                except asyncio.TimeoutError:
+                    route_class["timed_out"] += 1
+                    raise AdmissionRejected(name, self._retry_after(name))
+                finally:
+                    route_class["waiting"] -= 1
+            
+            route_class["running"] += 1
+            route_class["admitted"] += 1
+    
+    async def release(self, name: str, elapsed: float):
+        route_class = self.classes[name]
+        
+        async with self.condition:
+            route_class["running"] -= 1
+            # Moving average of service time, used for Retry-After
+            previous = route_class["avg_seconds"]
+            route_class["avg_seconds"] = elapsed if previous is None else 0.8 * previous + 0.2 * elapsed
+            self.condition.notify_all()
+    
+    async def enter_critical(self):
+        self.critical_inflight += 1
+    
+    async def exit_critical(self):
+        async with self.condition:
+            self.critical_inflight -= 1
+            self.condition.notify_all()
+    
+    def report(self) -> dict:
+        return {
+            "pid": os.getpid(),
+            "critical_inflight": self.critical_inflight,
+            "pressure_limit": self.pressure_limit,
+            "classes": {
+                name: {key: value for key, value in route_class.items()}
+                for name, route_class in self.classes.items()
+            }
+        }
+
+# (method, path pattern, route class). Unlisted routes are not limited.
+ADMISSION_ROUTES = [
+    ("POST", re.compile(r"^/api/batches$"), "critical"),
+    ("POST", re.compile(r"^/api/processing$"), "critical"),
+    ("POST", re.compile(r"^/api/export/"), "export"),
+    ("GET", re.compile(r"^/api/labels$"), "export"),
+    ("GET", re.compile(r"^/api/export/jobs/[^/]+/download$"), "export"),
+    ("GET", re.compile(r"^/api/dashboard/"), "dashboard"),
+    ("POST", re.compile(r"^/api/payments/pay-cycle$"), "bulk"),
+    ("PUT", re.compile(r"^/api/payments/bulk-status$"), "bulk"),
+    ("POST", re.compile(r"^/api/sync/upload$"), "bulk"),
+    ("POST", re.compile(r"^/api/import/[a-z_]+$"), "bulk"),
+    ("POST", re.compile(r"^/api/inventory/locations/reconcile$"), "bulk"),
+]
+
+def classify_admission_route(method: str, path: str) -> Optional[str]:
+    for route_method, pattern, route_class in ADMISSION_ROUTES:
+        if method == route_method and pattern.match(path):
+            return route_class
+    return None
+
+def admission_class_config(name: str, limit: int, queue: int) -> tuple:
+    return (
+        int(os.environ.get(f'ADMISSION_{name.upper()}_LIMIT', str(limit))),
+        int(os.environ.get(f'ADMISSION_{name.upper()}_QUEUE', str(queue)))
+    )
+
+admission_controller = AdmissionController(
+    classes={
+        "export": admission_class_config("export", 2, 4),
+        "dashboard": admission_class_config("dashboard", 4, 16),
+        "bulk": admission_class_config("bulk", 2, 4),
+    },
+    pressure_limit=int(os.environ.get('ADMISSION_PRESSURE_LIMIT', '1')),
+    queue_timeout=float(os.environ.get('ADMISSION_QUEUE_TIMEOUT_SECONDS', '10'))
+)
+
+class AdmissionControlMiddleware:
+    def __init__(self, app, controller: AdmissionController):
+        self.app = app
+        self.controller = controller
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        
+        route_class = classify_admission_route(scope["method"], scope["path"])
+        if route_class is None:
+            return await self.app(scope, receive, send)
+        
+        if route_class == "critical":
+            await self.controller.enter_critical()
+            try:
+                return await self.app(scope, receive, send)
+            finally:
+                await self.controller.exit_critical()
+        
+        try:
+            await self.controller.acquire(route_class)
+        except AdmissionRejected as e:
+            response = JSONResponse(
+                {"detail": f"Too many {e.route_class} requests, retry later"},
+                status_code=429,
+                headers={"Retry-After": str(e.retry_after)}
+            )
+            return await response(scope, receive, send)
+        
+        started = time.monotonic()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            await self.controller.release(route_class, time.monotonic() - started)
+
+# Response compression: brotli when the client accepts it, else gzip. Only
+# whole bodies of at least COMPRESSION_MIN_BYTES are compressed; streamed
+# responses (exports, import progress, file downloads) pass through so their
+# chunks aren't held back, as do ranges and already-compressed types.
+COMPRESSION_MIN_BYTES = int(os.environ.get('COMPRESSION_MIN_BYTES', '1024'))
+COMPRESSION_BROTLI_QUALITY = int(os.environ.get('COMPRESSION_BROTLI_QUALITY', '4'))
+COMPRESSION_GZIP_LEVEL = int(os.environ.get('COMPRESSION_GZIP_LEVEL', '6'))
+COMPRESSION_THREAD_BYTES = 256 * 1024  # Larger bodies compress off the event loop
+COMPRESSIBLE_TYPES = ("application/json", "application/msgpack", "image/svg+xml", "text/")
+
+def choose_content_encoding(accept_encoding: str) -> Optional[str]:
+    offered = {}
+    for part in accept_encoding.lower().split(","):
+        name, _, params = part.partition(";")
+        quality = params.strip()[2:] if params.strip().startswith("q=") else "1"
+        try:
+            offered[name.strip()] = float(quality)
+        except ValueError:
+            continue
+    return next((encoding for encoding in ("br", "gzip") if offered.get(encoding, 0) > 0), None)
+
+def compress_body(body: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return brotli.compress(body, quality=COMPRESSION_BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=COMPRESSION_GZIP_LEVEL)
+
+class CompressionMiddleware:
+    def __init__(self, app, minimum_size: int = COMPRESSION_MIN_BYTES):
+        self.app = app
+        self.minimum_size = minimum_size
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        
+        accept_encoding = next((value.decode() for key, value in scope["headers"] if key == b"accept-encoding"), "")
+        encoding = choose_content_encoding(accept_encoding)
+        if encoding is None:
+            return await self.app(scope, receive, send)
+        
+        start = None
+        
+        async def send_compressed(message):
+            nonlocal start
+            if message["type"] == "http.response.start":
+                start = message
+                return
+            if start is None:
+                # Already decided: pass the rest of the body through
+                return await send(message)
+            
+            response_start, start = start, None
+            headers = MutableHeaders(raw=response_start["headers"])
+            body = message.get("body", b"")
+            content_type = headers.get("content-type", "")
+            if (
+                message.get("more_body") or len(body) < self.minimum_size or response_start["status"] == 206
+                or "content-encoding" in headers or not content_type.startswith(COMPRESSIBLE_TYPES)
+            ):
+                await send(response_start)
+                return await send(message)
+            
+            if len(body) > COMPRESSION_THREAD_BYTES:
+                body = await asyncio.to_thread(compress_body, body, encoding)
+            else:
+                body = compress_body(body, encoding)
+            headers["Content-Encoding"] = encoding
+            headers["Content-Length"] = str(len(body))
+            headers.add_vary_header("Accept-Encoding")
+            await send(response_start)
+            await send({"type": "http.response.body", "body": body})
+        
+        await self.app(scope, receive, send_compressed)
+
+# Append-only history of every mutation: one event per document created,
+# updated or deleted, keyed by entity (the collection) and entity_id.
+# record_event writes the event in the request that made the change, right
+# after the state write, so every acknowledged write is in the log (bulk
+# writes log theirs with one insert_many through record_events). Derived
+# collections (location
+# occupancy counters, sales_cube, operator_shift_stats) are not logged; they
+# are rebuilt from the replayed documents.
+EVENT_MAX_LIMIT = 1000
+EVENT_KEYS = {
+    # entity -> key fields; the first is the event's entity_id
+    "users": ("user_id",),
+    "farmers": ("farmer_id",),
+    "batches": ("batch_id",),
+    "processing_stages": ("stage_id",),
+    "inventory": ("inventory_id",),
+    "storage_locations": ("location",),
+    "dispatches": ("dispatch_id",),
+    "lots": ("lot_id",),
+    "lineage": ("to_id", "from_id"),
+    "payments": ("payment_id",),
+    "grade_prices": ("size_grade",),
+}
+
+def event_doc(entity: str, action: str, entity_id: str, data: Optional[dict] = None, actor: Optional[dict] = None) -> dict:
+    # data: the whole document for "created", the fields set for "updated",
+    # nothing for "deleted". Copied, since callers keep using their dicts.
+    return {
+        "entity": entity,
+        "entity_id": entity_id,
+        "action": action,
+        "data": {field: value for field, value in data.items() if field != "_id"} if data else None,
+        "actor": actor["user_id"] if actor else None,
+        "at": datetime.now(timezone.utc)
+    }
+
+async def record_event(entity: str, action: str, entity_id: str, data: Optional[dict] = None, actor: Optional[dict] = None):
+    await db.events.insert_one(event_doc(entity, action, entity_id, data, actor))
+
+async def record_events(events: List[dict]):
+    # One round trip for a bulk write's events. Ordered, so their ObjectIds
+    # break ties between events recorded in the same millisecond.
+    if events:
+        await db.events.insert_many(events)
+
+def replay_operation(event: dict):
+    keys = EVENT_KEYS[event["entity"]]
+    if event["action"] == "created":
+        return ReplaceOne({key: event["data"][key] for key in keys}, event["data"], upsert=True)
+    if event["action"] == "updated":
+        # No upsert: a partial $set must not create a half-formed document
+        # (replay_events reports updates whose document does not exist)
+        return UpdateOne({keys[0]: event["entity_id"]}, {"$set": event["data"]})
+    # "deleted", or "archived": moved to an archive file, gone from the hot tier
+    return DeleteOne({keys[0]: event["entity_id"]})
+
+async def replay_events(target, until: Optional[datetime] = None) -> tuple:
+    # Applies the log, oldest first, to another database (e.g. a fresh one).
+    # Documents only depend on earlier events for the same entity, so each
+    # collection is written in order on its own, 1000 operations at a time.
+    # Returns the events applied per entity and the orphaned "updated" events:
+    # those for a document neither created earlier in the log nor already in
+    # target, e.g. when its "created" event was lost.
+    query = {"at": {"$lte": until}} if until else {}
+    pending = defaultdict(list)
+    applied = defaultdict(int)
+    created = defaultdict(set)
+    unseen_updates = defaultdict(list)
+    orphans = []
+    
+    async def apply(entity: str):
+        if unseen_updates[entity]:
+            # Checked before the chunk is applied: target as it was when the
+            # chunk's first event happened
+            key = EVENT_KEYS[entity][0]
+            ids = list({event["entity_id"] for event in unseen_updates[entity]})
+            existing = set(await target[entity].distinct(key, {key: {"$in": ids}}))
+            orphans.extend(event for event in unseen_updates[entity] if event["entity_id"] not in existing)
+            unseen_updates[entity].clear()
+        await target[entity].bulk_write(pending[entity])
+        applied[entity] += len(pending[entity])
+        pending[entity].clear()
+    
+    async for event in db.events.find(query).sort([("at", 1), ("_id", 1)]):
+        entity = event["entity"]
+        if event["action"] == "created":
+            created[entity].add(event["entity_id"])
+        elif event["action"] == "updated" and event["entity_id"] not in created[entity]:
+            unseen_updates[entity].append(event)
+        pending[entity].append(replay_operation(event))
+        if len(pending[entity]) >= 1000:
+            await apply(entity)
+    for entity, operations in pending.items():
+        if operations:
+            await apply(entity)
+    
+    for event in orphans:
+        logger.warning(f"Orphaned event {event['_id']}: {event['entity']} {event['entity_id']} updated "
+                       f"at {event['at'].isoformat()} but never created; not replayed")
+    return dict(applied), orphans
+
+async def backfill_event_log():
+    # Documents written before the log existed get one "created" event each,
+    # so a replay starts from them. Archived rows stay in their archive files.
+    if await db.counters.find_one({"_id": "events:baseline"}):
+        return
+    if not await acquire_lease("event-log-baseline", 3600):
+        return
+    try:
+        total = 0
+        for entity, keys in EVENT_KEYS.items():
+            events = []
+            async for doc in db[entity].find({}, {"_id": 0}):
+                events.append(event_doc(entity, "created", doc[keys[0]], doc))
+                if len(events) >= 1000:
+                    await record_events(events)
+                    total, events = total + len(events), []
+            await record_events(events)
+            total += len(events)
+        await db.counters.insert_one({"_id": "events:baseline", "events": total, "at": datetime.now(timezone.utc)})
+        logger.info(f"Event log baseline: {total} existing documents")
+    except Exception:
+        logger.exception("Event log baseline failed")
+
+async def reserve_location_capacity(location: str, quantity: float):
+    # Make sure the counter document exists, then increment it only if the
+    # new stock still fits. The check and the increment happen in one atomic
+    # update, so concurrent intakes cannot overfill a cold room.
+    now = datetime.now(timezone.utc)
+    await db.storage_locations.update_one(
+        {"location": location},
+        {"$setOnInsert": {
+            "location": location,
+            "capacity_kg": None,
+            "occupied_kg": 0.0,
+            "item_count": 0,
+            "updated_at": now
+        }},
+        upsert=True
+    )
+    
+    result = await db.storage_locations.update_one(
+        {
+            "location": location,
+            "$or": [
+                {"capacity_kg": None},
+                {"$expr": {"$lte": [{"$add": ["$occupied_kg", quantity]}, "$capacity_kg"]}}
+            ]
+        },
+        {
+            "$inc": {"occupied_kg": quantity, "item_count": 1},
+            "$set": {"updated_at": now}
+        }
+    )
+    
+    if result.matched_count == 0:
+        raise HTTPException(status_code=409, detail=f"Location {location} does not have capacity for {quantity} kg")
+
+async def release_location_capacity(location: str, quantity: float, items: int = 1):
+    await db.storage_locations.update_one(
+        {"location": location},
+        {
+            "$inc": {"occupied_kg": -quantity, "item_count": -items},
+            "$set": {"updated_at": datetime.now(timezone.utc)}
+        }
+    )
+
+OCCUPANCY_TOLERANCE_KG = 1e-6
+
+async def reconcile_location_occupancy() -> List[dict]:
+    # Recompute every counter from the STORED inventory rows and return
+    # the locations whose counters had drifted.
+    now = datetime.now(timezone.utc)
+    # Counters are read before the rows: a store or dispatch in between moves
+    # its counter off the snapshot, and the update below then skips it
+    counters = {
+        c["location"]: c
+        for c in await db.storage_locations.find({}, {"_id": 0}).to_list(None)
+    }
+    actual = {
+        row["_id"]: row
+        for row in await db.inventory.aggregate([
+            {"$match": {"status": "STORED"}},
+            {"$group": {"_id": "$location", "occupied_kg": {"$sum": "$quantity"}, "item_count": {"$sum": 1}}}
+        ]).to_list(None)
+    }
+    
+    drift = []
+    operations = []
+    for location in set(actual) | set(counters):
+        occupied_kg = actual.get(location, {}).get("occupied_kg", 0.0)
+        item_count = actual.get(location, {}).get("item_count", 0)
+        counter = counters.get(location, {})
+        
+        # The counter is a running float sum, so it differs from the
+        # aggregate in the last bits; only real drift is rewritten
+        if (counter.get("item_count") == item_count and counter.get("occupied_kg") is not None
+                and abs(counter["occupied_kg"] - occupied_kg) <= OCCUPANCY_TOLERANCE_KG):
+            continue
+        
+        drift.append({
+            "location": location,
+            "counted_kg": counter.get("occupied_kg", 0.0),
+            "actual_kg": occupied_kg,
+            "counted_items": counter.get("item_count", 0),
+            "actual_items": item_count
+        })
+        corrected = {"occupied_kg": occupied_kg, "item_count": item_count, "updated_at": now}
+        if counter:
+            operations.append(UpdateOne(
+                {"location": location, "occupied_kg": counter.get("occupied_kg"), "item_count": counter.get("item_count")},
+                {"$set": corrected}
+            ))
+        else:
+            operations.append(UpdateOne(
+                {"location": location},
+                {"$setOnInsert": {**corrected, "capacity_kg": None}},
+                upsert=True
+            ))
+    
+    if operations:
+        try:
+            result = await db.storage_locations.bulk_write(operations, ordered=False)
+            reconciled = result.modified_count + result.upserted_count
+        except BulkWriteError as e:
+            # A location first stored to meanwhile has its counter already
+            if any(error["code"] != 11000 for error in e.details["writeErrors"]):
+                raise
+            reconciled = e.details["nModified"] + len(e.details["upserted"])
+        logger.warning(f"Reconciled occupancy for {reconciled} storage location(s)")
     
-    import base64
-    img_str = base64.b64encode(buffer.getvalue()).decode()
-    return f"data:image/png;base64,{img_str}"
+    return drift
+
+async def run_location_reconciliation(interval_seconds: int):
+    # Runs once at startup (seeding counters for pre-existing stock) and
+    # then on every interval
+    while True:
+        try:
+            await reconcile_location_occupancy()
+        except Exception:
+            logger.exception("Storage location reconciliation failed")
+        await asyncio.sleep(interval_seconds)
+
+LINEAGE_NODE_PREFIXES = {"BATCH": "batch", "lot_": "lot", "inv_": "inventory", "disp_": "dispatch"}
+
+def lineage_node_type(node_id: str) -> Optional[str]:
+    return next((t for prefix, t in LINEAGE_NODE_PREFIXES.items() if node_id.startswith(prefix)), None)
+
+async def record_lineage(edges: List[tuple], actor: Optional[dict] = None):
+    # Genealogy edges (parent_id, child_id, weight_kg). Upserts on the unique
+    # (from_id, to_id) index, so recording the same movement twice is a no-op.
+    now = datetime.now(timezone.utc)
+    docs = [
+        {
+            "from_id": parent_id,
+            "to_id": child_id,
+            "from_type": lineage_node_type(parent_id),
+            "to_type": lineage_node_type(child_id),
+            "weight_kg": weight_kg,
+            "created_at": now
+        }
+        for parent_id, child_id, weight_kg in edges
+    ]
+    result = await db.lineage.bulk_write([
+        UpdateOne({"from_id": doc["from_id"], "to_id": doc["to_id"]}, {"$setOnInsert": doc}, upsert=True)
+        for doc in docs
+    ], ordered=False)
+    await record_events([event_doc("lineage", "created", docs[index]["to_id"], docs[index], actor) for index in result.upserted_ids])
+
+def farmer_search_fields(name: str, contact: str) -> dict:
+    # Normalised copies used by /search: lowercase name words for indexed
+    # word-prefix matching, and the phone number reduced to digits
+    return {
+        "name_tokens": name.lower().split(),
+        "contact_digits": re.sub(r"\D", "", contact)
+    }
+
+async def find_replayed_document(collection, idempotency_key: Optional[str]) -> Optional[dict]:
+    if not idempotency_key:
+        return None
+    return await collection.find_one({"client_request_id": idempotency_key}, {"_id": 0})
 
 async def get_current_user(request: Request) -> dict:
     # Check session_token from cookie first, then Authorization header
@@ -230,15 +1389,40 @@ async def get_current_user(request: Request) -> dict:
     
     return user_doc
 
+# ============ Health Routes ============
+
+@api_router.get("/health")
+async def health_check():
+    await db.command("ping")
+    
+    # "degraded": serving, but a uniqueness guarantee (one payment per batch,
+    # one batch per ID) is not enforced until its duplicates are resolved
+    if missing_unique_indexes:
+        return {"status": "degraded", "pid": os.getpid(), "missing_unique_indexes": missing_unique_indexes}
+    return {"status": "ok", "pid": os.getpid()}
+
+@api_router.get("/ready")
+async def readiness_check(response: Response, warm: bool = False):
+    # "serving" as soon as startup is done; "warm" once the QR, Excel, NumPy
+    # and HTTP modules are loaded. With ?warm=true a cold worker answers 503,
+    # for load balancers that should only route to warmed workers.
+    if warm and not warmup_state["warmed"]:
+        response.status_code = 503
+    
+    return {
+        "status": "warm" if warmup_state["warmed"] else "serving",
+        "pid": os.getpid(),
+        "modules": {name: name in sys.modules for name in HEAVY_MODULES},
+        "warmup_ms": warmup_state["steps_ms"]
+    }
+
 # ============ Auth Routes ============
 
 @api_router.post("/auth/session", response_model=SessionResponse)
 async def create_session(session_data: SessionCreate, response: Response):
     # REMINDER: DO NOT HARDCODE THE URL, OR ADD ANY FALLBACKS OR REDIRECT URLS, THIS BREAKS THE AUTH
     # Call Emergent Auth API
-    import requests
-    
-    auth_response = requests.get(
+    auth_response = await auth_http_client().get(
         "https://demobackend.emergentagent.com/auth/v1/env/oauth/session-data",
         headers={"X-Session-ID": session_data.session_id}
     )
@@ -257,24 +1441,22 @@ async def create_session(session_data: SessionCreate, response: Response):
     if existing_user:
         user_id = existing_user["user_id"]
         # Update user data
-        await db.users.update_one(
-            {"user_id": user_id},
-            {"$set": {
-                "name": auth_data["name"],
-                "picture": auth_data.get("picture")
-            }}
-        )
+        profile = {"name": auth_data["name"], "picture": auth_data.get("picture")}
+        await db.users.update_one({"user_id": user_id}, {"$set": profile})
+        await record_event("users", "updated", user_id, profile, existing_user)
     else:
         # Create new user with default role
         user_id = f"user_{uuid.uuid4().hex[:12]}"
-        await db.users.insert_one({
+        user_doc = {
             "user_id": user_id,
             "email": auth_data["email"],
             "name": auth_data["name"],
             "picture": auth_data.get("picture"),
             "role": "staff",  # Default role
             "created_at": datetime.now(timezone.utc)
-        })
+        }
+        await db.users.insert_one(user_doc)
+        await record_event("users", "created", user_id, user_doc, user_doc)
     
     # Create session
     session_token = auth_data["session_token"]
@@ -347,11 +1529,12 @@ async def invite_user(data: dict, user: dict = Depends(get_current_user)):
             {"email": email},
             {"$set": {"role": role}}
         )
+        await record_event("users", "updated", existing_user["user_id"], {"role": role}, user)
         return {"message": "User role updated", "user_id": existing_user["user_id"]}
     
     # Create invited user record
     user_id = f"user_{uuid.uuid4().hex[:12]}"
-    await db.users.insert_one({
+    invited_doc = {
         "user_id": user_id,
         "email": email,
         "name": email.split("@")[0],  # Temporary name
@@ -359,7 +1542,9 @@ async def invite_user(data: dict, user: dict = Depends(get_current_user)):
         "role": role,
         "invited": True,
         "created_at": datetime.now(timezone.utc)
-    })
+    }
+    await db.users.insert_one(invited_doc)
+    await record_event("users", "created", user_id, invited_doc, user)
     
     return {"message": "User invited successfully", "user_id": user_id}
 
@@ -392,6 +1577,7 @@ async def update_user_role(user_id: str, data: dict, user: dict = Depends(get_cu
     
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="User not found")
+    await record_event("users", "updated", user_id, {"role": role}, user)
     
     return {"message": "Role updated successfully"}
 
@@ -408,6 +1594,7 @@ async def delete_user(user_id: str, user: dict = Depends(get_current_user)):
     
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="User not found")
+    await record_event("users", "deleted", user_id, actor=user)
     
     return {"message": "User deleted successfully"}
 
@@ -426,19 +1613,21 @@ async def link_farmer_to_user(
         raise HTTPException(status_code=400, detail="user_id and farmer_id required")
     
     # Update farmer with user_id
-    farmer_result = await db.farmers.update_one(
-        {"farmer_id": farmer_id},
-        {"$set": {"user_id": user_id}}
-    )
+    link = {"user_id": user_id, "updated_at": datetime.now(timezone.utc)}
+    farmer_result = await db.farmers.update_one({"farmer_id": farmer_id}, {"$set": link})
     
     if farmer_result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Farmer not found")
+    await record_event("farmers", "updated", farmer_id, link, user)
+    response_cache.invalidate("farmers")
     
     # Update user role to farmer
-    await db.users.update_one(
+    role_result = await db.users.update_one(
         {"user_id": user_id},
         {"$set": {"role": "farmer"}}
     )
+    if role_result.matched_count:
+        await record_event("users", "updated", user_id, {"role": "farmer"}, user)
     
     return {"message": "Farmer linked to user successfully"}
 
@@ -453,15 +1642,18 @@ async def create_farmer(farmer: FarmerCreate, user: dict = Depends(get_current_u
         "name": farmer.name,
         "contact": farmer.contact,
         "address": farmer.address,
-        "created_at": datetime.now(timezone.utc)
+        "created_at": datetime.now(timezone.utc),
+        "updated_at": datetime.now(timezone.utc),
+        **farmer_search_fields(farmer.name, farmer.contact)
     }
     
     await db.farmers.insert_one(farmer_doc)
+    await record_event("farmers", "created", farmer_id, farmer_doc, user)
+    response_cache.invalidate("farmers")
     
     return Farmer(**farmer_doc)
 
-@api_router.get("/farmers", response_model=List[Farmer])
-async def get_farmers(user: dict = Depends(get_current_user)):
+async def load_farmers() -> List[dict]:
     farmers = await db.farmers.find({}, {"_id": 0}).to_list(1000)
     
     for farmer in farmers:
@@ -470,6 +1662,10 @@ async def get_farmers(user: dict = Depends(get_current_user)):
     
     return farmers
 
+@api_router.get("/farmers", response_model=List[Farmer])
+async def get_farmers(user: dict = Depends(get_current_user)):
+    return await response_cache.get_or_compute(("GET /farmers", user["role"]), {"farmers"}, load_farmers)
+
 @api_router.get("/farmers/me/stats")
 async def get_farmer_stats(user: dict = Depends(get_current_user)):
     if user["role"] != "farmer":
@@ -486,11 +1682,11 @@ async def get_farmer_stats(user: dict = Depends(get_current_user)):
         }
     
     # Get batches for this farmer
-    batches = await db.batches.find({"farmer_id": farmer["farmer_id"]}, {"_id": 0}).to_list(1000)
+    batches = await find_with_archive("batches", {"farmer_id": farmer["farmer_id"]}, columns=["weight_kg"])
     total_prawns = sum(b["weight_kg"] for b in batches)
     
     # Get payments
-    payments = await db.payments.find({"farmer_id": farmer["farmer_id"]}, {"_id": 0}).to_list(1000)
+    payments = await find_with_archive("payments", {"farmer_id": farmer["farmer_id"]})
     total_paid = sum(p["net_amount"] for p in payments if p["payment_status"] == "paid")
     pending_payments = sum(p["net_amount"] for p in payments if p["payment_status"] == "pending")
     
@@ -504,40 +1700,75 @@ async def get_farmer_stats(user: dict = Depends(get_current_user)):
 
 # ============ Batch Routes ============
 
-@api_router.post("/batches", response_model=Batch)
-async def create_batch(batch: BatchCreate, user: dict = Depends(get_current_user)):
-    batch_id = f"BATCH{datetime.now().strftime('%Y%m%d')}{uuid.uuid4().hex[:6].upper()}"
-    
-    # Generate QR code
-    qr_data = {
-        "batch_id": batch_id,
-        "farmer_id": batch.farmer_id,
-        "weight_kg": batch.weight_kg,
-        "size_grade": batch.size_grade,
-        "intake_date": datetime.now(timezone.utc).isoformat()
-    }
-    qr_code = generate_qr_code(qr_data)
+async def set_batch_status(batch_id: str, status: str, actor: dict):
+    change = {"status": status, "updated_at": datetime.now(timezone.utc)}
+    result = await db.batches.update_one({"batch_id": batch_id}, {"$set": change})
+    if result.matched_count:
+        await record_event("batches", "updated", batch_id, change, actor)
+
+def build_batch_doc(batch_id: str, farmer_id: str, weight_kg: float, size_grade: str, location: str) -> dict:
+    # Shared by manual intake and the weighbridge ingestion service
+    intake_date = datetime.now(timezone.utc)
+    qr_code = generate_qr_code(encode_batch_qr(batch_id))
     
-    batch_doc = {
+    return {
         "batch_id": batch_id,
-        "farmer_id": batch.farmer_id,
-        "weight_kg": batch.weight_kg,
-        "size_grade": batch.size_grade,
-        "intake_date": datetime.now(timezone.utc),
-        "intake_time": datetime.now(timezone.utc).strftime("%H:%M:%S"),
-        "location": batch.location,
+        "farmer_id": farmer_id,
+        "weight_kg": weight_kg,
+        "size_grade": size_grade,
+        "intake_date": intake_date,
+        "intake_time": intake_date.strftime("%H:%M:%S"),
+        "location": location,
         "status": "RECEIVED",
         "qr_code": qr_code,
-        "created_at": datetime.now(timezone.utc)
+        "created_at": datetime.now(timezone.utc),
+        "updated_at": datetime.now(timezone.utc)
     }
+
+@api_router.post("/batches", response_model=Batch)
+async def create_batch(
+    batch: BatchCreate,
+    user: dict = Depends(get_current_user),
+    idempotency_key: Optional[str] = Header(None)
+):
+    return await insert_batch(batch, user, idempotency_key)
+
+async def insert_batch(batch: BatchCreate, user: dict, idempotency_key: Optional[str] = None,
+                       reserved_ids: Optional[deque] = None) -> Batch:
+    # reserved_ids: allocated up front for a whole sync upload. Replayed
+    # operations leave theirs unused, a gap in the sequence.
+    # Replayed offline intake: return the batch created the first time
+    existing = await find_replayed_document(db.batches, idempotency_key)
+    if existing:
+        return Batch(**existing)
     
-    await db.batches.insert_one(batch_doc)
+    # The unique index on batch_id is the backstop; a collision (e.g. with an
+    # id issued before the allocator existed) just takes the next id
+    for attempt in range(3):
+        batch_id = reserved_ids.popleft() if reserved_ids else (await batch_id_allocator.allocate())[0]
+        
+        batch_doc = build_batch_doc(batch_id, batch.farmer_id, batch.weight_kg, batch.size_grade, batch.location)
+        if idempotency_key:
+            batch_doc["client_request_id"] = idempotency_key
+        
+        try:
+            await db.batches.insert_one(batch_doc)
+            break
+        except DuplicateKeyError as e:
+            if "batch_id" in (e.details or {}).get("keyPattern", {}) and attempt < 2:
+                continue
+            # Lost a race with a concurrent replay of the same intake
+            existing = await find_replayed_document(db.batches, idempotency_key)
+            if not existing:
+                raise
+            return Batch(**existing)
+    await record_event("batches", "created", batch_doc["batch_id"], batch_doc, user)
+    response_cache.invalidate("batches")
     
     return Batch(**batch_doc)
 
-@api_router.get("/batches", response_model=List[Batch])
-async def get_batches(user: dict = Depends(get_current_user)):
-    batches = await db.batches.find({}, {"_id": 0}).sort("created_at", -1).to_list(1000)
+async def load_batches(projection: Optional[dict] = None) -> List[dict]:
+    batches = await db.batches.find({}, projection or {"_id": 0}).sort("created_at", -1).to_list(1000)
     
     for batch in batches:
         if isinstance(batch.get('intake_date'), str):
@@ -547,9 +1778,26 @@ async def get_batches(user: dict = Depends(get_current_user)):
     
     return batches
 
+@api_router.get("/batches", response_model=List[Batch])
+async def get_batches(
+    request: Request,
+    response: Response,
+    expand: Optional[str] = None,
+    fields: Optional[str] = None,
+    user: dict = Depends(get_current_user)
+):
+    tree = parse_expand(expand, {"farmer"})
+    projection = parse_fields(fields, Batch, "batch_id", tree)
+    batches = await cached_list("GET /batches", user, {"batches"}, load_batches, tree, projection)
+    return list_response(request, response, batches, Batch, partial=projection is not None)
+
 @api_router.get("/batches/{batch_id}", response_model=Batch)
 async def get_batch(batch_id: str, user: dict = Depends(get_current_user)):
     batch = await db.batches.find_one({"batch_id": batch_id}, {"_id": 0})
+    if not batch:
+        # Moved to the cold tier, e.g. a label scanned months later
+        archived = await find_archived("batches", {"batch_id": [batch_id]})
+        batch = archived[0] if archived else None
     
     if not batch:
         raise HTTPException(status_code=404, detail="Batch not found")
@@ -561,10 +1809,211 @@ async def get_batch(batch_id: str, user: dict = Depends(get_current_user)):
     
     return Batch(**batch)
 
+@api_router.get("/batches/{batch_id}/qr")
+async def get_batch_qr(
+    batch_id: str,
+    format: str = "svg",
+    error_correction: Optional[str] = None,
+    user: dict = Depends(get_current_user)
+):
+    if format not in QR_IMAGE_FORMATS:
+        raise HTTPException(status_code=400, detail=f"format must be one of {', '.join(QR_IMAGE_FORMATS)}")
+    if not await db.batches.find_one({"batch_id": batch_id}, {"_id": 1}):
+        raise HTTPException(status_code=404, detail="Batch not found")
+    
+    try:
+        image = await asyncio.to_thread(render_qr_image, encode_batch_qr(batch_id), format, error_correction)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return Response(
+        content=image,
+        media_type=QR_IMAGE_FORMATS[format],
+        headers={"Cache-Control": "private, max-age=86400"}
+    )
+
+@api_router.get("/qr/resolve", response_model=Batch)
+async def resolve_qr(code: str, user: dict = Depends(get_current_user)):
+    # What the scanner page calls with the decoded text
+    try:
+        batch_id = decode_batch_qr(code)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return await get_batch(batch_id, user)
+
+# ============ Label Routes ============
+
+# Printable A4 sheets of 63.5 x 38.1 mm labels (the common 21-up layout):
+# QR code, batch ID, grade, weight and intake date. The QR codes are encoded
+# in a process pool (qrcode is pure Python, so threads would queue on the
+# GIL) and kept in an LRU keyed by batch_id and error correction level, so
+# reprinting a shift's labels only lays out the pages. Pages are 1-bit, which the PDF stores losslessly.
+LABEL_DPI = 300
+LABEL_PAGE_PX = (2480, 3508)  # A4 at 300 dpi
+LABEL_GRID = (3, 7)  # columns, rows
+LABEL_SIZE_PX = (750, 450)  # 63.5 x 38.1 mm at 300 dpi
+LABEL_PADDING_PX = 30
+LABEL_MAX = 2000
+LABEL_CACHE_SIZE = int(os.environ.get('LABEL_CACHE_SIZE', '5000'))
+LABEL_RENDER_WORKERS = int(os.environ.get('LABEL_RENDER_WORKERS', str(min(4, os.cpu_count() or 1))))
+
+label_qr_cache: "OrderedDict[tuple, bytes]" = OrderedDict()  # (batch_id, level) -> modules PNG
+_label_render_pool = None
+
+def label_render_pool() -> ProcessPoolExecutor:
+    # Spawned, not forked: the workers only need this module, not a copy of a
+    # process with open Mongo connections and an event loop
+    global _label_render_pool
+    if _label_render_pool is None:
+        _label_render_pool = ProcessPoolExecutor(
+            max_workers=LABEL_RENDER_WORKERS, mp_context=multiprocessing.get_context("spawn")
+        )
+    return _label_render_pool
+
+def render_qr_modules(payloads: List[str], error_correction: str) -> List[bytes]:
+    # Runs in the pool. One pixel per module; the page layout scales it up.
+    return [render_qr_image(payload, error_correction=error_correction, box_size=1, border=0) for payload in payloads]
+
+async def label_qr_images(batches: List[dict], error_correction: str) -> Dict[str, bytes]:
+    images, missing = {}, []
+    for batch in batches:
+        key = (batch["batch_id"], error_correction)
+        if key in label_qr_cache:
+            label_qr_cache.move_to_end(key)
+            images[batch["batch_id"]] = label_qr_cache[key]
+        else:
+            missing.append(batch["batch_id"])
+    if not missing:
+        return images
+    
+    # A few codes per task, so inter-process overhead doesn't dominate
+    size = max(1, min(50, math.ceil(len(missing) / LABEL_RENDER_WORKERS)))
+    chunks = [missing[start:start + size] for start in range(0, len(missing), size)]
+    loop = asyncio.get_running_loop()
+    rendered = await asyncio.gather(*(
+        loop.run_in_executor(
+            label_render_pool(), render_qr_modules, [encode_batch_qr(batch_id) for batch_id in chunk], error_correction
+        )
+        for chunk in chunks
+    ))
+    for chunk, chunk_images in zip(chunks, rendered):
+        for batch_id, image in zip(chunk, chunk_images):
+            label_qr_cache[(batch_id, error_correction)] = image
+            images[batch_id] = image
+    while len(label_qr_cache) > LABEL_CACHE_SIZE:
+        label_qr_cache.popitem(last=False)
+    return images
+
+@lru_cache(maxsize=None)
+def label_font(size: int):
+    from PIL import ImageFont
+    return ImageFont.load_default(size=size)
+
+def render_label_page(labels: List[tuple]) -> bytes:
+    # Runs in the pool. labels: (batch_id, size_grade, weight_kg, intake
+    # date text, QR modules PNG). Returns the 1-bit page as raw bytes.
+    from PIL import Image, ImageDraw
+    
+    columns, _ = LABEL_GRID
+    label_width, label_height = LABEL_SIZE_PX
+    left = (LABEL_PAGE_PX[0] - columns * label_width) // 2
+    top = (LABEL_PAGE_PX[1] - LABEL_GRID[1] * label_height) // 2
+    pad = LABEL_PADDING_PX
+    
+    page = Image.new("1", LABEL_PAGE_PX, 1)
+    draw = ImageDraw.Draw(page)
+    for slot, (batch_id, size_grade, weight_kg, intake, qr_png) in enumerate(labels):
+        x = left + (slot % columns) * label_width
+        y = top + (slot // columns) * label_height
+        
+        modules = Image.open(BytesIO(qr_png))
+        scale = (label_height - 2 * pad) // modules.size[0]
+        code = modules.resize((modules.size[0] * scale, modules.size[1] * scale), Image.NEAREST).convert("1")
+        page.paste(code, (x + pad, y + (label_height - code.size[1]) // 2))
+        
+        text_x = x + 2 * pad + code.size[0]
+        text_width = label_width - (text_x - x) - pad
+        text_y = y + pad
+        for text, size in ((batch_id, 36), (size_grade, 48), (f"{weight_kg:.1f} kg", 48), (intake, 30)):
+            # Shrink long values (batch IDs) until they fit beside the code
+            while size > 20 and draw.textlength(text, font=label_font(size)) > text_width:
+                size -= 4
+            draw.text((text_x, text_y), text, font=label_font(size), fill=0)
+            text_y += int(size * 1.5)
+    return page.tobytes()
+
+def labels_to_pdf(pages: List[bytes]) -> bytes:
+    from PIL import Image
+    
+    images = [Image.frombytes("1", LABEL_PAGE_PX, page) for page in pages]
+    buffer = BytesIO()
+    images[0].save(buffer, format="PDF", save_all=True, append_images=images[1:], resolution=LABEL_DPI)
+    return buffer.getvalue()
+
+async def render_label_pdf(batches: List[dict], error_correction: str = QR_ERROR_CORRECTION) -> bytes:
+    images = await label_qr_images(batches, error_correction)
+    labels = [
+        (batch["batch_id"], batch["size_grade"], batch["weight_kg"],
+         batch["intake_date"].strftime("%d %b %Y") if isinstance(batch.get("intake_date"), datetime) else "",
+         images[batch["batch_id"]])
+        for batch in batches
+    ]
+    per_page = LABEL_GRID[0] * LABEL_GRID[1]
+    loop = asyncio.get_running_loop()
+    pages = await asyncio.gather(*(
+        loop.run_in_executor(label_render_pool(), render_label_page, labels[first:first + per_page])
+        for first in range(0, len(labels), per_page)
+    ))
+    return await asyncio.to_thread(labels_to_pdf, pages)
+
+@api_router.get("/labels")
+async def get_labels(
+    batch_ids: Optional[str] = None,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    error_correction: Optional[str] = None,
+    user: dict = Depends(get_current_user)
+):
+    # batch_ids=BATCH...,BATCH... prints those in that order; otherwise every
+    # batch with intake_date in [start, end)
+    error_correction = (error_correction or QR_ERROR_CORRECTION).upper()
+    if error_correction not in QR_ERROR_LEVELS:
+        raise HTTPException(status_code=400, detail=f"error_correction must be one of {', '.join(QR_ERROR_LEVELS)}")
+    projection = {"_id": 0, "batch_id": 1, "farmer_id": 1, "weight_kg": 1, "size_grade": 1, "intake_date": 1}
+    if batch_ids:
+        requested = list(dict.fromkeys(b.strip() for b in batch_ids.split(",") if b.strip()))
+        if len(requested) > LABEL_MAX:
+            raise HTTPException(status_code=400, detail=f"At most {LABEL_MAX} labels per request")
+        found = {b["batch_id"]: b for b in await db.batches.find({"batch_id": {"$in": requested}}, projection).to_list(None)}
+        batches = [found[batch_id] for batch_id in requested if batch_id in found]
+    elif start or end:
+        date_range = {**({"$gte": start} if start else {}), **({"$lt": end} if end else {})}
+        batches = await db.batches.find({"intake_date": date_range}, projection).sort("intake_date", 1).to_list(LABEL_MAX + 1)
+        if len(batches) > LABEL_MAX:
+            raise HTTPException(status_code=400, detail=f"More than {LABEL_MAX} batches in range; narrow it")
+    else:
+        raise HTTPException(status_code=400, detail="Pass batch_ids or a start/end range")
+    if not batches:
+        raise HTTPException(status_code=404, detail="No batches found")
+    
+    pdf = await render_label_pdf(batches, error_correction)
+    return Response(
+        content=pdf,
+        media_type="application/pdf",
+        headers={"Content-Disposition": f'inline; filename="labels_{len(batches)}.pdf"'}
+    )
+
 # ============ Processing Routes ============
 
 @api_router.post("/processing", response_model=ProcessingStage)
-async def create_processing_stage(stage: ProcessingStageCreate, user: dict = Depends(get_current_user)):
+async def create_processing_stage(
+    stage: ProcessingStageCreate,
+    user: dict = Depends(get_current_user),
+    idempotency_key: Optional[str] = Header(None)
+):
+    existing = await find_replayed_document(db.processing_stages, idempotency_key)
+    if existing:
+        return ProcessingStage(**existing)
+    
     stage_id = f"stage_{uuid.uuid4().hex[:12]}"
     
     wastage = stage.input_weight - stage.output_weight
@@ -581,23 +2030,35 @@ async def create_processing_stage(stage: ProcessingStageCreate, user: dict = Dep
         "yield_percentage": yield_percentage,
         "status": "COMPLETED",
         "created_at": datetime.now(timezone.utc),
-        "completed_at": datetime.now(timezone.utc)
+        "started_at": stage.started_at,
+        "completed_at": datetime.now(timezone.utc),
+        "updated_at": datetime.now(timezone.utc)
     }
+    if idempotency_key:
+        stage_doc["client_request_id"] = idempotency_key
+    
+    try:
+        await db.processing_stages.insert_one(stage_doc)
+    except DuplicateKeyError:
+        existing = await find_replayed_document(db.processing_stages, idempotency_key)
+        if not existing:
+            raise
+        return ProcessingStage(**existing)
     
-    await db.processing_stages.insert_one(stage_doc)
+    await record_event("processing_stages", "created", stage_id, stage_doc, user)
+    await record_operator_stats(stage_doc)
     
     # Update batch status
     stages_count = await db.processing_stages.count_documents({"batch_id": stage.batch_id})
     if stages_count >= 4:  # All 4 stages completed
-        await db.batches.update_one(
-            {"batch_id": stage.batch_id},
-            {"$set": {"status": "PROCESSED"}}
-        )
+        await set_batch_status(stage.batch_id, "PROCESSED", user)
+    response_cache.invalidate("processing_stages", "batches")
     
     return ProcessingStage(**stage_doc)
 
 @api_router.get("/processing/batch/{batch_id}", response_model=List[ProcessingStage])
-async def get_processing_stages(batch_id: str, user: dict = Depends(get_current_user)):
+async def get_processing_stages(batch_id: str, expand: Optional[str] = None, user: dict = Depends(get_current_user)):
+    tree = parse_expand(expand, {"batch"})
     stages = await db.processing_stages.find({"batch_id": batch_id}, {"_id": 0}).to_list(1000)
     
     for stage in stages:
@@ -606,7 +2067,220 @@ async def get_processing_stages(batch_id: str, user: dict = Depends(get_current_
         if stage.get('completed_at') and isinstance(stage.get('completed_at'), str):
             stage['completed_at'] = datetime.fromisoformat(stage['completed_at'])
     
-    return stages
+    return await expand_references(stages, tree)
+
+# ============ Operator Productivity ============
+
+# Per-operator, per-shift totals in operator_shift_stats, one document per
+# (assigned_person, stage_name, shift), bumped with $inc as each stage is
+# recorded. A stage counts towards the shift it was completed in. Throughput
+# only counts stages that report started_at, since that's the only way to
+# know how long the work took.
+PLANT_TIMEZONE = ZoneInfo(os.environ.get('PLANT_TIMEZONE', 'UTC'))
+SHIFT_START_HOURS = sorted(int(hour) for hour in os.environ.get('SHIFT_START_HOURS', '6,14,22').split(','))
+SHIFT_NAMES = "ABCDEFGH"
+
+def shift_of(moment: datetime) -> dict:
+    local = moment.replace(tzinfo=moment.tzinfo or timezone.utc).astimezone(PLANT_TIMEZONE)
+    started = [i for i, hour in enumerate(SHIFT_START_HOURS) if hour <= local.hour]
+    if started:
+        index, day = started[-1], local.date()
+    else:
+        # Before the first shift of the day: still the previous night shift
+        index, day = len(SHIFT_START_HOURS) - 1, local.date() - timedelta(days=1)
+    start = datetime.combine(day, datetime.min.time(), tzinfo=PLANT_TIMEZONE).replace(hour=SHIFT_START_HOURS[index])
+    return {"shift_date": day.isoformat(), "shift": SHIFT_NAMES[index], "shift_start": start.astimezone(timezone.utc)}
+
+def operator_stat_increments(stage: dict) -> tuple:
+    # (key, counters) that one stage adds to its operator's shift
+    completed_at = stage["completed_at"]
+    shift = shift_of(completed_at)
+    key = {"assigned_person": stage["assigned_person"], "stage_name": stage["stage_name"],
+           "shift_start": shift["shift_start"]}
+    counters = {
+        "stages": 1,
+        "input_kg": stage["input_weight"],
+        "output_kg": stage["output_weight"],
+        "wastage_kg": stage["wastage"],
+        "timed_stages": 0,
+        "timed_input_kg": 0.0,
+        "work_seconds": 0.0
+    }
+    started_at = stage.get("started_at")
+    if started_at and to_naive_utc(started_at) < to_naive_utc(completed_at):
+        counters.update(
+            timed_stages=1,
+            timed_input_kg=stage["input_weight"],
+            work_seconds=(to_naive_utc(completed_at) - to_naive_utc(started_at)).total_seconds()
+        )
+    return {**key, "shift_date": shift["shift_date"], "shift": shift["shift"]}, counters
+
+def operator_stats_update(key: dict, counters: dict) -> UpdateOne:
+    return UpdateOne(
+        {field: key[field] for field in ("assigned_person", "stage_name", "shift_start")},
+        {
+            "$inc": counters,
+            "$setOnInsert": {"shift_date": key["shift_date"], "shift": key["shift"]},
+            "$max": {"updated_at": datetime.now(timezone.utc)}
+        },
+        upsert=True
+    )
+
+async def record_operator_stats(stage: dict):
+    await db.operator_shift_stats.bulk_write([operator_stats_update(*operator_stat_increments(stage))])
+
+async def record_operator_stats_many(stages: List[dict]):
+    # Stages of the same operator and shift are summed into one update
+    totals = {}
+    for stage in stages:
+        key, counters = operator_stat_increments(stage)
+        entry = totals.setdefault((key["assigned_person"], key["stage_name"], key["shift_start"]), (key, dict.fromkeys(counters, 0)))
+        for field, value in counters.items():
+            entry[1][field] += value
+    if totals:
+        await db.operator_shift_stats.bulk_write([operator_stats_update(*entry) for entry in totals.values()], ordered=False)
+
+async def rebuild_operator_stats(since: Optional[datetime] = None) -> int:
+    # Recomputes finished shifts from processing_stages. The current shift is
+    # left to the live $inc path, so the two never write the same document.
+    current_shift = shift_of(datetime.now(timezone.utc))["shift_start"]
+    query = {"completed_at": {"$lt": current_shift}}
+    if since:
+        query["completed_at"]["$gte"] = since
+    
+    totals = {}
+    async for stage in db.processing_stages.find(query, {"_id": 0, "assigned_person": 1, "stage_name": 1, "input_weight": 1,
+                                                          "output_weight": 1, "wastage": 1, "started_at": 1, "completed_at": 1}):
+        key, counters = operator_stat_increments(stage)
+        entry = totals.setdefault((key["assigned_person"], key["stage_name"], key["shift_start"]), {**key, **dict.fromkeys(counters, 0)})
+        for field, value in counters.items():
+            entry[field] += value
+    
+    now = datetime.now(timezone.utc)
+    operations = [
+        ReplaceOne({field: entry[field] for field in ("assigned_person", "stage_name", "shift_start")},
+                   {**entry, "updated_at": now}, upsert=True)
+        for entry in totals.values()
+    ]
+    for start in range(0, len(operations), 1000):
+        await db.operator_shift_stats.bulk_write(operations[start:start + 1000], ordered=False)
+    return len(operations)
+
+async def backfill_operator_stats():
+    # First start with rollups: derive them from existing stages in the
+    # background rather than holding up startup
+    if await db.operator_shift_stats.estimated_document_count():
+        return
+    if not await acquire_lease("operator-stats-backfill", 3600):
+        return
+    try:
+        shifts = await rebuild_operator_stats()
+        logger.info(f"Backfilled {shifts} operator shift rollups")
+    except Exception:
+        logger.exception("Operator rollup backfill failed")
+
+LEADERBOARD_METRICS = {
+    # metric -> sort direction (best first)
+    "throughput_kg_per_hour": -1,
+    "yield_percentage": -1,
+    "wastage_percentage": 1,
+    "input_kg": -1,
+}
+
+def plant_today() -> str:
+    return datetime.now(PLANT_TIMEZONE).date().isoformat()
+
+async def compute_leaderboard(start_date: str, end_date: str, shift: Optional[str], stage_name: Optional[str],
+                              metric: str, min_stages: int, limit: int) -> dict:
+    match = {"shift_date": {"$gte": start_date, "$lte": end_date}}
+    if shift:
+        match["shift"] = shift
+    if stage_name:
+        match["stage_name"] = stage_name
+    
+    rows = await analytics_db.operator_shift_stats.aggregate([
+        {"$match": match},
+        {"$group": {
+            "_id": "$assigned_person",
+            "shifts": {"$addToSet": "$shift_start"},
+            **{field: {"$sum": f"${field}"} for field in
+               ("stages", "input_kg", "output_kg", "wastage_kg", "timed_input_kg", "work_seconds")}
+        }},
+        {"$match": {"stages": {"$gte": min_stages}}},
+        {"$project": {
+            "_id": 0,
+            "assigned_person": "$_id",
+            "shifts": {"$size": "$shifts"},
+            "stages": 1,
+            "input_kg": {"$round": ["$input_kg", 2]},
+            "output_kg": {"$round": ["$output_kg", 2]},
+            "hours": {"$round": [{"$divide": ["$work_seconds", 3600]}, 2]},
+            "throughput_kg_per_hour": {"$cond": [
+                {"$gt": ["$work_seconds", 0]},
+                {"$round": [{"$divide": ["$timed_input_kg", {"$divide": ["$work_seconds", 3600]}]}, 2]},
+                None
+            ]},
+            "yield_percentage": {"$cond": [
+                {"$gt": ["$input_kg", 0]}, {"$round": [{"$multiply": [{"$divide": ["$output_kg", "$input_kg"]}, 100]}, 2]}, None
+            ]},
+            "wastage_percentage": {"$cond": [
+                {"$gt": ["$input_kg", 0]}, {"$round": [{"$multiply": [{"$divide": ["$wastage_kg", "$input_kg"]}, 100]}, 2]}, None
+            ]}
+        }},
+        # Operators without a value for the metric go last
+        {"$addFields": {"_ranked": {"$ne": [f"${metric}", None]}}},
+        {"$sort": {"_ranked": -1, metric: LEADERBOARD_METRICS[metric], "assigned_person": 1}},
+        {"$limit": limit},
+        {"$project": {"_ranked": 0}}
+    ]).to_list(None)
+    
+    for rank, row in enumerate(rows, start=1):
+        row["rank"] = rank
+    return {"start_date": start_date, "end_date": end_date, "shift": shift, "stage_name": stage_name,
+            "metric": metric, "operators": rows}
+
+@api_router.get("/analytics/operators/leaderboard")
+async def get_operator_leaderboard(
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    shift: Optional[str] = None,
+    stage_name: Optional[str] = None,
+    metric: str = "throughput_kg_per_hour",
+    min_stages: int = 1,
+    limit: int = 20,
+    user: dict = Depends(get_current_user)
+):
+    if metric not in LEADERBOARD_METRICS:
+        raise HTTPException(status_code=400, detail=f"metric must be one of {', '.join(LEADERBOARD_METRICS)}")
+    start_date = start_date or plant_today()
+    end_date = end_date or start_date
+    for value in (start_date, end_date):
+        try:
+            datetime.strptime(value, "%Y-%m-%d")
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Dates must look like 2026-02-18")
+    limit = max(1, min(limit, 200))
+    
+    return await response_cache.get_or_compute(
+        ("GET /analytics/operators/leaderboard", start_date, end_date, shift, stage_name, metric, min_stages, limit),
+        {"processing_stages"},
+        lambda: compute_leaderboard(start_date, end_date, shift, stage_name, metric, min_stages, limit)
+    )
+
+@api_router.get("/analytics/operators/{assigned_person}/shifts")
+async def get_operator_shifts(assigned_person: str, limit: int = 30, user: dict = Depends(get_current_user)):
+    return await analytics_db.operator_shift_stats.find(
+        {"assigned_person": assigned_person}, {"_id": 0}
+    ).sort("shift_start", -1).to_list(min(limit, 500))
+
+@api_router.post("/analytics/operators/rebuild")
+async def rebuild_operator_rollups(since: Optional[datetime] = None, user: dict = Depends(get_current_user)):
+    if user["role"] not in ["owner", "admin"]:
+        raise HTTPException(status_code=403, detail="Owner/Admin access required")
+    
+    shifts = await rebuild_operator_stats(since)
+    response_cache.invalidate("processing_stages")
+    return {"message": "Operator rollups rebuilt", "shifts": shifts}
 
 # ============ Inventory Routes ============
 
@@ -625,6 +2299,12 @@ async def create_inventory(inventory: InventoryCreate, user: dict = Depends(get_
     
     batch_age = (datetime.now(timezone.utc) - intake_date).days
     
+    if inventory.lot_id:
+        await load_lineage_source(inventory.lot_id)
+    
+    # Capacity check and occupancy update against the location counter
+    await reserve_location_capacity(inventory.location, inventory.quantity)
+    
     inventory_doc = {
         "inventory_id": inventory_id,
         "batch_id": inventory.batch_id,
@@ -632,21 +2312,25 @@ async def create_inventory(inventory: InventoryCreate, user: dict = Depends(get_
         "quantity": inventory.quantity,
         "batch_age": batch_age,
         "status": "STORED",
-        "created_at": datetime.now(timezone.utc)
+        "created_at": datetime.now(timezone.utc),
+        "updated_at": datetime.now(timezone.utc)
     }
     
-    await db.inventory.insert_one(inventory_doc)
+    try:
+        await db.inventory.insert_one(inventory_doc)
+    except Exception:
+        await release_location_capacity(inventory.location, inventory.quantity)
+        raise
+    await record_event("inventory", "created", inventory_id, inventory_doc, user)
+    await record_lineage([(inventory.lot_id or inventory.batch_id, inventory_id, inventory.quantity)], user)
     
     # Update batch status
-    await db.batches.update_one(
-        {"batch_id": inventory.batch_id},
-        {"$set": {"status": "STORED"}}
-    )
+    await set_batch_status(inventory.batch_id, "STORED", user)
+    response_cache.invalidate("inventory", "batches")
     
     return Inventory(**inventory_doc)
 
-@api_router.get("/inventory", response_model=List[Inventory])
-async def get_inventory(user: dict = Depends(get_current_user)):
+async def load_inventory() -> List[dict]:
     inventory = await db.inventory.find({}, {"_id": 0}).to_list(1000)
     
     for item in inventory:
@@ -655,12 +2339,84 @@ async def get_inventory(user: dict = Depends(get_current_user)):
     
     return inventory
 
+@api_router.get("/inventory", response_model=List[Inventory])
+async def get_inventory(expand: Optional[str] = None, user: dict = Depends(get_current_user)):
+    return await cached_list("GET /inventory", user, {"inventory"}, load_inventory, parse_expand(expand, {"batch"}))
+
+@api_router.get("/inventory/locations", response_model=List[StorageLocation])
+async def get_storage_locations(user: dict = Depends(get_current_user)):
+    locations = await db.storage_locations.find({}, {"_id": 0}).sort("location", 1).to_list(1000)
+    
+    for location in locations:
+        if isinstance(location.get('updated_at'), str):
+            location['updated_at'] = datetime.fromisoformat(location['updated_at'])
+    
+    return locations
+
+@api_router.put("/inventory/locations/{location}", response_model=StorageLocation)
+async def update_storage_location(location: str, data: StorageLocationUpdate, user: dict = Depends(get_current_user)):
+    if user["role"] not in ["owner", "admin"]:
+        raise HTTPException(status_code=403, detail="Owner/Admin access required")
+    
+    now = datetime.now(timezone.utc)
+    await db.storage_locations.update_one(
+        {"location": location},
+        {
+            "$set": {"capacity_kg": data.capacity_kg, "updated_at": now},
+            "$setOnInsert": {"location": location, "occupied_kg": 0.0, "item_count": 0}
+        },
+        upsert=True
+    )
+    await record_event("storage_locations", "updated", location, {"capacity_kg": data.capacity_kg, "updated_at": now}, user)
+    
+    location_doc = await db.storage_locations.find_one({"location": location}, {"_id": 0})
+    return StorageLocation(**location_doc)
+
+@api_router.post("/inventory/locations/reconcile")
+async def reconcile_storage_locations(user: dict = Depends(get_current_user)):
+    if user["role"] not in ["owner", "admin"]:
+        raise HTTPException(status_code=403, detail="Owner/Admin access required")
+    
+    drift = await reconcile_location_occupancy()
+    
+    return {"message": "Storage locations reconciled", "corrected": len(drift), "drift": drift}
+
 # ============ Dispatch Routes ============
 
 @api_router.post("/dispatch", response_model=Dispatch)
 async def create_dispatch(dispatch: DispatchCreate, user: dict = Depends(get_current_user)):
     dispatch_id = f"disp_{uuid.uuid4().hex[:12]}"
     
+    if dispatch.lot_ids:
+        known = await db.lots.count_documents({"lot_id": {"$in": dispatch.lot_ids}})
+        if known != len(set(dispatch.lot_ids)):
+            raise HTTPException(status_code=404, detail="Lot not found")
+    
+    batch = await db.batches.find_one({"batch_id": dispatch.batch_id}, {"_id": 0, "weight_kg": 1, "size_grade": 1}) or {}
+    
+    # Release the batch's stock from its cold room counters. Each row is
+    # claimed individually so a repeated dispatch cannot release it twice.
+    stored_items = await db.inventory.find(
+        {"batch_id": dispatch.batch_id, "status": "STORED"},
+        {"_id": 0, "inventory_id": 1}
+    ).to_list(1000)
+    edges = [(lot_id, dispatch_id, None) for lot_id in dispatch.lot_ids]
+    for item in stored_items:
+        now = datetime.now(timezone.utc)
+        claim = {"status": "DISPATCHED", "dispatched_at": now, "updated_at": now}
+        claimed = await db.inventory.find_one_and_update(
+            {"inventory_id": item["inventory_id"], "status": "STORED"},
+            {"$set": claim},
+            projection={"_id": 0, "location": 1, "quantity": 1}
+        )
+        if claimed:
+            await record_event("inventory", "updated", item["inventory_id"], claim, user)
+            await release_location_capacity(claimed["location"], claimed["quantity"])
+            edges.append((item["inventory_id"], dispatch_id, claimed["quantity"]))
+    
+    # The weight is known before the dispatch is written, so it is inserted
+    # whole: readers never see a dispatch without its weight
+    claimed_kg = sum(weight for _, _, weight in edges if weight)
     dispatch_doc = {
         "dispatch_id": dispatch_id,
         "batch_id": dispatch.batch_id,
@@ -668,23 +2424,28 @@ async def create_dispatch(dispatch: DispatchCreate, user: dict = Depends(get_cur
         "country": dispatch.country,
         "selling_price": dispatch.selling_price,
         "dispatch_date": dispatch.dispatch_date,
+        "weight_kg": round(claimed_kg or batch.get("weight_kg", 0.0), 2),
+        "size_grade": batch.get("size_grade"),
         "status": "SHIPPED",
-        "created_at": datetime.now(timezone.utc)
+        "created_at": datetime.now(timezone.utc),
+        "updated_at": datetime.now(timezone.utc)
     }
-    
     await db.dispatches.insert_one(dispatch_doc)
+    await record_event("dispatches", "created", dispatch_id, dispatch_doc, user)
+    
+    # Genealogy: shipped from the named lots and the claimed stock, or
+    # straight from the batch when neither was recorded
+    await record_lineage(edges or [(dispatch.batch_id, dispatch_id, None)], user)
+    await record_sale(dispatch_doc)
     
     # Update batch status
-    await db.batches.update_one(
-        {"batch_id": dispatch.batch_id},
-        {"$set": {"status": "SHIPPED"}}
-    )
+    await set_batch_status(dispatch.batch_id, "SHIPPED", user)
+    response_cache.invalidate("dispatches", "inventory", "batches")
     
     return Dispatch(**dispatch_doc)
 
-@api_router.get("/dispatch", response_model=List[Dispatch])
-async def get_dispatches(user: dict = Depends(get_current_user)):
-    dispatches = await db.dispatches.find({}, {"_id": 0}).to_list(1000)
+async def load_dispatches(projection: Optional[dict] = None) -> List[dict]:
+    dispatches = await db.dispatches.find({}, projection or {"_id": 0}).to_list(1000)
     
     for dispatch in dispatches:
         if isinstance(dispatch.get('dispatch_date'), str):
@@ -694,6 +2455,366 @@ async def get_dispatches(user: dict = Depends(get_current_user)):
     
     return dispatches
 
+@api_router.get("/dispatch", response_model=List[Dispatch])
+async def get_dispatches(
+    request: Request,
+    response: Response,
+    expand: Optional[str] = None,
+    fields: Optional[str] = None,
+    user: dict = Depends(get_current_user)
+):
+    tree = parse_expand(expand, {"batch"})
+    projection = parse_fields(fields, Dispatch, "dispatch_id", tree)
+    dispatches = await cached_list("GET /dispatch", user, {"dispatches"}, load_dispatches, tree, projection)
+    return list_response(request, response, dispatches, Dispatch, partial=projection is not None)
+
+# ============ Sales Cube ============
+
+# Revenue and volume per (customer_name, country, size_grade, month) in
+# sales_cube, bumped with $inc by create_dispatch. Drill-downs group these
+# cells, never the dispatches themselves. Volume is the stock a dispatch
+# claimed from cold storage, or the batch weight when none was claimed;
+# selling_price is per kg.
+SALES_CUBE_DIMENSIONS = ("customer_name", "country", "size_grade", "month")
+SALES_CUBE_MEASURES = ("revenue", "weight_kg", "dispatches")
+
+def sales_cube_cell(dispatch: dict) -> tuple:
+    # (cell key, increments) for one dispatch
+    weight = dispatch.get("weight_kg") or 0.0
+    dispatch_date = dispatch["dispatch_date"]
+    if isinstance(dispatch_date, str):
+        dispatch_date = datetime.fromisoformat(dispatch_date)
+    key = {
+        "customer_name": dispatch["customer_name"],
+        "country": dispatch["country"],
+        "size_grade": dispatch.get("size_grade") or "unknown",
+        "month": to_naive_utc(dispatch_date).strftime("%Y-%m")
+    }
+    return key, {"revenue": round(weight * dispatch["selling_price"], 2), "weight_kg": weight, "dispatches": 1}
+
+async def record_sale(dispatch: dict):
+    key, increments = sales_cube_cell(dispatch)
+    await db.sales_cube.update_one(
+        key, {"$inc": increments, "$max": {"updated_at": datetime.now(timezone.utc)}}, upsert=True
+    )
+    # Flagged only once counted, so the flag never claims a sale the cube lacks
+    await db.dispatches.update_one({"dispatch_id": dispatch["dispatch_id"]}, {"$set": {"in_sales_cube": True}})
+
+async def backfill_sales_cube(in_flight: timedelta = timedelta(minutes=5)):
+    # Dispatches recorded before the cube existed (no in_sales_cube flag),
+    # hot and archived, are added once
+    if await db.counters.find_one({"_id": "sales_cube:backfill"}):
+        return
+    if not await acquire_lease("sales-cube-backfill", 3600):
+        return
+    try:
+        # Dispatches created within in_flight may still be on their way
+        # through record_sale, which counts and flags them itself
+        cutoff = to_naive_utc(datetime.now(timezone.utc) - in_flight)
+        columns = ["batch_id", "customer_name", "country", "selling_price", "dispatch_date", "in_sales_cube", "created_at"]
+        dispatches = []
+        for dispatch in await find_with_archive("dispatches", columns=columns):
+            created_at = dispatch.get("created_at")
+            if isinstance(created_at, str):
+                created_at = datetime.fromisoformat(created_at)
+            if not dispatch.get("in_sales_cube") and (not created_at or to_naive_utc(created_at) < cutoff):
+                dispatches.append(dispatch)
+        
+        batch_ids = list({d["batch_id"] for d in dispatches})
+        batches = {}
+        for start in range(0, len(batch_ids), 5000):
+            for batch in await find_with_archive("batches", {"batch_id": batch_ids[start:start + 5000]},
+                                                 columns=["weight_kg", "size_grade"]):
+                batches[batch["batch_id"]] = batch
+        shipped = {}
+        async for edge in db.lineage.find({"to_type": "dispatch", "from_type": "inventory"},
+                                          {"_id": 0, "to_id": 1, "weight_kg": 1}):
+            shipped[edge["to_id"]] = shipped.get(edge["to_id"], 0.0) + (edge["weight_kg"] or 0.0)
+        
+        cells = {}
+        for dispatch in dispatches:
+            batch = batches.get(dispatch["batch_id"], {})
+            dispatch["weight_kg"] = shipped.get(dispatch["dispatch_id"]) or batch.get("weight_kg", 0.0)
+            dispatch["size_grade"] = batch.get("size_grade")
+            key, increments = sales_cube_cell(dispatch)
+            cell = cells.setdefault(tuple(key.values()), {"key": key, **dict.fromkeys(SALES_CUBE_MEASURES, 0)})
+            for measure, value in increments.items():
+                cell[measure] += value
+        
+        now = datetime.now(timezone.utc)
+        operations = [
+            UpdateOne(cell["key"], {"$inc": {m: cell[m] for m in SALES_CUBE_MEASURES}, "$max": {"updated_at": now}}, upsert=True)
+            for cell in cells.values()
+        ]
+        for start in range(0, len(operations), 1000):
+            await db.sales_cube.bulk_write(operations[start:start + 1000], ordered=False)
+        dispatch_ids = [d["dispatch_id"] for d in dispatches]
+        for start in range(0, len(dispatch_ids), 5000):
+            await db.dispatches.update_many({"dispatch_id": {"$in": dispatch_ids[start:start + 5000]}},
+                                            {"$set": {"in_sales_cube": True}})
+        await db.counters.insert_one({"_id": "sales_cube:backfill", "dispatches": len(dispatches), "at": now})
+        response_cache.invalidate("dispatches")
+        logger.info(f"Sales cube backfilled from {len(dispatches)} dispatches")
+    except Exception:
+        logger.exception("Sales cube backfill failed")
+
+async def compute_sales_slice(group_by: List[str], filters: Dict[str, List[str]],
+                              start_month: Optional[str], end_month: Optional[str], limit: int) -> dict:
+    match = {dimension: {"$in": values} for dimension, values in filters.items()}
+    if start_month or end_month:
+        match["month"] = {
+            **({"$gte": start_month} if start_month else {}),
+            **({"$lte": end_month} if end_month else {})
+        }
+    
+    sums = {measure: {"$sum": f"${measure}"} for measure in SALES_CUBE_MEASURES}
+    price = {"$cond": [{"$gt": ["$weight_kg", 0]}, {"$round": [{"$divide": ["$revenue", "$weight_kg"]}, 2]}, None]}
+    measures = {"revenue": {"$round": ["$revenue", 2]}, "weight_kg": {"$round": ["$weight_kg", 2]},
+                "dispatches": 1, "avg_price_per_kg": price}
+    
+    result = await analytics_db.sales_cube.aggregate([
+        {"$match": match},
+        {"$facet": {
+            "totals": [{"$group": {"_id": None, **sums}}, {"$project": {"_id": 0, **measures}}],
+            "rows": [
+                {"$group": {"_id": {dimension: f"${dimension}" for dimension in group_by}, **sums}},
+                {"$sort": {"revenue": -1}},
+                {"$limit": limit},
+                {"$project": {"_id": 0, **{dimension: f"$_id.{dimension}" for dimension in group_by}, **measures}}
+            ]
+        }}
+    ]).to_list(None)
+    
+    totals = result[0]["totals"][0] if result and result[0]["totals"] else \
+        {"revenue": 0, "weight_kg": 0, "dispatches": 0, "avg_price_per_kg": None}
+    return {
+        "group_by": group_by,
+        "filters": filters,
+        "start_month": start_month,
+        "end_month": end_month,
+        "totals": totals,
+        "rows": result[0]["rows"] if group_by and result else []
+    }
+
+@api_router.get("/analytics/sales")
+async def get_sales_slice(
+    group_by: str = "",
+    customer_name: Optional[str] = None,
+    country: Optional[str] = None,
+    size_grade: Optional[str] = None,
+    start_month: Optional[str] = None,
+    end_month: Optional[str] = None,
+    limit: int = 100,
+    user: dict = Depends(get_current_user)
+):
+    if user["role"] not in ["owner", "admin"]:
+        raise HTTPException(status_code=403, detail="Owner/Admin access required")
+    
+    # group_by=country,month; filters take comma-separated values
+    dimensions = [d for d in group_by.split(",") if d]
+    unknown = [d for d in dimensions if d not in SALES_CUBE_DIMENSIONS]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Cannot group by {', '.join(unknown)}; use {', '.join(SALES_CUBE_DIMENSIONS)}")
+    for month in (start_month, end_month):
+        if month and not re.fullmatch(r"\d{4}-\d{2}", month):
+            raise HTTPException(status_code=400, detail="Months must look like 2026-02")
+    filters = {
+        dimension: value.split(",")
+        for dimension, value in (("customer_name", customer_name), ("country", country), ("size_grade", size_grade))
+        if value
+    }
+    limit = max(1, min(limit, 1000))
+    
+    return await response_cache.get_or_compute(
+        ("GET /analytics/sales", tuple(dimensions), tuple(sorted((k, tuple(v)) for k, v in filters.items())),
+         start_month, end_month, limit),
+        {"dispatches"},
+        lambda: compute_sales_slice(dimensions, filters, start_month, end_month, limit)
+    )
+
+# ============ Lineage Routes ============
+
+LINEAGE_MAX_DEPTH = 20
+
+async def load_lineage_source(source_id: str, projection: Optional[dict] = None) -> dict:
+    node_type = lineage_node_type(source_id)
+    projection = {"_id": 0, **(projection or {"weight_kg": 1, "size_grade": 1})}
+    if node_type == "batch":
+        source = await db.batches.find_one({"batch_id": source_id}, projection)
+    elif node_type == "lot":
+        source = await db.lots.find_one({"lot_id": source_id}, projection)
+    else:
+        source = None
+    if not source:
+        raise HTTPException(status_code=404, detail=f"Batch or lot {source_id} not found")
+    return source
+
+async def create_lot(origin: str, size_grade: Optional[str], parts: List[tuple], actor: Optional[dict] = None) -> dict:
+    # parts: (source_id, weight_kg) the lot was made from
+    lot_doc = {
+        "lot_id": f"lot_{uuid.uuid4().hex[:12]}",
+        "size_grade": size_grade,
+        "weight_kg": sum(weight for _, weight in parts),
+        "origin": origin,
+        "source_ids": [source_id for source_id, _ in parts],
+        "created_at": datetime.now(timezone.utc),
+        "updated_at": datetime.now(timezone.utc)
+    }
+    await db.lots.insert_one(lot_doc)
+    await record_event("lots", "created", lot_doc["lot_id"], lot_doc, actor)
+    await record_lineage([(source_id, lot_doc["lot_id"], weight) for source_id, weight in parts], actor)
+    return lot_doc
+
+async def reserve_split_weight(source_id: str, requested: float) -> bool:
+    # remaining_weight_kg on the batch / lot is what is left to split. It is
+    # reserved with one conditional $inc, so concurrent splits of the same
+    # source cannot both pass the check. Sources split before the field
+    # existed (or replayed without it) start from their lineage edges.
+    collection, key = (db.batches, "batch_id") if lineage_node_type(source_id) == "batch" else (db.lots, "lot_id")
+    source = await collection.find_one({key: source_id}, {"_id": 0, "weight_kg": 1, "remaining_weight_kg": 1})
+    if "remaining_weight_kg" not in source:
+        already_split = await db.lineage.aggregate([
+            {"$match": {"from_id": source_id, "to_type": "lot"}},
+            {"$group": {"_id": None, "weight_kg": {"$sum": "$weight_kg"}}}
+        ]).to_list(1)
+        await collection.update_one(
+            {key: source_id, "remaining_weight_kg": {"$exists": False}},
+            {"$set": {"remaining_weight_kg": source["weight_kg"] - (already_split[0]["weight_kg"] if already_split else 0)}}
+        )
+    
+    reserved = await collection.find_one_and_update(
+        {key: source_id, "remaining_weight_kg": {"$gte": requested - 1e-6}},
+        {"$inc": {"remaining_weight_kg": -requested}},
+        projection={"_id": 1}
+    )
+    return reserved is not None
+
+async def release_split_weight(source_id: str, weight_kg: float):
+    collection, key = (db.batches, "batch_id") if lineage_node_type(source_id) == "batch" else (db.lots, "lot_id")
+    await collection.update_one({key: source_id}, {"$inc": {"remaining_weight_kg": weight_kg}})
+
+@api_router.post("/lots/split", response_model=List[Lot])
+async def split_lot(data: LotSplit, user: dict = Depends(get_current_user)):
+    # Grading: one batch (or lot) becomes several lots
+    await load_lineage_source(data.source_id)
+    
+    requested = sum(part.weight_kg for part in data.lots)
+    if not await reserve_split_weight(data.source_id, requested):
+        available = (await load_lineage_source(data.source_id, {"remaining_weight_kg": 1})).get("remaining_weight_kg", 0)
+        raise HTTPException(
+            status_code=400,
+            detail=f"Lots total {requested:.2f} kg, only {available:.2f} kg of {data.source_id} left to split"
+        )
+    
+    lots = []
+    try:
+        for part in data.lots:
+            lots.append(await create_lot("split", part.size_grade, [(data.source_id, part.weight_kg)], user))
+    except Exception:
+        # Give back what the lots that were not written had reserved
+        await release_split_weight(data.source_id, requested - sum(lot["weight_kg"] for lot in lots))
+        raise
+    return [Lot(**lot) for lot in lots]
+
+@api_router.post("/lots/merge", response_model=Lot)
+async def merge_lots(data: LotMerge, user: dict = Depends(get_current_user)):
+    # Packing: several batches / lots go into one lot (e.g. an export carton)
+    if not data.sources:
+        raise HTTPException(status_code=400, detail="No sources given")
+    for source in data.sources:
+        await load_lineage_source(source.id)
+    
+    lot = await create_lot("merge", data.size_grade, [(source.id, source.weight_kg) for source in data.sources], user)
+    return Lot(**lot)
+
+@api_router.get("/lineage/{node_id}")
+async def get_lineage(node_id: str, direction: str = "downstream", max_depth: int = LINEAGE_MAX_DEPTH,
+                      user: dict = Depends(get_current_user)):
+    # Walks the genealogy graph with $graphLookup over the indexed edges:
+    # downstream (batch → lots → inventory → dispatch) or upstream
+    if direction not in ("downstream", "upstream"):
+        raise HTTPException(status_code=400, detail="direction must be downstream or upstream")
+    here, there = ("from_id", "to_id") if direction == "downstream" else ("to_id", "from_id")
+    
+    result = await db.lineage.aggregate([
+        {"$match": {here: node_id}},
+        {"$limit": 1},
+        {"$graphLookup": {
+            "from": "lineage",
+            "startWith": node_id,
+            "connectFromField": there,
+            "connectToField": here,
+            "as": "edges",
+            "depthField": "depth",
+            "maxDepth": max(0, min(max_depth, LINEAGE_MAX_DEPTH))
+        }},
+        {"$project": {"_id": 0, "edges": {"$map": {"input": "$edges", "as": "e", "in": {
+            "from_id": "$$e.from_id", "from_type": "$$e.from_type",
+            "to_id": "$$e.to_id", "to_type": "$$e.to_type",
+            "weight_kg": "$$e.weight_kg", "depth": "$$e.depth"
+        }}}}}
+    ]).to_list(1)
+    edges = sorted(result[0]["edges"], key=lambda e: e["depth"]) if result else []
+    
+    nodes = {}
+    for edge in edges:
+        node = edge[there]
+        if node not in nodes:
+            nodes[node] = {"id": node, "type": edge[there.replace("_id", "_type")], "depth": edge["depth"] + 1}
+    
+    return {"node_id": node_id, "direction": direction, "nodes": list(nodes.values()), "edges": edges}
+
+@api_router.get("/recall")
+async def recall_dispatches(
+    farmer_id: Optional[str] = None,
+    batch_id: Optional[str] = None,
+    week: Optional[str] = None,
+    user: dict = Depends(get_current_user)
+):
+    # "Every dispatch containing prawns from farmer X in week Y": the farmer's
+    # batches come off the (farmer_id, intake_date) index (and the archive
+    # months for that week), then one $graphLookup follows the edges
+    # downstream to the dispatches.
+    if batch_id:
+        batch_ids = [batch_id]
+    elif farmer_id:
+        start = end = None
+        if week:
+            try:
+                year, week_number = week.upper().split("-W")
+                start = datetime.fromisocalendar(int(year), int(week_number), 1).replace(tzinfo=timezone.utc)
+            except ValueError:
+                raise HTTPException(status_code=400, detail="week must look like 2026-W07")
+            end = start + timedelta(days=7)
+        batches = await find_with_archive("batches", {"farmer_id": farmer_id}, start, end, columns=["batch_id"])
+        batch_ids = [b["batch_id"] for b in batches]
+    else:
+        raise HTTPException(status_code=400, detail="farmer_id or batch_id is required")
+    
+    if not batch_ids:
+        return {"batch_ids": [], "dispatches": []}
+    
+    reached = await db.lineage.aggregate([
+        {"$match": {"from_id": {"$in": batch_ids}}},
+        {"$graphLookup": {
+            "from": "lineage",
+            "startWith": "$to_id",
+            "connectFromField": "to_id",
+            "connectToField": "from_id",
+            "as": "downstream",
+            "maxDepth": LINEAGE_MAX_DEPTH
+        }},
+        {"$project": {"ids": {"$concatArrays": [["$to_id"], "$downstream.to_id"]}}},
+        {"$unwind": "$ids"},
+        {"$match": {"ids": {"$regex": "^disp_"}}},
+        {"$group": {"_id": "$ids"}}
+    ]).to_list(None)
+    
+    dispatches = await find_with_archive("dispatches", {"dispatch_id": [r["_id"] for r in reached]})
+    dispatches.sort(key=lambda d: to_naive_utc(d["dispatch_date"]))
+    
+    return {"batch_ids": batch_ids, "dispatches": [Dispatch(**d) for d in dispatches]}
+
 # ============ Payment Routes ============
 
 @api_router.post("/payments", response_model=Payment)
@@ -720,31 +2841,185 @@ async def create_payment(payment: PaymentCreate, user: dict = Depends(get_curren
         "net_amount": net_amount,
         "payment_status": "pending",
         "payment_date": None,
-        "created_at": datetime.now(timezone.utc)
+        "created_at": datetime.now(timezone.utc),
+        "updated_at": datetime.now(timezone.utc)
     }
     
-    await db.payments.insert_one(payment_doc)
+    try:
+        await db.payments.insert_one(payment_doc)
+    except DuplicateKeyError:
+        # The unique index on batch_id: one payment per batch
+        raise HTTPException(status_code=409, detail=f"Batch {payment.batch_id} already has a payment")
+    await record_event("payments", "created", payment_id, payment_doc, user)
+    response_cache.invalidate("payments")
     
     return Payment(**payment_doc)
 
 @api_router.put("/payments/{payment_id}/status")
 async def update_payment_status(payment_id: str, status: str, user: dict = Depends(get_current_user)):
-    result = await db.payments.update_one(
-        {"payment_id": payment_id},
-        {"$set": {
-            "payment_status": status,
-            "payment_date": datetime.now(timezone.utc) if status == "paid" else None
-        }}
-    )
+    now = datetime.now(timezone.utc)
+    change = {"payment_status": status, "payment_date": now if status == "paid" else None, "updated_at": now}
+    result = await db.payments.update_one({"payment_id": payment_id}, {"$set": change})
     
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Payment not found")
+    await record_event("payments", "updated", payment_id, change, user)
+    response_cache.invalidate("payments")
     
     return {"message": "Payment status updated"}
 
-@api_router.get("/payments", response_model=List[Payment])
-async def get_payments(user: dict = Depends(get_current_user)):
-    payments = await db.payments.find({}, {"_id": 0}).to_list(1000)
+@api_router.get("/payments/price-table")
+async def get_price_table(user: dict = Depends(get_current_user)):
+    prices = await db.grade_prices.find({}, {"_id": 0}).to_list(1000)
+    
+    return {"prices": {p["size_grade"]: p["price_per_kg"] for p in prices}}
+
+@api_router.put("/payments/price-table")
+async def update_price_table(data: PriceTableUpdate, user: dict = Depends(get_current_user)):
+    if user["role"] not in ["owner", "admin"]:
+        raise HTTPException(status_code=403, detail="Owner/Admin access required")
+    
+    now = datetime.now(timezone.utc)
+    operations = [
+        UpdateOne(
+            {"size_grade": grade},
+            {"$set": {"size_grade": grade, "price_per_kg": price, "updated_at": now}},
+            upsert=True
+        )
+        for grade, price in data.prices.items()
+    ]
+    if operations:
+        await db.grade_prices.bulk_write(operations, ordered=False)
+    await record_events([
+        event_doc("grade_prices", "updated", grade, {"size_grade": grade, "price_per_kg": price, "updated_at": now}, user)
+        for grade, price in data.prices.items()
+    ])
+    
+    return {"message": "Price table updated", "grades": len(operations)}
+
+@api_router.post("/payments/pay-cycle")
+async def create_pay_cycle(cycle: PayCycleCreate, user: dict = Depends(get_current_user)):
+    if user["role"] not in ["owner", "admin"]:
+        raise HTTPException(status_code=403, detail="Owner/Admin access required")
+    
+    if cycle.end_date <= cycle.start_date:
+        raise HTTPException(status_code=400, detail="end_date must be after start_date")
+    
+    prices = cycle.prices
+    if prices is None:
+        stored = await db.grade_prices.find({}, {"_id": 0}).to_list(1000)
+        prices = {p["size_grade"]: p["price_per_kg"] for p in stored}
+    
+    # Processed batches from the cycle that have no payment yet
+    batches = await db.batches.find(
+        {
+            "status": {"$in": ["PROCESSED", "STORED", "SHIPPED"]},
+            "intake_date": {"$gte": cycle.start_date, "$lt": cycle.end_date}
+        },
+        {"_id": 0, "batch_id": 1, "farmer_id": 1, "weight_kg": 1, "size_grade": 1}
+    ).to_list(None)
+    
+    already_paid = set(await db.payments.distinct(
+        "batch_id",
+        {"batch_id": {"$in": [b["batch_id"] for b in batches]}}
+    ))
+    unpaid = [b for b in batches if b["batch_id"] not in already_paid]
+    
+    priced = [b for b in unpaid if b["size_grade"] in prices]
+    unpriced = [b["batch_id"] for b in unpaid if b["size_grade"] not in prices]
+    
+    # Amounts for the whole cycle in one pass
+    weights = np.array([b["weight_kg"] for b in priced], dtype=float)
+    price_per_kg = np.array([prices[b["size_grade"]] for b in priced], dtype=float)
+    gross = np.round(weights * price_per_kg, 2)
+    deductions = np.round(gross * cycle.deduction_percent / 100 + weights * cycle.deduction_per_kg, 2)
+    net = np.round(gross - deductions, 2)
+    
+    pay_cycle_id = f"cycle_{uuid.uuid4().hex[:12]}"
+    now = datetime.now(timezone.utc)
+    payment_docs = [
+        {
+            "payment_id": f"pay_{uuid.uuid4().hex[:12]}",
+            "farmer_id": batch["farmer_id"],
+            "batch_id": batch["batch_id"],
+            "total_prawns": batch["weight_kg"],
+            "price_per_kg": batch_price,
+            "gross_amount": batch_gross,
+            "deductions": batch_deductions,
+            "net_amount": batch_net,
+            "payment_status": "pending",
+            "payment_date": None,
+            "pay_cycle_id": pay_cycle_id,
+            "created_at": now,
+            "updated_at": now
+        }
+        for batch, batch_price, batch_gross, batch_deductions, batch_net in zip(
+            priced, price_per_kg.tolist(), gross.tolist(), deductions.tolist(), net.tolist()
+        )
+    ]
+    
+    if payment_docs and not cycle.dry_run:
+        # Upsert on batch_id so a payment created concurrently (or a re-run
+        # of the same cycle) is never duplicated
+        try:
+            result = await db.payments.bulk_write(
+                [UpdateOne({"batch_id": doc["batch_id"]}, {"$setOnInsert": doc}, upsert=True) for doc in payment_docs],
+                ordered=False
+            )
+            upserted = sorted(result.upserted_ids)
+        except BulkWriteError as e:
+            # Two upserts raced on the unique batch_id index; the other one won
+            if any(error["code"] != 11000 for error in e.details["writeErrors"]):
+                raise
+            upserted = sorted(item["index"] for item in e.details["upserted"])
+        # Report only the payments this cycle actually created
+        already_paid.update(doc["batch_id"] for doc in payment_docs)
+        already_paid.difference_update(payment_docs[index]["batch_id"] for index in upserted)
+        payment_docs = [payment_docs[index] for index in upserted]
+        weights, gross, deductions, net = (values[upserted] for values in (weights, gross, deductions, net))
+        await record_events([event_doc("payments", "created", doc["payment_id"], doc, user) for doc in payment_docs])
+        response_cache.invalidate("payments")
+    
+    return {
+        "pay_cycle_id": None if cycle.dry_run else pay_cycle_id,
+        "dry_run": cycle.dry_run,
+        "batches_found": len(batches),
+        "already_paid": len(already_paid),
+        "payments_created": 0 if cycle.dry_run else len(payment_docs),
+        "unpriced_batches": unpriced,
+        "total_prawns": float(weights.sum()),
+        "total_gross": float(gross.sum()),
+        "total_deductions": float(deductions.sum()),
+        "total_net": float(net.sum()),
+        "payments": payment_docs
+    }
+
+@api_router.put("/payments/bulk-status")
+async def update_payment_status_bulk(data: BulkPaymentStatusUpdate, user: dict = Depends(get_current_user)):
+    if user["role"] not in ["owner", "admin"]:
+        raise HTTPException(status_code=403, detail="Owner/Admin access required")
+    
+    if data.status not in ["pending", "paid"]:
+        raise HTTPException(status_code=400, detail="Invalid status")
+    
+    if not data.payment_ids and not data.pay_cycle_id:
+        raise HTTPException(status_code=400, detail="payment_ids or pay_cycle_id required")
+    
+    query = {"payment_id": {"$in": data.payment_ids}} if data.payment_ids else {"pay_cycle_id": data.pay_cycle_id}
+    # Resolved to ids first, so the log names exactly the payments updated
+    payment_ids = await db.payments.distinct("payment_id", query)
+    
+    now = datetime.now(timezone.utc)
+    change = {"payment_status": data.status, "payment_date": now if data.status == "paid" else None, "updated_at": now}
+    result = await db.payments.update_many({"payment_id": {"$in": payment_ids}}, {"$set": change})
+    await record_events([event_doc("payments", "updated", payment_id, change, user) for payment_id in payment_ids])
+    
+    response_cache.invalidate("payments")
+    
+    return {"message": "Payment statuses updated", "matched": result.matched_count, "modified": result.modified_count}
+
+async def load_payments(projection: Optional[dict] = None) -> List[dict]:
+    payments = await db.payments.find({}, projection or {"_id": 0}).to_list(1000)
     
     for payment in payments:
         if isinstance(payment.get('created_at'), str):
@@ -754,194 +3029,1902 @@ async def get_payments(user: dict = Depends(get_current_user)):
     
     return payments
 
+@api_router.get("/payments", response_model=List[Payment])
+async def get_payments(
+    request: Request,
+    response: Response,
+    expand: Optional[str] = None,
+    fields: Optional[str] = None,
+    user: dict = Depends(get_current_user)
+):
+    tree = parse_expand(expand, {"batch", "farmer"})
+    projection = parse_fields(fields, Payment, "payment_id", tree)
+    payments = await cached_list("GET /payments", user, {"payments"}, load_payments, tree, projection)
+    return list_response(request, response, payments, Payment, partial=projection is not None)
+
+# ============ Search Routes ============
+
+SEARCH_MAX_LIMIT = 50
+
+def search_rank_farmer(farmer: dict, q: str) -> int:
+    name = farmer["name"].lower()
+    if name == q:
+        return 0
+    if name.startswith(q):
+        return 1
+    if all(any(token.startswith(word) for token in farmer.get("name_tokens", [])) for word in q.split()):
+        return 2
+    return 3  # Contact prefix
+
+def search_rank_batch(batch: dict, q: str) -> int:
+    batch_id = batch["batch_id"].upper()
+    if batch_id == q.upper() or batch_id == f"BATCH{q.upper()}":
+        return 0
+    return 1
+
+@api_router.get("/search")
+async def search(q: str, limit: int = 10, user: dict = Depends(get_current_user)):
+    # Typeahead over farmers (name, contact) and batches (batch_id). Every
+    # prefix query is an anchored regex on an indexed field, so it is an index
+    # range scan capped at limit; address/location text search only fills
+    # whatever room is left. q is echoed back so a debounced client can drop
+    # responses that arrive out of order.
+    q = " ".join(q.lower().split())
+    limit = max(1, min(limit, SEARCH_MAX_LIMIT))
+    if not q:
+        return {"q": q, "results": []}
+    
+    words = [re.escape(word) for word in q.split()]
+    digits = re.sub(r"\D", "", q)
+    farmer_projection = {"_id": 0, "farmer_id": 1, "name": 1, "contact": 1, "address": 1, "name_tokens": 1}
+    batch_projection = {"_id": 0, "batch_id": 1, "farmer_id": 1, "size_grade": 1, "weight_kg": 1, "location": 1, "status": 1}
+    
+    farmer_query = {"$and": [{"name_tokens": {"$regex": f"^{word}"}} for word in words]}
+    if digits and len(digits) == len(q.replace(" ", "").lstrip("+")):
+        farmer_query = {"$or": [farmer_query, {"contact_digits": {"$regex": f"^{digits}"}}]}
+    
+    batch_prefix = re.escape(q.replace(" ", "").upper())
+    batch_query = {"$or": [
+        {"batch_id": {"$regex": f"^{batch_prefix}"}},
+        {"batch_id": {"$regex": f"^BATCH{batch_prefix}"}}
+    ]}
+    
+    farmers, batches = await asyncio.gather(
+        db.farmers.find(farmer_query, farmer_projection).limit(limit).to_list(limit),
+        db.batches.find(batch_query, batch_projection).sort("batch_id", 1).limit(limit).to_list(limit)
+    )
+    
+    results = [
+        {"type": "farmer", "id": f["farmer_id"], "label": f["name"], "detail": f["contact"], "rank": search_rank_farmer(f, q)}
+        for f in farmers
+    ] + [
+        {"type": "batch", "id": b["batch_id"], "label": b["batch_id"],
+         "detail": f"{b['size_grade']} · {b['weight_kg']} kg · {b['status']}", "rank": search_rank_batch(b, q)}
+        for b in batches
+    ]
+    
+    # Address / location words, only when the prefixes leave room
+    if len(results) < limit and len(q) >= 3:
+        seen = {r["id"] for r in results}
+        text_query = {"$text": {"$search": q}}
+        score = {"score": {"$meta": "textScore"}}
+        text_farmers, text_batches = await asyncio.gather(
+            db.farmers.find(text_query, {**farmer_projection, **score}).sort([("score", {"$meta": "textScore"})]).limit(limit).to_list(limit),
+            db.batches.find(text_query, {**batch_projection, **score}).sort([("score", {"$meta": "textScore"})]).limit(limit).to_list(limit)
+        )
+        results += [
+            {"type": "farmer", "id": f["farmer_id"], "label": f["name"], "detail": f["address"], "rank": 4}
+            for f in text_farmers if f["farmer_id"] not in seen
+        ] + [
+            {"type": "batch", "id": b["batch_id"], "label": b["batch_id"], "detail": b["location"], "rank": 4}
+            for b in text_batches if b["batch_id"] not in seen
+        ]
+    
+    results.sort(key=lambda r: (r["rank"], r["label"].lower()))
+    
+    return {"q": q, "results": results[:limit]}
+
+# ============ Sync Routes ============
+
+# Response key -> (collection, id field) for the offline PWA
+SYNC_COLLECTIONS = {
+    "farmers": ("farmers", "farmer_id"),
+    "batches": ("batches", "batch_id"),
+    "processing_stages": ("processing_stages", "stage_id"),
+    "inventory": ("inventory", "inventory_id"),
+    "dispatches": ("dispatches", "dispatch_id"),
+    "payments": ("payments", "payment_id"),
+}
+
+# Tombstones: removals from the hot tier, read from the event log
+SYNC_REMOVALS = ("deleted", "archived")
+
+# Writes still in flight when a sync runs can commit with an earlier
+# updated_at, so each new token overlaps the previous window slightly.
+# Clients upsert by id, so the repeated documents are harmless.
+SYNC_OVERLAP = timedelta(seconds=5)
+
+def sync_token_to_datetime(token: str) -> datetime:
+    try:
+        return datetime.fromtimestamp(int(token) / 1000, tz=timezone.utc)
+    except (ValueError, OverflowError, OSError):
+        raise HTTPException(status_code=400, detail="Invalid sync token")
+
+def datetime_to_sync_token(value: datetime) -> str:
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return str(int(value.timestamp() * 1000))
+
+@api_router.get("/sync")
+async def sync_changes(
+    since: Optional[str] = None,
+    limit: int = 1000,
+    user: dict = Depends(get_current_user)
+):
+    limit = max(1, min(limit, 5000))
+    started_at = datetime.now(timezone.utc)
+    query = {"updated_at": {"$gte": sync_token_to_datetime(since)}} if since else {}
+    
+    changes = {}
+    truncated_at = []
+    for key, (collection_name, id_field) in SYNC_COLLECTIONS.items():
+        docs = await db[collection_name].find(query, {"_id": 0}).sort("updated_at", 1).to_list(limit)
+        if len(docs) == limit:
+            # Bulk writes share one updated_at, so take every document at the
+            # cut-off timestamp; the next page can then start strictly after it
+            last_updated = docs[-1]["updated_at"]
+            seen = {d[id_field] for d in docs}
+            ties = await db[collection_name].find({"updated_at": last_updated}, {"_id": 0}).to_list(None)
+            docs.extend(d for d in ties if d[id_field] not in seen)
+            truncated_at.append(last_updated)
+        changes[key] = docs
+    
+    # Ids deleted or archived since the token, so clients drop their copies.
+    # Events are written before their request returns; SYNC_OVERLAP covers
+    # one still in flight.
+    deleted = {key: [] for key in SYNC_COLLECTIONS}
+    if since:
+        keys_by_entity = {collection_name: key for key, (collection_name, _) in SYNC_COLLECTIONS.items()}
+        event_query = {"at": query["updated_at"], "action": {"$in": SYNC_REMOVALS}, "entity": {"$in": list(keys_by_entity)}}
+        projection = {"_id": 0, "entity": 1, "entity_id": 1, "at": 1}
+        events = await db.events.find(event_query, projection).sort("at", 1).to_list(limit)
+        if len(events) == limit:
+            last_at = events[-1]["at"]
+            events += await db.events.find({**event_query, "at": last_at}, projection).to_list(None)
+            truncated_at.append(last_at)
+        for event in events:
+            deleted[keys_by_entity[event["entity"]]].append(event["entity_id"])
+        deleted = {key: list(dict.fromkeys(ids)) for key, ids in deleted.items()}
+    
+    if truncated_at:
+        # Resume just after the earliest point where a collection was cut off
+        token = datetime_to_sync_token(min(truncated_at) + timedelta(milliseconds=1))
+    else:
+        token = datetime_to_sync_token(started_at - SYNC_OVERLAP)
+    
+    return {
+        "token": token,
+        "has_more": bool(truncated_at),
+        "full": since is None,
+        "changes": changes,
+        "deleted": deleted
+    }
+
+@api_router.post("/sync/upload")
+async def sync_upload(data: SyncUpload, user: dict = Depends(get_current_user)):
+    # Replays queued offline writes. Each operation carries the id it was
+    # queued with, so an upload retried after a dropped connection returns
+    # the original records instead of creating duplicates.
+    # One counter round trip for the whole upload: its batches get
+    # contiguous ids, in upload order
+    reserved_ids = deque(await batch_id_allocator.allocate(
+        sum(1 for operation in data.operations if operation.kind == "batch")
+    ))
+    handlers = {
+        "batch": (BatchCreate, lambda batch, **kwargs: insert_batch(batch, reserved_ids=reserved_ids, **kwargs)),
+        "processing_stage": (ProcessingStageCreate, create_processing_stage),
+    }
+    
+    results = []
+    for operation in data.operations:
+        if operation.kind not in handlers:
+            results.append({"client_request_id": operation.client_request_id, "status": "error", "detail": "Unknown kind"})
+            continue
+        
+        model, handler = handlers[operation.kind]
+        try:
+            record = await handler(model(**operation.payload), user=user, idempotency_key=operation.client_request_id)
+            results.append({"client_request_id": operation.client_request_id, "status": "ok", "record": record})
+        except ValidationError as e:
+            results.append({"client_request_id": operation.client_request_id, "status": "error", "detail": str(e)})
+        except HTTPException as e:
+            results.append({"client_request_id": operation.client_request_id, "status": "error", "detail": e.detail})
+    
+    return {"results": results}
+
+# ============ Import Routes ============
+
+# Historical records from spreadsheets. The file is spooled to disk, read
+# row by row (openpyxl read-only mode, or csv), validated against the
+# *ImportRow models and written IMPORT_CHUNK_ROWS at a time with unordered
+# insert_many, so memory stays flat however long the file is. Every row gets
+# client_request_id "import:<file sha256>:<row>", which makes re-importing the
+# same file a no-op for rows already written.
+IMPORT_CHUNK_ROWS = int(os.environ.get('IMPORT_CHUNK_ROWS', '1000'))
+IMPORT_FORMATS = ("csv", "xlsx")
+
+def read_import_rows(path: Path, file_format: str):
+    # Yields (spreadsheet row number, {header: value}), skipping empty cells
+    if file_format == "csv":
+        with open(path, newline="", encoding="utf-8-sig") as f:
+            for number, row in enumerate(csv.DictReader(f), start=2):
+                record = {key.strip(): value for key, value in row.items() if key and value not in (None, "")}
+                if record:
+                    yield number, record
+        return
+    
+    workbook = openpyxl.load_workbook(path, read_only=True, data_only=True)
+    try:
+        rows = workbook.active.iter_rows(values_only=True)
+        header = [str(cell).strip() if cell is not None else None for cell in next(rows, ())]
+        for number, values in enumerate(rows, start=2):
+            record = {key: value for key, value in zip(header, values) if key and value not in (None, "")}
+            if record:
+                yield number, record
+    finally:
+        workbook.close()
+
+async def existing_ids(collection: str, field: str, values, projection: Optional[dict] = None) -> Dict[str, dict]:
+    return {
+        doc[field]: doc
+        async for doc in db[collection].find({field: {"$in": list(set(values))}}, {"_id": 0, field: 1, **(projection or {})})
+    }
+
+async def build_farmer_imports(rows: List[tuple], now: datetime) -> tuple:
+    docs = [
+        (number, {
+            "farmer_id": row.farmer_id or f"farmer_{uuid.uuid4().hex[:12]}",
+            "user_id": None,
+            "name": row.name,
+            "contact": row.contact,
+            "address": row.address,
+            "created_at": row.created_at or now,
+            "updated_at": now,
+            **farmer_search_fields(row.name, row.contact)
+        })
+        for number, row in rows
+    ]
+    return docs, []
+
+async def build_batch_imports(rows: List[tuple], now: datetime) -> tuple:
+    farmers = await existing_ids("farmers", "farmer_id", [row.farmer_id for _, row in rows])
+    known = [(number, row) for number, row in rows if row.farmer_id in farmers]
+    errors = [(number, f"farmer_id {row.farmer_id} not found") for number, row in rows if row.farmer_id not in farmers]
+    
+    # One counter round trip for the rows without a legacy batch ID
+    new_ids = iter(await batch_id_allocator.allocate(sum(1 for _, row in known if not row.batch_id)))
+    docs = []
+    for number, row in known:
+        intake_date = row.intake_date or now
+        docs.append((number, {
+            "batch_id": row.batch_id or next(new_ids),
+            "farmer_id": row.farmer_id,
+            "weight_kg": row.weight_kg,
+            "size_grade": row.size_grade,
+            "intake_date": intake_date,
+            "intake_time": intake_date.strftime("%H:%M:%S"),
+            "location": row.location,
+            "status": row.status,
+            # Labels for historical batches are rendered on demand
+            "qr_code": None,
+            "source": "import",
+            "created_at": intake_date,
+            "updated_at": now
+        }))
+    return docs, errors
+
+async def build_stage_imports(rows: List[tuple], now: datetime) -> tuple:
+    batches = await existing_ids("batches", "batch_id", [row.batch_id for _, row in rows])
+    docs, errors = [], []
+    for number, row in rows:
+        if row.batch_id not in batches:
+            errors.append((number, f"batch_id {row.batch_id} not found"))
+            continue
+        completed_at = row.completed_at or now
+        docs.append((number, {
+            "stage_id": f"stage_{uuid.uuid4().hex[:12]}",
+            "batch_id": row.batch_id,
+            "stage_name": row.stage_name,
+            "assigned_person": row.assigned_person,
+            "input_weight": row.input_weight,
+            "output_weight": row.output_weight,
+            "wastage": row.input_weight - row.output_weight,
+            "yield_percentage": (row.output_weight / row.input_weight * 100) if row.input_weight > 0 else 0,
+            "status": "COMPLETED",
+            "created_at": completed_at,
+            "started_at": row.started_at,
+            "completed_at": completed_at,
+            "updated_at": now
+        }))
+    return docs, errors
+
+async def build_payment_imports(rows: List[tuple], now: datetime) -> tuple:
+    batch_ids = [row.batch_id for _, row in rows]
+    batches = await existing_ids("batches", "batch_id", batch_ids, {"farmer_id": 1, "weight_kg": 1})
+    paid = await existing_ids("payments", "batch_id", batch_ids)
+    docs, errors = [], []
+    for number, row in rows:
+        batch = batches.get(row.batch_id)
+        if not batch:
+            errors.append((number, f"batch_id {row.batch_id} not found"))
+            continue
+        if row.batch_id in paid:
+            errors.append((number, f"batch {row.batch_id} already has a payment"))
+            continue
+        if batch["farmer_id"] != row.farmer_id:
+            errors.append((number, f"batch {row.batch_id} belongs to {batch['farmer_id']}, not {row.farmer_id}"))
+            continue
+        gross_amount = batch["weight_kg"] * row.price_per_kg
+        docs.append((number, {
+            "payment_id": f"pay_{uuid.uuid4().hex[:12]}",
+            "farmer_id": row.farmer_id,
+            "batch_id": row.batch_id,
+            "total_prawns": batch["weight_kg"],
+            "price_per_kg": row.price_per_kg,
+            "gross_amount": gross_amount,
+            "deductions": row.deductions,
+            "net_amount": gross_amount - row.deductions,
+            "payment_status": row.payment_status,
+            "payment_date": row.payment_date or (now if row.payment_status == "paid" else None),
+            "created_at": row.payment_date or now,
+            "updated_at": now
+        }))
+    return docs, errors
+
+async def after_stage_imports(docs: List[dict]):
+    await record_operator_stats_many(docs)
+
+IMPORT_KINDS = {
+    # kind -> (row model, collection, build docs, after insert)
+    "farmers": (FarmerImportRow, "farmers", build_farmer_imports, None),
+    "batches": (BatchImportRow, "batches", build_batch_imports, None),
+    "processing_stages": (ProcessingStageImportRow, "processing_stages", build_stage_imports, after_stage_imports),
+    "payments": (PaymentImportRow, "payments", build_payment_imports, None),
+}
+
+def validation_messages(error: ValidationError) -> List[str]:
+    return [f"{'.'.join(str(part) for part in e['loc']) or 'row'}: {e['msg']}" for e in error.errors()]
+
+async def import_records(kind: str, path: Path, file_format: str, file_key: str, dry_run: bool = False,
+                         actor: Optional[dict] = None):
+    # Async generator of {"row", "errors"} for every rejected row, then one
+    # {"summary"} at the end
+    model, collection, build_docs, after_insert = IMPORT_KINDS[kind]
+    rows = read_import_rows(path, file_format)
+    summary = {"kind": kind, "rows": 0, "inserted": 0, "already_imported": 0, "failed": 0, "dry_run": dry_run}
+    started = time.perf_counter()
+    
+    while chunk := await asyncio.to_thread(lambda: list(itertools.islice(rows, IMPORT_CHUNK_ROWS))):
+        summary["rows"] += len(chunk)
+        valid = []
+        for number, record in chunk:
+            try:
+                valid.append((number, model(**record)))
+            except ValidationError as e:
+                summary["failed"] += 1
+                yield {"row": number, "errors": validation_messages(e)}
+        
+        # Rows written by an earlier run of the same file are skipped before
+        # any lookups or ID allocation
+        done = await existing_ids(collection, "client_request_id",
+                                  [f"import:{file_key}:{number}" for number, _ in valid]) if valid else {}
+        summary["already_imported"] += len(done)
+        valid = [(number, row) for number, row in valid if f"import:{file_key}:{number}" not in done]
+        
+        docs, errors = await build_docs(valid, datetime.now(timezone.utc)) if valid else ([], [])
+        for number, message in errors:
+            summary["failed"] += 1
+            yield {"row": number, "errors": [message]}
+        if not docs:
+            continue
+        if dry_run:
+            summary["inserted"] += len(docs)
+            continue
+        
+        for number, doc in docs:
+            doc["client_request_id"] = f"import:{file_key}:{number}"
+        failed_at = {}
+        try:
+            await db[collection].insert_many([doc for _, doc in docs], ordered=False)
+        except BulkWriteError as e:
+            failed_at = {error["index"]: error for error in e.details["writeErrors"]}
+        
+        inserted = []
+        for index, (number, doc) in enumerate(docs):
+            error = failed_at.get(index)
+            if not error:
+                inserted.append(doc)
+            elif error["code"] == 11000 and "client_request_id" in (error.get("keyPattern") or {}):
+                summary["already_imported"] += 1
+            else:
+                summary["failed"] += 1
+                duplicate = f"duplicate {', '.join(error.get('keyPattern') or {}) or 'key'}"
+                yield {"row": number, "errors": [duplicate if error["code"] == 11000 else error.get("errmsg", "write failed")]}
+        summary["inserted"] += len(inserted)
+        await record_events([event_doc(collection, "created", doc[EVENT_KEYS[collection][0]], doc, actor) for doc in inserted])
+        if inserted and after_insert:
+            await after_insert(inserted)
+    
+    if summary["inserted"] and not dry_run:
+        response_cache.invalidate(collection)
+    summary["seconds"] = round(time.perf_counter() - started, 1)
+    logger.info(f"Import {file_key[:12]} into {collection}: {summary}")
+    yield {"summary": summary}
+
+@api_router.post("/import/{kind}")
+async def import_file(kind: str, request: Request, format: str = "csv", dry_run: bool = False,
+                      user: dict = Depends(get_current_user)):
+    # The file is the raw request body (not multipart), e.g.
+    #   curl --data-binary @batches.xlsx ".../api/import/batches?format=xlsx"
+    # Responds with NDJSON: one line per rejected row, then the summary
+    if user["role"] not in ["owner", "admin"]:
+        raise HTTPException(status_code=403, detail="Owner/Admin access required")
+    if kind not in IMPORT_KINDS:
+        raise HTTPException(status_code=404, detail=f"Unknown import kind; use {', '.join(IMPORT_KINDS)}")
+    if format not in IMPORT_FORMATS:
+        raise HTTPException(status_code=400, detail="format must be csv or xlsx")
+    
+    spool = tempfile.NamedTemporaryFile(suffix=f".{format}", delete=False)
+    digest = hashlib.sha256()
+    try:
+        with spool:
+            async for chunk in request.stream():
+                digest.update(chunk)
+                spool.write(chunk)
+    except Exception:
+        os.unlink(spool.name)
+        raise
+    
+    async def report():
+        try:
+            async for line in import_records(kind, Path(spool.name), format, digest.hexdigest(), dry_run, user):
+                yield json.dumps(line, default=str) + "\n"
+        except Exception as e:
+            logger.exception("Import failed")
+            yield json.dumps({"error": str(e)}) + "\n"
+        finally:
+            os.unlink(spool.name)
+    
+    return StreamingResponse(report(), media_type="application/x-ndjson")
+
+# ============ Event Log Routes ============
+
+@api_router.get("/events")
+async def get_events(
+    entity: Optional[str] = None,
+    entity_id: Optional[str] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    after: Optional[str] = None,
+    limit: int = 100,
+    user: dict = Depends(get_current_user)
+):
+    # Oldest first. entity + entity_id is one document's history; pass the
+    # last event_id back as after= for the next page.
+    if user["role"] not in ["owner", "admin"]:
+        raise HTTPException(status_code=403, detail="Owner/Admin access required")
+    if entity and entity not in EVENT_KEYS:
+        raise HTTPException(status_code=400, detail=f"Unknown entity; use {', '.join(EVENT_KEYS)}")
+    if entity_id and not entity:
+        raise HTTPException(status_code=400, detail="entity_id needs entity")
+    limit = max(1, min(limit, EVENT_MAX_LIMIT))
+    
+    query = {}
+    if entity:
+        query["entity"] = entity
+    if entity_id:
+        query["entity_id"] = entity_id
+    if since or until:
+        query["at"] = {**({"$gte": since} if since else {}), **({"$lte": until} if until else {})}
+    if after:
+        try:
+            anchor = await db.events.find_one({"_id": ObjectId(after)}, {"at": 1})
+        except InvalidId:
+            anchor = None
+        if not anchor:
+            raise HTTPException(status_code=400, detail="Unknown event id in after")
+        query["$or"] = [{"at": {"$gt": anchor["at"]}}, {"at": anchor["at"], "_id": {"$gt": anchor["_id"]}}]
+    
+    events = await db.events.find(query).sort([("at", 1), ("_id", 1)]).limit(limit).to_list(limit)
+    for event in events:
+        event["event_id"] = str(event.pop("_id"))
+    
+    return {"events": events, "next_after": events[-1]["event_id"] if len(events) == limit else None}
+
+# ============ Telemetry Routes ============
+
+# Cold-room sensor readings go into the temperature_readings time-series
+# collection. Posts are buffered and written with insert_many every
+# TELEMETRY_FLUSH_SECONDS (or TELEMETRY_FLUSH_MAX readings). A rollup job
+# folds raw readings into 1-minute buckets and those into 1-hour buckets;
+# raw readings and minute buckets expire, hour buckets are kept.
+TELEMETRY_API_KEY = os.environ.get('TELEMETRY_API_KEY')
+TELEMETRY_FLUSH_SECONDS = 1.0
+TELEMETRY_FLUSH_MAX = 1000
+TELEMETRY_BUFFER_LIMIT = 100_000
+TELEMETRY_LATE_SECONDS = int(os.environ.get('TELEMETRY_LATE_SECONDS', '300'))
+TELEMETRY_RAW_RETENTION = timedelta(days=int(os.environ.get('TELEMETRY_RAW_RETENTION_DAYS', '7')))
+TELEMETRY_MINUTE_RETENTION = timedelta(days=int(os.environ.get('TELEMETRY_MINUTE_RETENTION_DAYS', '90')))
+TELEMETRY_MAX_TEMP_C = float(os.environ.get('TELEMETRY_MAX_TEMP_C', '-18'))
+
+telemetry_buffer: List[dict] = []
+telemetry_flush_now = asyncio.Event()
+
+async def flush_telemetry():
+    global telemetry_buffer
+    readings, telemetry_buffer = telemetry_buffer, []
+    if not readings:
+        return
+    try:
+        await db.temperature_readings.insert_many(readings, ordered=False)
+    except Exception:
+        # Keep them for the next flush; ingest pushes back once the buffer is full
+        telemetry_buffer = readings + telemetry_buffer
+        raise
+
+async def run_telemetry_writer():
+    while True:
+        try:
+            await asyncio.wait_for(telemetry_flush_now.wait(), timeout=TELEMETRY_FLUSH_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+        telemetry_flush_now.clear()
+        try:
+            await flush_telemetry()
+        except Exception:
+            logger.exception("Telemetry flush failed")
+
+async def rollup_temperature(target: str, source: str, time_field: str, unit: str, now: datetime):
+    # Recomputes whole buckets from the last watermark (minus the lateness
+    # allowance for readings that arrive late) and replaces them, so a rerun
+    # is harmless
+    watermark = await db.counters.find_one({"_id": f"rollup:{target}"})
+    since = (watermark["through"] if watermark else now - TELEMETRY_RAW_RETENTION) - timedelta(seconds=TELEMETRY_LATE_SECONDS)
+    # Start on a bucket boundary so no bucket is replaced by a partial one
+    since = since.replace(second=0, microsecond=0)
+    if unit == "hour":
+        since = since.replace(minute=0)
+    
+    if source == "temperature_readings":
+        key = {"location": "$sensor.location", "sensor_id": "$sensor.sensor_id"}
+        fold = {"min": {"$min": "$temperature_c"}, "max": {"$max": "$temperature_c"},
+                "sum": {"$sum": "$temperature_c"}, "count": {"$sum": 1}}
+    else:
+        key = {"location": "$location", "sensor_id": "$sensor_id"}
+        fold = {"min": {"$min": "$min"}, "max": {"$max": "$max"}, "sum": {"$sum": "$sum"}, "count": {"$sum": "$count"}}
+    
+    await db[source].aggregate([
+        {"$match": {time_field: {"$gte": since, "$lt": now}}},
+        {"$group": {"_id": {**key, "start": {"$dateTrunc": {"date": f"${time_field}", "unit": unit}}}, **fold}},
+        {"$project": {
+            "_id": 0, "location": "$_id.location", "sensor_id": "$_id.sensor_id", "start": "$_id.start",
+            "min": 1, "max": 1, "sum": 1, "count": 1, "avg": {"$divide": ["$sum", "$count"]}
+        }},
+        {"$merge": {"into": target, "on": ["location", "sensor_id", "start"], "whenMatched": "replace"}}
+    ]).to_list(None)
+    
+    await db.counters.update_one({"_id": f"rollup:{target}"}, {"$set": {"through": now}}, upsert=True)
+
+async def run_temperature_rollups(interval_seconds: int = 60):
+    while True:
+        try:
+            if await acquire_lease("telemetry-rollup", interval_seconds):
+                now = datetime.now(timezone.utc)
+                await rollup_temperature("temperature_1m", "temperature_readings", "ts", "minute", now)
+                await rollup_temperature("temperature_1h", "temperature_1m", "start", "hour", now)
+        except Exception:
+            logger.exception("Temperature rollup failed")
+        await asyncio.sleep(interval_seconds)
+
+async def ensure_telemetry_collections():
+    try:
+        await db.create_collection(
+            "temperature_readings",
+            timeseries={"timeField": "ts", "metaField": "sensor", "granularity": "seconds"},
+            expireAfterSeconds=int(TELEMETRY_RAW_RETENTION.total_seconds())
+        )
+    except (CollectionInvalid, OperationFailure):
+        pass  # Already exists (possibly created by another worker just now)
+    await db.temperature_readings.create_index([("sensor.location", 1), ("ts", 1)])
+    
+    for rollup in ("temperature_1m", "temperature_1h"):
+        await db[rollup].create_index([("location", 1), ("sensor_id", 1), ("start", 1)], unique=True)
+        await db[rollup].create_index([("location", 1), ("start", 1)])
+    await db.temperature_1m.create_index("start", expireAfterSeconds=int(TELEMETRY_MINUTE_RETENTION.total_seconds()))
+
+async def get_telemetry_client(request: Request) -> dict:
+    # Sensors authenticate with X-Telemetry-Key when TELEMETRY_API_KEY is set;
+    # staff sessions are accepted too (manual uploads, testing)
+    if TELEMETRY_API_KEY and request.headers.get("x-telemetry-key") == TELEMETRY_API_KEY:
+        return {"role": "sensor"}
+    return await get_current_user(request)
+
+@api_router.post("/telemetry/temperature", status_code=202)
+async def ingest_temperature(data: TelemetryUpload, client_info: dict = Depends(get_telemetry_client)):
+    if len(telemetry_buffer) + len(data.readings) > TELEMETRY_BUFFER_LIMIT:
+        raise HTTPException(status_code=503, detail="Telemetry backlog full, retry later", headers={"Retry-After": "5"})
+    
+    received = datetime.now(timezone.utc)
+    telemetry_buffer.extend(
+        {
+            "ts": reading.ts or received,
+            "sensor": {"sensor_id": reading.sensor_id, "location": reading.location},
+            "temperature_c": reading.temperature_c
+        }
+        for reading in data.readings
+    )
+    if len(telemetry_buffer) >= TELEMETRY_FLUSH_MAX:
+        telemetry_flush_now.set()
+    
+    return {"accepted": len(data.readings)}
+
+def telemetry_resolution(span: timedelta) -> str:
+    if span <= timedelta(hours=2):
+        return "raw"
+    if span <= timedelta(days=7):
+        return "1m"
+    return "1h"
+
+async def temperature_series(location: str, start: datetime, end: datetime, resolution: str) -> List[dict]:
+    # Sensors at one location are combined per point
+    if resolution == "raw":
+        source, time_field, key = "temperature_readings", "ts", "sensor.location"
+        fold = {"min": {"$min": "$temperature_c"}, "max": {"$max": "$temperature_c"},
+                "sum": {"$sum": "$temperature_c"}, "count": {"$sum": 1}}
+    else:
+        source, time_field, key = f"temperature_{resolution}", "start", "location"
+        fold = {"min": {"$min": "$min"}, "max": {"$max": "$max"}, "sum": {"$sum": "$sum"}, "count": {"$sum": "$count"}}
+    
+    return await analytics_db[source].aggregate([
+        {"$match": {key: location, time_field: {"$gte": start, "$lt": end}}},
+        {"$group": {"_id": f"${time_field}", **fold}},
+        {"$sort": {"_id": 1}},
+        {"$project": {"_id": 0, "t": "$_id", "min": 1, "max": 1, "avg": {"$round": [{"$divide": ["$sum", "$count"]}, 2]}}}
+    ]).to_list(None)
+
+@api_router.get("/telemetry/batches/{batch_id}/temperature")
+async def get_batch_temperature(batch_id: str, resolution: str = "auto", user: dict = Depends(get_current_user)):
+    # Temperature history for every cold-storage stay of a batch, from
+    # inventory.created_at until it was dispatched (or now)
+    if resolution not in ("auto", "raw", "1m", "1h"):
+        raise HTTPException(status_code=400, detail="resolution must be auto, raw, 1m or 1h")
+    
+    stays = await db.inventory.find(
+        {"batch_id": batch_id},
+        {"_id": 0, "inventory_id": 1, "location": 1, "status": 1, "created_at": 1, "dispatched_at": 1, "updated_at": 1}
+    ).sort("created_at", 1).to_list(None)
+    if not stays:
+        raise HTTPException(status_code=404, detail="No storage records for this batch")
+    
+    now = datetime.now(timezone.utc)
+    intervals = []
+    for stay in stays:
+        start = to_naive_utc(stay["created_at"])
+        if stay["status"] == "DISPATCHED":
+            end = to_naive_utc(stay.get("dispatched_at") or stay.get("updated_at") or now)
+        else:
+            end = to_naive_utc(now)
+        chosen = telemetry_resolution(end - start) if resolution == "auto" else resolution
+        intervals.append((stay, start, end, chosen))
+    
+    # All stays are queried at once
+    series = await asyncio.gather(*(
+        temperature_series(stay["location"], start, end, chosen) for stay, start, end, chosen in intervals
+    ))
+    
+    result = []
+    for (stay, start, end, chosen), points in zip(intervals, series):
+        excursions = [p for p in points if p["max"] > TELEMETRY_MAX_TEMP_C]
+        result.append({
+            "inventory_id": stay["inventory_id"],
+            "location": stay["location"],
+            "start": start,
+            "end": end,
+            "resolution": chosen,
+            "summary": {
+                "min": min((p["min"] for p in points), default=None),
+                "max": max((p["max"] for p in points), default=None),
+                "avg": round(sum(p["avg"] for p in points) / len(points), 2) if points else None,
+                "max_allowed": TELEMETRY_MAX_TEMP_C,
+                "excursion_points": len(excursions),
+                "first_excursion": excursions[0]["t"] if excursions else None
+            },
+            "points": points
+        })
+    
+    return {"batch_id": batch_id, "stays": result}
+
+# ============ Archive (Cold Tier) ============
+
+# Shipped and paid records older than the retention window are moved out of
+# the hot collections into zstd-compressed Parquet files, one directory per
+# collection and month. The archive_partitions collection catalogues every
+# file with its date span, so readers only open the months a query touches.
+# pyarrow is imported on first use; workers that never read archived months
+# don't load it.
+ARCHIVE_DIR = Path(os.environ.get('ARCHIVE_DIR', ROOT_DIR / 'archive'))
+ARCHIVE_RETENTION = timedelta(days=int(os.environ.get('ARCHIVE_RETENTION_DAYS', '365')))
+ARCHIVE_CHUNK_ROWS = 5000
+ARCHIVE_LEASE_SECONDS = 3 * 3600  # Longer than any pass; a crashed holder is replaced after this
+ARCHIVE_DATE_FIELDS = {"intake_date", "dispatch_date", "payment_date", "created_at", "updated_at", "started_at", "completed_at"}
+
+ARCHIVE_SPECS = {
+    "batches": {"key": "batch_id", "date_field": "intake_date", "eligible": {"status": "SHIPPED"}},
+    # Stages go only once their batch has left the hot tier
+    "processing_stages": {"key": "stage_id", "date_field": "created_at", "eligible": {}, "parent": ("batches", "batch_id")},
+    "dispatches": {"key": "dispatch_id", "date_field": "dispatch_date", "eligible": {}},
+    "payments": {"key": "payment_id", "date_field": "created_at", "eligible": {"payment_status": "paid"}},
+}
+
+ARCHIVE_TOTALS = {
+    # collection -> {total: (field, only where)}. Stored per archive file, so
+    # dashboard totals add them up instead of opening the files.
+    "batches": {"weight_kg": ("weight_kg", None)},
+    "processing_stages": {"input_weight": ("input_weight", None), "output_weight": ("output_weight", None)},
+    "payments": {"net_amount": ("net_amount", None), "pending_amount": ("net_amount", {"payment_status": "pending"})},
+    "dispatches": {"selling_price": ("selling_price", None)},
+}
+
+LEASE_OWNER = f"{socket.gethostname()}:{os.getpid()}"
+
+async def acquire_lease(name: str, seconds: int) -> bool:
+    # One holder at a time across workers; expires if the holder dies
+    now = datetime.now(timezone.utc)
+    try:
+        await db.counters.find_one_and_update(
+            {"_id": f"lease:{name}", "$or": [{"expires_at": {"$lt": now}}, {"owner": LEASE_OWNER}]},
+            {"$set": {"owner": LEASE_OWNER, "expires_at": now + timedelta(seconds=seconds)}},
+            upsert=True
+        )
+        return True
+    except DuplicateKeyError:
+        return False
+
+async def release_lease(name: str):
+    # Expire it, so the next acquire_lease from any worker succeeds
+    await db.counters.update_one(
+        {"_id": f"lease:{name}", "owner": LEASE_OWNER},
+        {"$set": {"expires_at": datetime.now(timezone.utc) - timedelta(seconds=1)}, "$unset": {"owner": ""}}
+    )
+
+def to_naive_utc(value: datetime) -> datetime:
+    # Mongo hands back naive UTC datetimes; archives store the same
+    if value.tzinfo:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+def archive_record(doc: dict) -> dict:
+    record = {key: value for key, value in doc.items() if key != "_id"}
+    for key in ARCHIVE_DATE_FIELDS & record.keys():
+        value = record[key]
+        if isinstance(value, str):
+            value = datetime.fromisoformat(value)
+        if isinstance(value, datetime):
+            record[key] = to_naive_utc(value)
+    return record
+
+def write_archive_file(records: List[dict], path: Path):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(".tmp")
+    pq.write_table(pa.Table.from_pylist(records), tmp_path, compression="zstd")
+    os.replace(tmp_path, path)
+
+def read_archive_files(paths: List[Path], match: dict, date_field: str,
+                       start: Optional[datetime], end: Optional[datetime],
+                       columns: Optional[List[str]]) -> List[dict]:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+    
+    # Older files may lack fields added later; unify so they read as null
+    schema = pa.unify_schemas([pq.read_schema(path) for path in paths], promote_options="permissive")
+    if any(key not in schema.names for key in match):
+        return []
+    
+    conditions = [
+        ds.field(key).isin(value) if isinstance(value, list) else ds.field(key) == value
+        for key, value in match.items()
+    ]
+    if start:
+        conditions.append(ds.field(date_field) >= to_naive_utc(start))
+    if end:
+        conditions.append(ds.field(date_field) < to_naive_utc(end))
+    expression = None
+    for condition in conditions:
+        expression = condition if expression is None else expression & condition
+    
+    dataset = ds.dataset([str(path) for path in paths], schema=schema, format="parquet")
+    selected = [column for column in columns if column in schema.names] if columns else None
+    return dataset.to_table(columns=selected, filter=expression).to_pylist()
+
+async def partitions_holding_keys(key: str, partitions: List[dict], values: list) -> List[dict]:
+    # A file can only hold keys between its min_key and max_key, so a lookup
+    # by key (e.g. an expand= miss) opens just the files whose range covers
+    # one of the values; ids embed their date, so that is usually one month
+    # or none. Files catalogued before the range was stored get it once.
+    values = sorted({value for value in values if value is not None})
+    kept = []
+    for partition in partitions:
+        if "min_key" not in partition:
+            records = await asyncio.to_thread(
+                read_archive_files, [ARCHIVE_DIR / partition["path"]], {}, None, None, None, [key]
+            )
+            stored = [record[key] for record in records if record.get(key) is not None]
+            partition["min_key"], partition["max_key"] = (min(stored), max(stored)) if stored else (None, None)
+            await db.archive_partitions.update_one(
+                {"path": partition["path"]},
+                {"$set": {"min_key": partition["min_key"], "max_key": partition["max_key"]}}
+            )
+        if partition["min_key"] is None:
+            continue
+        index = bisect.bisect_left(values, partition["min_key"])
+        if index < len(values) and values[index] <= partition["max_key"]:
+            kept.append(partition)
+    return kept
+
+async def find_archived(collection: str, match: Optional[dict] = None,
+                        start: Optional[datetime] = None, end: Optional[datetime] = None,
+                        columns: Optional[List[str]] = None) -> List[dict]:
+    # match is equality per field (a list means "any of"); start/end bound
+    # the collection's date field. Only months overlapping the range are read.
+    spec = ARCHIVE_SPECS[collection]
+    
+    partition_query = {"collection": collection}
+    if start:
+        partition_query["max_date"] = {"$gte": to_naive_utc(start)}
+    if end:
+        partition_query["min_date"] = {"$lt": to_naive_utc(end)}
+    partitions = await db.archive_partitions.find(partition_query, {"_id": 0, "path": 1, "min_key": 1, "max_key": 1}).to_list(None)
+    keys = (match or {}).get(spec["key"])
+    if keys is not None and partitions:
+        partitions = await partitions_holding_keys(spec["key"], partitions, keys if isinstance(keys, list) else [keys])
+    if not partitions:
+        return []
+    
+    return await asyncio.to_thread(
+        read_archive_files, [ARCHIVE_DIR / p["path"] for p in partitions],
+        match or {}, spec["date_field"], start, end, columns and [*columns, spec["key"]]
+    )
+
+def archive_query(collection: str, match: Optional[dict], start: Optional[datetime], end: Optional[datetime]) -> dict:
+    # The same selection as find_archived, for the hot collection
+    query = {key: {"$in": value} if isinstance(value, list) else value for key, value in (match or {}).items()}
+    date_range = {}
+    if start:
+        date_range["$gte"] = start
+    if end:
+        date_range["$lt"] = end
+    if date_range:
+        query[ARCHIVE_SPECS[collection]["date_field"]] = date_range
+    return query
+
+def archive_totals(collection: str, records: List[dict]) -> dict:
+    totals = {"rows": len(records)}
+    for name, (field, where) in ARCHIVE_TOTALS[collection].items():
+        totals[name] = sum(
+            record.get(field) or 0 for record in records
+            if not where or all(record.get(key) == value for key, value in where.items())
+        )
+    return totals
+
+async def collection_totals(collection: str, start: Optional[datetime] = None, end: Optional[datetime] = None) -> dict:
+    # ARCHIVE_TOTALS plus "rows" over both tiers: one $group on the hot
+    # collection, the stored totals of archive files wholly inside the range,
+    # and only the files straddling start/end read row by row. A record
+    # caught between an archive file write and its hot delete counts twice
+    # until the pass completes.
+    spec = ARCHIVE_TOTALS[collection]
+    sums = {}
+    for name, (field, where) in spec.items():
+        value = f"${field}"
+        if where:
+            value = {"$cond": [{"$and": [{"$eq": [f"${key}", match]} for key, match in where.items()]}, value, 0]}
+        sums[name] = {"$sum": value}
+    hot = await analytics_db[collection].aggregate([
+        {"$match": archive_query(collection, None, start, end)},
+        {"$group": {"_id": None, "rows": {"$sum": 1}, **sums}}
+    ]).to_list(1)
+    totals = {name: hot[0][name] if hot else 0 for name in ["rows", *spec]}
+    
+    partition_query = {"collection": collection}
+    if start:
+        partition_query["max_date"] = {"$gte": to_naive_utc(start)}
+    if end:
+        partition_query["min_date"] = {"$lt": to_naive_utc(end)}
+    columns = list({field for field, _ in spec.values()} | {key for _, where in spec.values() for key in where or {}})
+    date_field = ARCHIVE_SPECS[collection]["date_field"]
+    straddling = []
+    for partition in await db.archive_partitions.find(partition_query, {"_id": 0}).to_list(None):
+        if ((start and to_naive_utc(partition["min_date"]) < to_naive_utc(start))
+                or (end and to_naive_utc(partition["max_date"]) >= to_naive_utc(end))):
+            straddling.append(ARCHIVE_DIR / partition["path"])
+            continue
+        if "totals" not in partition:
+            # Files written before totals were stored: summed once
+            records = await asyncio.to_thread(
+                read_archive_files, [ARCHIVE_DIR / partition["path"]], {}, date_field, None, None, columns
+            )
+            partition["totals"] = archive_totals(collection, records)
+            await db.archive_partitions.update_one({"path": partition["path"]}, {"$set": {"totals": partition["totals"]}})
+        for name in totals:
+            totals[name] += partition["totals"][name]
+    if straddling:
+        records = await asyncio.to_thread(read_archive_files, straddling, {}, date_field, start, end, columns)
+        for name, value in archive_totals(collection, records).items():
+            totals[name] += value
+    return totals
+
+async def find_with_archive(collection: str, match: Optional[dict] = None,
+                            start: Optional[datetime] = None, end: Optional[datetime] = None,
+                            columns: Optional[List[str]] = None) -> List[dict]:
+    # Hot and archived documents together
+    key = ARCHIVE_SPECS[collection]["key"]
+    projection = {"_id": 0, **({column: 1 for column in [*columns, key]} if columns else {})}
+    hot = await analytics_db[collection].find(archive_query(collection, match, start, end), projection).to_list(None)
+    
+    # A re-run after an interrupted archive pass can leave the same record
+    # in two files, or still in the hot tier; keep one copy
+    seen = {doc.get(key) for doc in hot}
+    for doc in await find_archived(collection, match, start, end, columns):
+        if doc.get(key) not in seen:
+            seen.add(doc.get(key))
+            hot.append(doc)
+    return hot
+
+async def archive_collection(collection: str, cutoff: datetime) -> int:
+    spec = ARCHIVE_SPECS[collection]
+    query = {**spec["eligible"], spec["date_field"]: {"$lt": cutoff}}
+    archived = 0
+    last_id = None
+    
+    while True:
+        page_query = {**query, "_id": {"$gt": last_id}} if last_id else query
+        docs = await db[collection].find(page_query).sort("_id", 1).limit(ARCHIVE_CHUNK_ROWS).to_list(ARCHIVE_CHUNK_ROWS)
+        if not docs:
+            return archived
+        last_id = docs[-1]["_id"]
+        
+        if "parent" in spec:
+            parent_collection, parent_key = spec["parent"]
+            still_hot = {
+                parent[parent_key] for parent in await db[parent_collection].find(
+                    {parent_key: {"$in": list({doc[parent_key] for doc in docs})}}, {"_id": 0, parent_key: 1}
+                ).to_list(None)
+            }
+            docs = [doc for doc in docs if doc[parent_key] not in still_hot]
+            if not docs:
+                continue
+        
+        by_month = defaultdict(list)
+        for doc in docs:
+            record = archive_record(doc)
+            by_month[record[spec["date_field"]].strftime("%Y-%m")].append((doc["_id"], record))
+        
+        for month, entries in by_month.items():
+            # Named after the first _id, so re-running an interrupted chunk
+            # overwrites the same file instead of adding a copy
+            relative_path = f"{collection}/month={month}/part-{entries[0][0]}.parquet"
+            records = [record for _, record in entries]
+            await asyncio.to_thread(write_archive_file, records, ARCHIVE_DIR / relative_path)
+            
+            dates = [record[spec["date_field"]] for record in records]
+            keys = [record[spec["key"]] for record in records]
+            await db.archive_partitions.update_one(
+                {"path": relative_path},
+                {"$set": {
+                    "collection": collection,
+                    "month": month,
+                    "rows": len(records),
+                    "totals": archive_totals(collection, records),
+                    "min_date": min(dates),
+                    "max_date": max(dates),
+                    "min_key": min(keys),
+                    "max_key": max(keys),
+                    "archived_at": datetime.now(timezone.utc)
+                }},
+                upsert=True
+            )
+            # Only removed from the hot tier once the file and its catalogue
+            # entry exist
+            await db[collection].delete_many({"_id": {"$in": [_id for _id, _ in entries]}})
+            await record_events([event_doc(collection, "archived", record[spec["key"]], {"path": relative_path}) for record in records])
+            archived += len(records)
+
+archive_pass_lock = asyncio.Lock()
+
+async def run_archive_pass() -> Dict[str, int]:
+    cutoff = datetime.now(timezone.utc) - ARCHIVE_RETENTION
+    result = {}
+    async with archive_pass_lock:
+        for collection in ARCHIVE_SPECS:
+            result[collection] = await archive_collection(collection, cutoff)
+    if any(result.values()):
+        response_cache.invalidate(*ARCHIVE_SPECS)
+        logger.info(f"Archived records older than {cutoff:%Y-%m-%d}: {result}")
+    return result
+
+async def run_archiver(interval_seconds: int):
+    while True:
+        try:
+            if await acquire_lease("archiver", ARCHIVE_LEASE_SECONDS):
+                try:
+                    await run_archive_pass()
+                finally:
+                    await release_lease("archiver")
+        except ImportError:
+            logger.warning("pyarrow is not installed; archiving disabled")
+            return
+        except Exception:
+            logger.exception("Archive pass failed")
+        await asyncio.sleep(interval_seconds)
+
+@api_router.post("/archive/run")
+async def run_archive(user: dict = Depends(get_current_user)):
+    if user["role"] not in ["owner", "admin"]:
+        raise HTTPException(status_code=403, detail="Owner/Admin access required")
+    
+    if archive_pass_lock.locked() or not await acquire_lease("archiver", ARCHIVE_LEASE_SECONDS):
+        raise HTTPException(status_code=409, detail="An archive pass is already running")
+    
+    try:
+        return {"archived": await run_archive_pass()}
+    finally:
+        await release_lease("archiver")
+
+@api_router.get("/archive/partitions")
+async def get_archive_partitions(user: dict = Depends(get_current_user)):
+    if user["role"] not in ["owner", "admin"]:
+        raise HTTPException(status_code=403, detail="Owner/Admin access required")
+    
+    return await db.archive_partitions.aggregate([
+        {"$group": {
+            "_id": {"collection": "$collection", "month": "$month"},
+            "files": {"$sum": 1},
+            "rows": {"$sum": "$rows"}
+        }},
+        {"$project": {"_id": 0, "collection": "$_id.collection", "month": "$_id.month", "files": 1, "rows": 1}},
+        {"$sort": {"collection": 1, "month": 1}}
+    ]).to_list(None)
+
+# ============ Yield Analytics ============
+
+# Flags processing stages whose yield is far from what comparable stages
+# achieved just before them. Each stage is scored against two rolling
+# baselines, the previous YIELD_BASELINE_WINDOW stages of its group:
+#   stage_grade     same stage_name and size grade (what the material allows)
+#   stage_operator  same stage_name and assigned_person (that person's norm)
+# A stage is flagged when its yield is more than YIELD_Z_THRESHOLD standard
+# deviations from either. Stages are loaded in columnar chunks and scored
+# with NumPy; flags are kept in yield_anomalies.
+YIELD_BASELINES = {
+    "stage_grade": ("stage_name", "size_grade"),
+    "stage_operator": ("stage_name", "assigned_person"),
+}
+YIELD_BASELINE_WINDOW = int(os.environ.get('YIELD_BASELINE_WINDOW', '200'))
+YIELD_MIN_HISTORY = 20
+YIELD_MIN_STD = 1.0  # Percentage points, so very steady groups don't flag noise
+YIELD_Z_THRESHOLD = float(os.environ.get('YIELD_Z_THRESHOLD', '3.5'))
+YIELD_LOOKBACK_DAYS = int(os.environ.get('YIELD_LOOKBACK_DAYS', '180'))
+YIELD_LOAD_CHUNK = 50_000
+YIELD_CATEGORIES = ("stage_name", "assigned_person", "size_grade")
+
+async def load_stage_columns(since: datetime) -> tuple:
+    # One array per field. Names and grades are stored as integer codes
+    # (labels[field][code] is the value), so grouping never sorts strings.
+    # size_grade is joined from batches per chunk.
+    cursor = analytics_db.processing_stages.find(
+        {"created_at": {"$gte": since}},
+        {"_id": 0, "stage_id": 1, "batch_id": 1, "stage_name": 1, "assigned_person": 1,
+         "input_weight": 1, "output_weight": 1, "created_at": 1},
+        batch_size=YIELD_LOAD_CHUNK
+    )
+    labels = {field: {} for field in YIELD_CATEGORIES}
+    
+    def codes(field: str, values) -> "np.ndarray":
+        vocabulary = labels[field]
+        return np.array([vocabulary.setdefault(value, len(vocabulary)) for value in values], dtype="int64")
+    
+    chunks = []
+    while rows := await cursor.to_list(YIELD_LOAD_CHUNK):
+        grades = {
+            b["batch_id"]: b["size_grade"]
+            async for b in analytics_db.batches.find(
+                {"batch_id": {"$in": list({r["batch_id"] for r in rows})}},
+                {"_id": 0, "batch_id": 1, "size_grade": 1}
+            )
+        }
+        chunks.append({
+            "stage_id": np.array([r["stage_id"] for r in rows], dtype=object),
+            "batch_id": np.array([r["batch_id"] for r in rows], dtype=object),
+            "stage_name": codes("stage_name", (r["stage_name"] for r in rows)),
+            "assigned_person": codes("assigned_person", (r["assigned_person"] for r in rows)),
+            "size_grade": codes("size_grade", (grades.get(r["batch_id"], "unknown") for r in rows)),
+            "input_weight": np.array([r["input_weight"] for r in rows], dtype=float),
+            "output_weight": np.array([r["output_weight"] for r in rows], dtype=float),
+            "created_at": np.array([to_naive_utc(r["created_at"]) for r in rows], dtype="datetime64[ms]"),
+        })
+    if not chunks:
+        return {}, {}
+    columns = {field: np.concatenate([chunk[field] for chunk in chunks]) for field in chunks[0]}
+    return columns, {field: list(vocabulary) for field, vocabulary in labels.items()}
+
+def rolling_baseline(groups: "np.ndarray", times: "np.ndarray", values: "np.ndarray", window: int) -> tuple:
+    # Mean and std of the previous `window` values of the same group, for
+    # every row. Rows are put in (group, time) order once; the window sums
+    # then come from prefix sums, with no per-row Python work.
+    order = np.lexsort((times, groups))
+    ordered = values[order]
+    sorted_groups = groups[order]
+    position = np.arange(len(ordered))
+    
+    group_start = np.maximum.accumulate(
+        np.where(np.r_[True, sorted_groups[1:] != sorted_groups[:-1]], position, 0)
+    )
+    window_start = np.maximum(group_start, position - window)
+    count = position - window_start
+    sums = np.r_[0.0, np.cumsum(ordered)]
+    squares = np.r_[0.0, np.cumsum(ordered * ordered)]
+    total = sums[position] - sums[window_start]
+    total_squares = squares[position] - squares[window_start]
+    
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = total / count
+        std = np.sqrt(np.maximum(total_squares - count * mean * mean, 0.0) / (count - 1))
+    mean[count < YIELD_MIN_HISTORY] = np.nan
+    std = np.maximum(np.nan_to_num(std), YIELD_MIN_STD)
+    
+    # Back to the caller's row order
+    baseline_mean = np.empty_like(mean)
+    baseline_std = np.empty_like(std)
+    baseline_mean[order] = mean
+    baseline_std[order] = std
+    return baseline_mean, baseline_std
+
+def score_yields(columns: Dict[str, "np.ndarray"], labels: Dict[str, List[str]]) -> List[dict]:
+    usable = columns["input_weight"] > 0
+    columns = {field: values[usable] for field, values in columns.items()}
+    yields = columns["output_weight"] / columns["input_weight"] * 100
+    times = columns["created_at"].astype("int64")
+    
+    scores = {}
+    for name, (first, second) in YIELD_BASELINES.items():
+        groups = columns[first] * len(labels[second]) + columns[second]
+        mean, std = rolling_baseline(groups, times, yields, YIELD_BASELINE_WINDOW)
+        scores[name] = (mean, std, (yields - mean) / std)
+    
+    with np.errstate(invalid="ignore"):
+        worst = np.fmax.reduce([np.abs(z) for _, _, z in scores.values()])
+        flagged = np.flatnonzero(worst > YIELD_Z_THRESHOLD)
+    
+    now = datetime.now(timezone.utc)
+    flags = []
+    for i in flagged.tolist():
+        baselines = {
+            name: {"mean": round(float(mean[i]), 2), "std": round(float(std[i]), 2), "z": round(float(z[i]), 2)}
+            for name, (mean, std, z) in scores.items() if not np.isnan(z[i])
+        }
+        flags.append({
+            "stage_id": columns["stage_id"][i],
+            "batch_id": columns["batch_id"][i],
+            **{field: labels[field][columns[field][i]] for field in YIELD_CATEGORIES},
+            "yield_percentage": round(float(yields[i]), 2),
+            "wastage": round(float(columns["input_weight"][i] - columns["output_weight"][i]), 2),
+            "direction": "low" if max(baselines.values(), key=lambda b: abs(b["z"]))["z"] < 0 else "high",
+            "severity": round(float(worst[i]), 2),
+            "baselines": baselines,
+            "created_at": columns["created_at"][i].astype(datetime),
+            "detected_at": now
+        })
+    return flags
+
+yield_analysis_lock = asyncio.Lock()
+
+async def run_yield_analysis_pass() -> dict:
+    since = to_naive_utc(datetime.now(timezone.utc) - timedelta(days=YIELD_LOOKBACK_DAYS))
+    async with yield_analysis_lock:
+        started = time.perf_counter()
+        columns, labels = await load_stage_columns(since)
+        loaded = time.perf_counter()
+        flags = await asyncio.to_thread(score_yields, columns, labels) if columns else []
+        scored = time.perf_counter()
+        
+        if flags:
+            await db.yield_anomalies.bulk_write(
+                [UpdateOne({"stage_id": flag["stage_id"]}, {"$set": flag}, upsert=True) for flag in flags],
+                ordered=False
+            )
+        # Stages inside the window that no longer stand out lose their flag
+        await db.yield_anomalies.delete_many(
+            {"created_at": {"$gte": since}, "stage_id": {"$nin": [flag["stage_id"] for flag in flags]}}
+        )
+    
+    result = {
+        "stages": len(columns.get("stage_id", [])),
+        "flagged": len(flags),
+        "load_ms": round((loaded - started) * 1000, 1),
+        "score_ms": round((scored - loaded) * 1000, 1)
+    }
+    logger.info(f"Yield analysis: {result}")
+    return result
+
+async def run_yield_analyzer(interval_seconds: int):
+    while True:
+        try:
+            if await acquire_lease("yield-anomalies", interval_seconds):
+                await run_yield_analysis_pass()
+        except Exception:
+            logger.exception("Yield analysis failed")
+        await asyncio.sleep(interval_seconds)
+
+@api_router.post("/analytics/yield-anomalies/run")
+async def run_yield_analysis(user: dict = Depends(get_current_user)):
+    if user["role"] not in ["owner", "admin"]:
+        raise HTTPException(status_code=403, detail="Owner/Admin access required")
+    
+    if yield_analysis_lock.locked() or not await acquire_lease("yield-anomalies", 600):
+        raise HTTPException(status_code=409, detail="Yield analysis is already running")
+    
+    return await run_yield_analysis_pass()
+
+@api_router.get("/analytics/yield-anomalies")
+async def get_yield_anomalies(
+    stage_name: Optional[str] = None,
+    assigned_person: Optional[str] = None,
+    size_grade: Optional[str] = None,
+    direction: Optional[str] = None,
+    since: Optional[datetime] = None,
+    limit: int = 100,
+    user: dict = Depends(get_current_user)
+):
+    query = {}
+    for field, value in (("stage_name", stage_name), ("assigned_person", assigned_person),
+                         ("size_grade", size_grade), ("direction", direction)):
+        if value:
+            query[field] = value
+    if since:
+        query["created_at"] = {"$gte": to_naive_utc(since)}
+    
+    flags = await analytics_db.yield_anomalies.find(query, {"_id": 0}).sort("created_at", -1).to_list(min(limit, 1000))
+    by_person = await analytics_db.yield_anomalies.aggregate([
+        {"$match": query},
+        {"$group": {"_id": "$assigned_person", "flags": {"$sum": 1},
+                    "low": {"$sum": {"$cond": [{"$eq": ["$direction", "low"]}, 1, 0]}}}},
+        {"$sort": {"flags": -1}},
+        {"$limit": 20},
+        {"$project": {"_id": 0, "assigned_person": "$_id", "flags": 1, "low": 1}}
+    ]).to_list(None)
+    
+    return {"anomalies": flags, "by_person": by_person}
+
 # ============ Dashboard Routes ============
 
-@api_router.get("/dashboard/admin")
-async def get_admin_dashboard(user: dict = Depends(get_current_user)):
-    # Total procurement
-    batches = await db.batches.find({}, {"_id": 0}).to_list(10000)
-    total_procurement = sum(b["weight_kg"] for b in batches)
-    
-    # Calculate yield
-    stages = await db.processing_stages.find({}, {"_id": 0}).to_list(10000)
-    total_input = sum(s["input_weight"] for s in stages)
-    total_output = sum(s["output_weight"] for s in stages)
-    yield_percentage = (total_output / total_input * 100) if total_input > 0 else 0
-    
-    # Farmer payments
-    payments = await db.payments.find({}, {"_id": 0}).to_list(10000)
-    total_payments = sum(p["net_amount"] for p in payments)
-    pending_payments = sum(p["net_amount"] for p in payments if p["payment_status"] == "pending")
+async def compute_admin_dashboard(start: Optional[datetime] = None, end: Optional[datetime] = None) -> dict:
+    # Totals span the hot and archived tiers, summed without loading rows
+    batches = await collection_totals("batches", start, end)
+    stages = await collection_totals("processing_stages", start, end)
+    payments = await collection_totals("payments", start, end)
+    dispatches = await collection_totals("dispatches", start, end)
     
-    # Selling price (average from dispatches)
-    dispatches = await db.dispatches.find({}, {"_id": 0}).to_list(10000)
-    avg_selling_price = sum(d["selling_price"] for d in dispatches) / len(dispatches) if dispatches else 0
+    total_input = stages["input_weight"]
+    yield_percentage = (stages["output_weight"] / total_input * 100) if total_input > 0 else 0
     
     return {
-        "total_procurement": total_procurement,
+        "total_procurement": batches["weight_kg"],
         "yield_percentage": yield_percentage,
-        "total_payments": total_payments,
-        "pending_payments": pending_payments,
-        "avg_selling_price": avg_selling_price,
-        "total_batches": len(batches),
-        "total_farmers": await db.farmers.count_documents({}),
-        "total_dispatches": len(dispatches)
+        "total_payments": payments["net_amount"],
+        "pending_payments": payments["pending_amount"],
+        "avg_selling_price": dispatches["selling_price"] / dispatches["rows"] if dispatches["rows"] else 0,
+        "total_batches": batches["rows"],
+        "total_farmers": await analytics_db.farmers.count_documents({}),
+        "total_dispatches": dispatches["rows"]
     }
 
+@api_router.get("/dashboard/admin")
+async def get_admin_dashboard(
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    user: dict = Depends(get_current_user)
+):
+    return await response_cache.get_or_compute(
+        ("GET /dashboard/admin", user["role"], start, end),
+        {"batches", "processing_stages", "payments", "dispatches", "farmers"},
+        lambda: compute_admin_dashboard(start, end),
+        ttl=float(os.environ.get('DASHBOARD_CACHE_TTL_SECONDS', '10')),
+        db_queries=5
+    )
+
+@api_router.get("/admission/stats")
+async def get_admission_stats(user: dict = Depends(get_current_user)):
+    if user["role"] not in ["owner", "admin"]:
+        raise HTTPException(status_code=403, detail="Owner/Admin access required")
+    
+    return admission_controller.report()
+
+@api_router.get("/cache/stats")
+async def get_cache_stats(user: dict = Depends(get_current_user)):
+    if user["role"] not in ["owner", "admin"]:
+        raise HTTPException(status_code=403, detail="Owner/Admin access required")
+    
+    return response_cache.report()
+
 # ============ Export Routes ============
 
+EXPORT_MEDIA_TYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+# Background export jobs write their files here and keep them for the
+# retention window. Jobs stuck in "running" past the timeout (a worker died
+# mid-export) are marked failed so identical requests can start a new one.
+EXPORT_DIR = Path(os.environ.get('EXPORT_DIR', ROOT_DIR / 'exports'))
+EXPORT_WORKERS = int(os.environ.get('EXPORT_WORKERS', '2'))
+EXPORT_RETENTION = timedelta(hours=int(os.environ.get('EXPORT_RETENTION_HOURS', '24')))
+EXPORT_JOB_TIMEOUT = timedelta(minutes=int(os.environ.get('EXPORT_JOB_TIMEOUT_MINUTES', '30')))
+EXPORT_POLL_SECONDS = 5
+EXPORT_CHUNK_SIZE = 64 * 1024
+
+export_job_wakeup = asyncio.Event()
+
+def batch_export_row(batch: dict) -> list:
+    intake_date = batch["intake_date"]
+    if isinstance(intake_date, str):
+        intake_date = datetime.fromisoformat(intake_date)
+    
+    return [
+        batch["batch_id"],
+        batch["farmer_id"],
+        batch["weight_kg"],
+        batch["size_grade"],
+        intake_date.strftime("%Y-%m-%d %H:%M:%S"),
+        batch["location"],
+        batch["status"]
+    ]
+
+def payment_export_row(payment: dict) -> list:
+    return [
+        payment["payment_id"],
+        payment["farmer_id"],
+        payment["batch_id"],
+        payment["total_prawns"],
+        payment["price_per_kg"],
+        payment["gross_amount"],
+        payment["deductions"],
+        payment["net_amount"],
+        payment["payment_status"]
+    ]
+
+def processing_export_row(stage: dict) -> list:
+    yield_pct = stage.get("yield_percentage", 0)
+    
+    return [
+        stage["stage_id"],
+        stage["batch_id"],
+        stage["stage_name"],
+        stage["assigned_person"],
+        stage["input_weight"],
+        stage["output_weight"],
+        stage["wastage"],
+        f"{yield_pct:.2f}%",
+        stage["status"]
+    ]
+
+EXPORT_SPECS = {
+    "batches": {
+        "collection": "batches",
+        "title": "Batches",
+        "headers": ["Batch ID", "Farmer ID", "Weight (kg)", "Size Grade", "Intake Date", "Location", "Status"],
+        "row": batch_export_row,
+        "currency_columns": [],
+    },
+    "payments": {
+        "collection": "payments",
+        "title": "Payments",
+        "headers": ["Payment ID", "Farmer ID", "Batch ID", "Total Prawns (kg)", "Price/kg", "Gross Amount", "Deductions", "Net Amount", "Status"],
+        "row": payment_export_row,
+        "currency_columns": [5, 6, 7, 8],
+    },
+    "processing": {
+        "collection": "processing_stages",
+        "title": "Processing Stages",
+        "headers": ["Stage ID", "Batch ID", "Stage Name", "Assigned Person", "Input Weight", "Output Weight", "Wastage", "Yield %", "Status"],
+        "row": processing_export_row,
+        "currency_columns": [],
+    },
+}
+
 def create_styled_header(worksheet, headers: List[str]):
-    header_fill = PatternFill(
+    header_fill = openpyxl.styles.PatternFill(
         start_color="0F172A",
         end_color="0F172A",
         fill_type="solid"
     )
-    header_font = Font(bold=True, color="FFFFFF", size=12)
-    header_alignment = Alignment(horizontal="center", vertical="center")
+    header_font = openpyxl.styles.Font(bold=True, color="FFFFFF", size=12)
+    header_alignment = openpyxl.styles.Alignment(horizontal="center", vertical="center")
     
+    cells = []
     for col_num, header in enumerate(headers, 1):
-        cell = worksheet.cell(row=1, column=col_num)
-        cell.value = header
+        cell = openpyxl.cell.WriteOnlyCell(worksheet, value=header)
         cell.fill = header_fill
         cell.font = header_font
         cell.alignment = header_alignment
-        worksheet.column_dimensions[cell.column_letter].width = 18
+        cells.append(cell)
+        worksheet.column_dimensions[openpyxl.utils.get_column_letter(col_num)].width = 18
     
+    worksheet.append(cells)
     return worksheet
 
-@api_router.post("/export/batches")
-async def export_batches(user: dict = Depends(get_current_user)):
-    batches = await db.batches.find({}, {"_id": 0}).to_list(10000)
-    
-    workbook = Workbook()
-    worksheet = workbook.active
-    worksheet.title = "Batches"
-    
-    headers = ["Batch ID", "Farmer ID", "Weight (kg)", "Size Grade", "Intake Date", "Location", "Status"]
-    worksheet = create_styled_header(worksheet, headers)
-    
-    for row_num, batch in enumerate(batches, 2):
-        intake_date = batch["intake_date"]
-        if isinstance(intake_date, str):
-            intake_date = datetime.fromisoformat(intake_date)
-        
-        row_data = [
-            batch["batch_id"],
-            batch["farmer_id"],
-            batch["weight_kg"],
-            batch["size_grade"],
-            intake_date.strftime("%Y-%m-%d %H:%M:%S"),
-            batch["location"],
-            batch["status"]
-        ]
-        
-        for col_num, value in enumerate(row_data, 1):
-            cell = worksheet.cell(row=row_num, column=col_num)
-            cell.value = value
-            cell.alignment = Alignment(horizontal="left", vertical="center")
+async def write_export_workbook(kind: str, target, start: Optional[datetime] = None, end: Optional[datetime] = None) -> int:
+    # Streams rows from a cursor into a write-only workbook, so memory stays
+    # flat no matter how many documents are exported. Archived months in the
+    # range follow the hot rows.
+    spec = EXPORT_SPECS[kind]
+    collection = spec["collection"]
+    key = ARCHIVE_SPECS[collection]["key"]
     
-    buffer = BytesIO()
-    workbook.save(buffer)
-    buffer.seek(0)
+    workbook = openpyxl.Workbook(write_only=True)
+    worksheet = workbook.create_sheet(spec["title"])
+    create_styled_header(worksheet, spec["headers"])
+    row_alignment = openpyxl.styles.Alignment(horizontal="left", vertical="center")
     
-    filename = f"batches_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
+    def append_row(doc: dict):
+        cells = []
+        for col_num, value in enumerate(spec["row"](doc), 1):
+            cell = openpyxl.cell.WriteOnlyCell(worksheet, value=value)
+            cell.alignment = row_alignment
+            if col_num in spec["currency_columns"]:
+                cell.number_format = '$#,##0.00'
+            cells.append(cell)
+        worksheet.append(cells)
     
-    return StreamingResponse(
-        iter([buffer.getvalue()]),
-        media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-        headers={"Content-Disposition": f"attachment; filename={filename}"}
-    )
-
-@api_router.post("/export/payments")
-async def export_payments(user: dict = Depends(get_current_user)):
-    payments = await db.payments.find({}, {"_id": 0}).to_list(10000)
-    
-    workbook = Workbook()
-    worksheet = workbook.active
-    worksheet.title = "Payments"
-    
-    headers = ["Payment ID", "Farmer ID", "Batch ID", "Total Prawns (kg)", "Price/kg", "Gross Amount", "Deductions", "Net Amount", "Status"]
-    worksheet = create_styled_header(worksheet, headers)
-    
-    for row_num, payment in enumerate(payments, 2):
-        row_data = [
-            payment["payment_id"],
-            payment["farmer_id"],
-            payment["batch_id"],
-            payment["total_prawns"],
-            payment["price_per_kg"],
-            payment["gross_amount"],
-            payment["deductions"],
-            payment["net_amount"],
-            payment["payment_status"]
-        ]
-        
-        for col_num, value in enumerate(row_data, 1):
-            cell = worksheet.cell(row=row_num, column=col_num)
-            cell.value = value
-            cell.alignment = Alignment(horizontal="left", vertical="center")
+    seen = set()
+    async for doc in analytics_db[collection].find(archive_query(collection, None, start, end), {"_id": 0}):
+        append_row(doc)
+        seen.add(doc[key])
+    for doc in await find_archived(collection, None, start, end):
+        if doc[key] not in seen:
+            seen.add(doc[key])
+            append_row(doc)
+    
+    await asyncio.to_thread(workbook.save, target)
+    return len(seen)
+
+def export_filename(kind: str) -> str:
+    return f"{kind}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
+
+async def enqueue_export_job(kind: str, user: dict, start: Optional[datetime] = None, end: Optional[datetime] = None) -> dict:
+    # Only one queued/running job per kind and range may hold active_key
+    # (unique index), so identical concurrent requests all get the same job
+    active_key = f"{kind}:{start.isoformat() if start else ''}:{end.isoformat() if end else ''}"
+    for _ in range(3):
+        job_doc = {
+            "job_id": f"export_{uuid.uuid4().hex[:12]}",
+            "kind": kind,
+            "start": start,
+            "end": end,
+            "status": "queued",
+            "active_key": active_key,
+            "requested_by": user["user_id"],
+            "rows": None,
+            "size_bytes": None,
+            "filename": None,
+            "error": None,
+            "created_at": datetime.now(timezone.utc),
+            "started_at": None,
+            "finished_at": None,
+            "expires_at": None
+        }
+        try:
+            await db.export_jobs.insert_one(job_doc)
+            job_doc.pop("_id", None)
+            export_job_wakeup.set()
+            return job_doc
+        except DuplicateKeyError:
+            existing = await db.export_jobs.find_one({"active_key": active_key}, {"_id": 0})
+            if existing:
+                return existing
+            # The active job finished in between; try again
+    
+    raise HTTPException(status_code=503, detail="Could not queue export, please retry")
+
+async def process_export_job(job: dict):
+    EXPORT_DIR.mkdir(parents=True, exist_ok=True)
+    path = EXPORT_DIR / f"{job['job_id']}.xlsx"
+    
+    try:
+        rows = await write_export_workbook(job["kind"], path, job.get("start"), job.get("end"))
+        update = {
+            "status": "done",
+            "rows": rows,
+            "size_bytes": path.stat().st_size,
+            "filename": export_filename(job["kind"])
+        }
+    except Exception as e:
+        logger.exception(f"Export job {job['job_id']} failed")
+        path.unlink(missing_ok=True)
+        update = {"status": "failed", "error": str(e)}
+    
+    now = datetime.now(timezone.utc)
+    await db.export_jobs.update_one(
+        {"job_id": job["job_id"]},
+        {
+            "$set": {**update, "finished_at": now, "expires_at": now + EXPORT_RETENTION},
+            "$unset": {"active_key": ""}
+        }
+    )
+
+async def run_export_worker():
+    while True:
+        try:
+            export_job_wakeup.clear()
+            job = await db.export_jobs.find_one_and_update(
+                {"status": "queued"},
+                {"$set": {"status": "running", "started_at": datetime.now(timezone.utc)}},
+                sort=[("created_at", 1)],
+                projection={"_id": 0},
+                return_document=ReturnDocument.AFTER
+            )
             
-            if col_num in [5, 6, 7, 8]:  # Currency columns
-                cell.number_format = '$#,##0.00'
+            if not job:
+                # Woken early by enqueue_export_job in this process; the poll
+                # picks up jobs queued by other workers
+                try:
+                    await asyncio.wait_for(export_job_wakeup.wait(), timeout=EXPORT_POLL_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            
+            await process_export_job(job)
+        except Exception:
+            # A database outage must not end the worker; a job it left
+            # running is failed by cleanup_export_jobs after the timeout
+            logger.exception("Export worker pass failed")
+            await asyncio.sleep(EXPORT_POLL_SECONDS)
+
+async def cleanup_export_jobs():
+    now = datetime.now(timezone.utc)
+    
+    await db.export_jobs.update_many(
+        {"status": "running", "started_at": {"$lt": now - EXPORT_JOB_TIMEOUT}},
+        {
+            "$set": {"status": "failed", "error": "Export timed out", "finished_at": now, "expires_at": now + EXPORT_RETENTION},
+            "$unset": {"active_key": ""}
+        }
+    )
+    
+    expired = await db.export_jobs.find({"expires_at": {"$lt": now}}, {"_id": 0, "job_id": 1}).to_list(None)
+    for job in expired:
+        (EXPORT_DIR / f"{job['job_id']}.xlsx").unlink(missing_ok=True)
+    if expired:
+        await db.export_jobs.delete_many({"job_id": {"$in": [job["job_id"] for job in expired]}})
+
+async def run_export_cleanup(interval_seconds: int = 600):
+    while True:
+        try:
+            await cleanup_export_jobs()
+        except Exception:
+            logger.exception("Export job cleanup failed")
+        await asyncio.sleep(interval_seconds)
+
+def iter_file_range(path: Path, start: int, length: int):
+    with open(path, "rb") as f:
+        f.seek(start)
+        while length > 0:
+            chunk = f.read(min(EXPORT_CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+def parse_byte_range(range_header: str, size: int) -> tuple:
+    match = re.fullmatch(r"bytes=(\d*)-(\d*)", range_header.strip())
+    if not match or not any(match.groups()):
+        raise HTTPException(status_code=416, detail="Invalid range", headers={"Content-Range": f"bytes */{size}"})
+    
+    first, last = match.groups()
+    if not first:
+        # Suffix range: the last N bytes
+        start, end = max(size - int(last), 0), size - 1
+    else:
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+    
+    if start >= size or start > end:
+        raise HTTPException(status_code=416, detail="Range not satisfiable", headers={"Content-Range": f"bytes */{size}"})
+    
+    return start, end
+
+@api_router.post("/export/{kind}")
+async def export_data(
+    kind: str,
+    response: Response,
+    background: bool = False,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    user: dict = Depends(get_current_user)
+):
+    if kind not in EXPORT_SPECS:
+        raise HTTPException(status_code=404, detail="Unknown export")
+    
+    if background:
+        job = await enqueue_export_job(kind, user, start, end)
+        response.status_code = 202
+        return ExportJob(**job)
     
     buffer = BytesIO()
-    workbook.save(buffer)
+    await write_export_workbook(kind, buffer, start, end)
     buffer.seek(0)
     
-    filename = f"payments_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
-    
     return StreamingResponse(
         iter([buffer.getvalue()]),
-        media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-        headers={"Content-Disposition": f"attachment; filename={filename}"}
-    )
-
-@api_router.post("/export/processing")
-async def export_processing(user: dict = Depends(get_current_user)):
-    stages = await db.processing_stages.find({}, {"_id": 0}).to_list(10000)
-    
-    workbook = Workbook()
-    worksheet = workbook.active
-    worksheet.title = "Processing Stages"
-    
-    headers = ["Stage ID", "Batch ID", "Stage Name", "Assigned Person", "Input Weight", "Output Weight", "Wastage", "Yield %", "Status"]
-    worksheet = create_styled_header(worksheet, headers)
-    
-    for row_num, stage in enumerate(stages, 2):
-        yield_pct = stage.get("yield_percentage", 0)
-        
-        row_data = [
-            stage["stage_id"],
-            stage["batch_id"],
-            stage["stage_name"],
-            stage["assigned_person"],
-            stage["input_weight"],
-            stage["output_weight"],
-            stage["wastage"],
-            f"{yield_pct:.2f}%",
-            stage["status"]
-        ]
-        
-        for col_num, value in enumerate(row_data, 1):
-            cell = worksheet.cell(row=row_num, column=col_num)
-            cell.value = value
-            cell.alignment = Alignment(horizontal="left", vertical="center")
+        media_type=EXPORT_MEDIA_TYPE,
+        headers={"Content-Disposition": f"attachment; filename={export_filename(kind)}"}
+    )
+
+@api_router.get("/export/jobs/{job_id}", response_model=ExportJob)
+async def get_export_job(job_id: str, user: dict = Depends(get_current_user)):
+    job = await db.export_jobs.find_one({"job_id": job_id}, {"_id": 0})
     
-    buffer = BytesIO()
-    workbook.save(buffer)
-    buffer.seek(0)
+    if not job:
+        raise HTTPException(status_code=404, detail="Export job not found")
+    
+    return ExportJob(**job)
+
+@api_router.get("/export/jobs/{job_id}/download")
+async def download_export_job(job_id: str, request: Request, user: dict = Depends(get_current_user)):
+    job = await db.export_jobs.find_one({"job_id": job_id}, {"_id": 0})
+    
+    if not job:
+        raise HTTPException(status_code=404, detail="Export job not found")
+    
+    if job["status"] != "done":
+        raise HTTPException(status_code=409, detail=f"Export is {job['status']}")
     
-    filename = f"processing_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
+    path = EXPORT_DIR / f"{job_id}.xlsx"
+    if not path.exists():
+        raise HTTPException(status_code=410, detail="Export file has expired")
+    
+    size = path.stat().st_size
+    headers = {
+        "Accept-Ranges": "bytes",
+        "Content-Disposition": f"attachment; filename={job['filename']}"
+    }
+    
+    range_header = request.headers.get("range")
+    if not range_header:
+        return StreamingResponse(
+            iter_file_range(path, 0, size),
+            media_type=EXPORT_MEDIA_TYPE,
+            headers={**headers, "Content-Length": str(size)}
+        )
+    
+    start, end = parse_byte_range(range_header, size)
+    length = end - start + 1
     
     return StreamingResponse(
-        iter([buffer.getvalue()]),
-        media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-        headers={"Content-Disposition": f"attachment; filename={filename}"}
+        iter_file_range(path, start, length),
+        status_code=206,
+        media_type=EXPORT_MEDIA_TYPE,
+        headers={**headers, "Content-Length": str(length), "Content-Range": f"bytes {start}-{end}/{size}"}
     )
 
+# ============ App Lifecycle ============
+
+background_tasks = []
+
+async def create_unique_index(collection, field: str, **options) -> bool:
+    # Building a unique index over duplicate values fails and would stop the
+    # app from starting: report them and keep a plain index until resolved
+    name = f"{collection.name}.{field}"
+    current = (await collection.index_information()).get(f"{field}_1")
+    if current and current.get("unique"):
+        missing_unique_indexes.pop(name, None)
+        return True
+    duplicates = await collection.aggregate([
+        {"$match": options.get("partialFilterExpression", {field: {"$exists": True}})},
+        {"$group": {"_id": f"${field}", "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": 1}}},
+        {"$limit": 20}
+    ]).to_list(None)
+    if duplicates:
+        missing_unique_indexes[name] = "duplicate values: " + ", ".join(f"{d['_id']} (x{d['count']})" for d in duplicates)
+        logger.error(f"{name} unique index not built, {missing_unique_indexes[name]}")
+        if not current:
+            await collection.create_index(field)
+        return False
+    if current:
+        # The plain index from before the field was unique
+        await collection.drop_index(f"{field}_1")
+    await collection.create_index(field, unique=True, **options)
+    missing_unique_indexes.pop(name, None)
+    return True
+
+async def ensure_indexes():
+    await db.storage_locations.create_index("location", unique=True)
+    await db.inventory.create_index([("batch_id", 1), ("status", 1)])
+    await db.inventory.create_index([("status", 1), ("location", 1)])
+    await db.batches.create_index([("status", 1), ("intake_date", 1)])
+    await create_unique_index(db.payments, "batch_id", partialFilterExpression={"batch_id": {"$type": "string"}})
+    await db.payments.create_index("pay_cycle_id")
+    await db.grade_prices.create_index("size_grade", unique=True)
+    
+    # Delta sync: every synced collection is scanned by updated_at.
+    # Documents written before updated_at existed are backfilled once.
+    for collection_name, _ in SYNC_COLLECTIONS.values():
+        await db[collection_name].update_many(
+            {"updated_at": {"$exists": False}},
+            [{"$set": {"updated_at": {"$toDate": "$created_at"}}}]
+        )
+        await db[collection_name].create_index("updated_at")
+    await db.batches.create_index("client_request_id", unique=True, sparse=True)
+    await db.processing_stages.create_index("client_request_id", unique=True, sparse=True)
+    await db.farmers.create_index("name_tokens")
+    await db.farmers.create_index("contact_digits")
+    await db.farmers.create_index([("address", "text")])
+    await create_unique_index(db.batches, "batch_id")
+    await db.batches.create_index([("farmer_id", 1), ("intake_date", 1)])
+    await db.lots.create_index("lot_id", unique=True)
+    await db.lineage.create_index([("from_id", 1), ("to_id", 1)], unique=True)
+    await db.lineage.create_index("to_id")
+    
+    # First start with genealogy: derive edges for stock and shipments that
+    # were recorded against a batch_id only
+    if not await db.lineage.estimated_document_count():
+        await db.inventory.aggregate([
+            {"$project": {"_id": 0, "from_id": "$batch_id", "from_type": "batch", "to_id": "$inventory_id",
+                          "to_type": "inventory", "weight_kg": "$quantity", "created_at": 1}},
+            {"$merge": {"into": "lineage", "on": ["from_id", "to_id"], "whenMatched": "keepExisting"}}
+        ]).to_list(None)
+        await db.dispatches.aggregate([
+            {"$project": {"_id": 0, "from_id": "$batch_id", "from_type": "batch", "to_id": "$dispatch_id",
+                          "to_type": "dispatch", "weight_kg": None, "created_at": 1}},
+            {"$merge": {"into": "lineage", "on": ["from_id", "to_id"], "whenMatched": "keepExisting"}}
+        ]).to_list(None)
+    await db.batches.create_index([("location", "text")])
+    
+    # Farmers created before search existed get their search fields once
+    backfill = [
+        UpdateOne({"farmer_id": f["farmer_id"]}, {"$set": farmer_search_fields(f["name"], f["contact"])})
+        async for f in db.farmers.find({"name_tokens": {"$exists": False}}, {"_id": 0, "farmer_id": 1, "name": 1, "contact": 1})
+    ]
+    if backfill:
+        await db.farmers.bulk_write(backfill, ordered=False)
+    
+    await db.events.create_index([("entity", 1), ("entity_id", 1), ("at", 1)])
+    await db.events.create_index("at")
+    
+    await ensure_telemetry_collections()
+    await db.yield_anomalies.create_index("stage_id", unique=True)
+    await db.yield_anomalies.create_index([("assigned_person", 1), ("created_at", -1)])
+    await db.yield_anomalies.create_index("created_at")
+    await db.operator_shift_stats.create_index([("assigned_person", 1), ("stage_name", 1), ("shift_start", 1)], unique=True)
+    await db.operator_shift_stats.create_index([("shift_date", 1), ("shift", 1)])
+    await db.operator_shift_stats.create_index([("assigned_person", 1), ("shift_start", -1)])
+    await db.sales_cube.create_index([(dimension, 1) for dimension in SALES_CUBE_DIMENSIONS], unique=True)
+    await db.sales_cube.create_index([("month", 1), ("country", 1)])
+    await db.farmers.create_index("farmer_id", unique=True)
+    await db.farmers.create_index("client_request_id", unique=True, sparse=True)
+    await db.payments.create_index("client_request_id", unique=True, sparse=True)
+    
+    await db.archive_partitions.create_index("path", unique=True)
+    await db.archive_partitions.create_index([("collection", 1), ("max_date", 1)])
+    
+    await db.export_jobs.create_index("job_id", unique=True)
+    await db.export_jobs.create_index("active_key", unique=True, sparse=True)
+    await db.export_jobs.create_index([("status", 1), ("created_at", 1)])
+    await db.export_jobs.create_index("expires_at")
+
+def warm_up_qrcode():
+    # Imports qrcode, PIL and its PNG encoder
+    generate_qr_code(encode_batch_qr("BATCH00000000000000"))
+
+def warm_up_excel():
+    workbook = openpyxl.Workbook(write_only=True)
+    create_styled_header(workbook.create_sheet("Warmup"), ["Warmup"])
+    workbook.save(BytesIO())
+
+WARMUP_STEPS = [
+    ("qrcode", warm_up_qrcode),
+    ("excel", warm_up_excel),
+    ("numpy", np._load),
+    ("http", httpx._load),
+    ("brotli", brotli._load),
+    ("msgpack", msgpack._load),
+]
+
+async def warm_up_modules():
+    # Runs after startup so the worker already serves while this happens;
+    # each import runs in a thread to keep the event loop free
+    warmup_state["started_at"] = datetime.now(timezone.utc)
+    for name, step in WARMUP_STEPS:
+        started = time.perf_counter()
+        try:
+            await asyncio.to_thread(step)
+        except Exception:
+            logger.exception(f"Warm-up step {name} failed")
+            continue
+        warmup_state["steps_ms"][name] = round((time.perf_counter() - started) * 1000, 1)
+    auth_http_client()
+    warmup_state["finished_at"] = datetime.now(timezone.utc)
+    warmup_state["warmed"] = True
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global client, db, analytics_db
+    client = create_mongo_client()
+    db = client[os.environ['DB_NAME']]
+    analytics_db = db.with_options(read_preference=analytics_read_preference())
+    await load_qr_check_key()
+    
+    # Safe to run in every worker: index creation and backfills are idempotent
+    await ensure_indexes()
+    
+    reconcile_interval = int(os.environ.get('LOCATION_RECONCILE_INTERVAL_SECONDS', '3600'))
+    if reconcile_interval > 0:
+        background_tasks.append(asyncio.create_task(run_location_reconciliation(reconcile_interval)))
+    
+    for _ in range(EXPORT_WORKERS):
+        background_tasks.append(asyncio.create_task(run_export_worker()))
+    background_tasks.append(asyncio.create_task(run_export_cleanup()))
+    
+    archive_interval = int(os.environ.get('ARCHIVE_INTERVAL_SECONDS', '86400'))
+    if archive_interval > 0:
+        background_tasks.append(asyncio.create_task(run_archiver(archive_interval)))
+    
+    background_tasks.append(asyncio.create_task(run_telemetry_writer()))
+    background_tasks.append(asyncio.create_task(backfill_event_log()))
+    rollup_interval = int(os.environ.get('TELEMETRY_ROLLUP_SECONDS', '60'))
+    if rollup_interval > 0:
+        background_tasks.append(asyncio.create_task(run_temperature_rollups(rollup_interval)))
+    
+    background_tasks.append(asyncio.create_task(backfill_operator_stats()))
+    background_tasks.append(asyncio.create_task(backfill_sales_cube()))
+    
+    yield_interval = int(os.environ.get('YIELD_ANALYSIS_INTERVAL_SECONDS', '3600'))
+    if yield_interval > 0:
+        background_tasks.append(asyncio.create_task(run_yield_analyzer(yield_interval)))
+    
+    if os.environ.get('WARMUP_ON_STARTUP', '1') == '1':
+        background_tasks.append(asyncio.create_task(warm_up_modules()))
+    
+    yield
+    
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
+    try:
+        await flush_telemetry()
+    except Exception:
+        logger.exception("Dropping unflushed telemetry on shutdown")
+    if _auth_http_client is not None:
+        await _auth_http_client.aclose()
+    if _label_render_pool is not None:
+        _label_render_pool.shutdown(cancel_futures=True)
+    client.close()
+
+# Create the main app without a prefix
+app = FastAPI(lifespan=lifespan)
+
 # Include the router in the main app
 app.include_router(api_router)
 
+# Innermost, so compression time counts against the admission slot
+app.add_middleware(CompressionMiddleware)
+
+# Added before CORS so CORS stays outermost and 429s carry CORS headers
+app.add_middleware(AdmissionControlMiddleware, controller=admission_controller)
+
 app.add_middleware(
     CORSMiddleware,
     allow_credentials=True,
@@ -949,7 +4932,3 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
-
-@app.on_event("shutdown")
-async def shutdown_db_client():
-    client.close()
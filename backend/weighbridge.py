@@ -0,0 +1,331 @@
+#!/usr/bin/env python3
+"""
+Weighbridge ingestion service for the AquaFlow backend.
+
+Scales connect over TCP and stream newline-delimited JSON:
+
+    {"scale_id": "S1", "event": "start", "farmer_id": "farmer_abc", "size_grade": "Medium", "location": "Dock A"}
+    {"scale_id": "S1", "weight_kg": 152.34, "ts": 1771408800.125}
+    {"scale_id": "S1", "event": "end"}
+
+`start` / `end` bracket one farmer's delivery. Raw readings are debounced:
+a weighing is captured once the load has stayed within
+WEIGHBRIDGE_TOLERANCE_KG for WEIGHBRIDGE_SETTLE_SECONDS, and the next one only
+after the platform has been emptied (below WEIGHBRIDGE_MIN_LOAD_KG). The scale
+gets {"event": "captured", ...} back for its display. On `end`, or after
+WEIGHBRIDGE_IDLE_SECONDS without readings, the delivery's weighings become one
+batch intake record.
+
+Raw readings are never written. Captured weighings and intake batches are
+buffered and written in micro-batches every WEIGHBRIDGE_FLUSH_MS (or when
+WEIGHBRIDGE_FLUSH_MAX records are waiting). Batch IDs come from the same
+per-day allocator as POST /api/batches, reserved for the whole micro-batch in
+one round trip.
+
+Runs as its own process next to the API:
+
+    python weighbridge.py
+
+and can be driven locally with scripts/weighbridge_simulator.py.
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+import uuid
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+from pymongo import UpdateMany
+from pymongo.errors import BulkWriteError
+
+import server
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger("weighbridge")
+
+HOST = os.environ.get('WEIGHBRIDGE_HOST', '0.0.0.0')
+PORT = int(os.environ.get('WEIGHBRIDGE_PORT', '9100'))
+SETTLE_SECONDS = float(os.environ.get('WEIGHBRIDGE_SETTLE_SECONDS', '0.5'))
+TOLERANCE_KG = float(os.environ.get('WEIGHBRIDGE_TOLERANCE_KG', '0.05'))
+MIN_LOAD_KG = float(os.environ.get('WEIGHBRIDGE_MIN_LOAD_KG', '1.0'))
+IDLE_SECONDS = float(os.environ.get('WEIGHBRIDGE_IDLE_SECONDS', '300'))
+FLUSH_SECONDS = int(os.environ.get('WEIGHBRIDGE_FLUSH_MS', '250')) / 1000
+FLUSH_MAX = int(os.environ.get('WEIGHBRIDGE_FLUSH_MAX', '500'))
+READ_CHUNK = 64 * 1024
+
+async def insert_new(collection, docs: List[dict]):
+    # insert_many that tolerates documents already written by an earlier,
+    # partly failed flush (same _id or client_request_id)
+    try:
+        await collection.insert_many(docs, ordered=False)
+    except BulkWriteError as e:
+        if any(error["code"] != 11000 for error in e.details["writeErrors"]):
+            raise
+
+class Stabilizer:
+    # Debounces one scale's readings. A load is stable once every reading for
+    # SETTLE_SECONDS stayed within TOLERANCE_KG of where it settled; the mean
+    # of those readings is the captured weight. O(1) per reading.
+    def __init__(self):
+        self.anchor = None
+        self.since = 0.0
+        self.total = 0.0
+        self.count = 0
+        self.armed = True
+    
+    def add(self, ts: float, weight: float) -> Optional[float]:
+        if weight < MIN_LOAD_KG:
+            # Platform emptied: ready for the next crate
+            self.armed = True
+            self.anchor = None
+            return None
+        
+        if self.anchor is None or abs(weight - self.anchor) > TOLERANCE_KG:
+            self.anchor, self.since, self.total, self.count = weight, ts, 0.0, 0
+        self.total += weight
+        self.count += 1
+        
+        if self.armed and ts - self.since >= SETTLE_SECONDS:
+            self.armed = False
+            return round(self.total / self.count, 2)
+        return None
+
+class Delivery:
+    def __init__(self, scale_id: str, farmer_id: str, size_grade: str, location: str):
+        self.session_id = f"wb_{uuid.uuid4().hex[:12]}"
+        self.scale_id = scale_id
+        self.farmer_id = farmer_id
+        self.size_grade = size_grade
+        self.location = location
+        self.weights: List[float] = []
+        self.last_activity = time.monotonic()
+        self.batch_id: Optional[str] = None
+        self.batch_doc: Optional[dict] = None
+        self.logged = False
+
+class Pipeline:
+    def __init__(self, db):
+        self.db = db
+        self.stabilizers: Dict[str, Stabilizer] = {}
+        self.deliveries: Dict[str, Delivery] = {}
+        self.pending_weighings: List[dict] = []
+        self.pending_intakes: List[Delivery] = []
+        self.flush_now = asyncio.Event()
+        self.stats = {"readings": 0, "rejected": 0, "weighings": 0, "batches": 0, "flushes": 0, "flush_ms": 0.0}
+    
+    # ---- Reading path (never awaits) ----
+    
+    def handle(self, message: dict) -> Optional[dict]:
+        scale_id = message.get("scale_id")
+        if not scale_id:
+            self.stats["rejected"] += 1
+            return None
+        
+        event = message.get("event")
+        if event == "start":
+            self.close_delivery(scale_id)
+            self.deliveries[scale_id] = Delivery(
+                scale_id, message["farmer_id"], message.get("size_grade", "Medium"), message.get("location", scale_id)
+            )
+            return None
+        if event == "end":
+            self.close_delivery(scale_id)
+            return None
+        
+        weight = message.get("weight_kg")
+        if not isinstance(weight, (int, float)):
+            self.stats["rejected"] += 1
+            return None
+        self.stats["readings"] += 1
+        
+        ts = message.get("ts") or time.time()
+        stabilizer = self.stabilizers.setdefault(scale_id, Stabilizer())
+        captured = stabilizer.add(ts, float(weight))
+        delivery = self.deliveries.get(scale_id)
+        if delivery:
+            delivery.last_activity = time.monotonic()
+        if captured is None:
+            return None
+        
+        self.stats["weighings"] += 1
+        self.pending_weighings.append({
+            "scale_id": scale_id,
+            "session_id": delivery.session_id if delivery else None,
+            "farmer_id": delivery.farmer_id if delivery else None,
+            "weight_kg": captured,
+            "ts": datetime.fromtimestamp(ts, timezone.utc),
+            "batch_id": None
+        })
+        if delivery:
+            delivery.weights.append(captured)
+        if len(self.pending_weighings) >= FLUSH_MAX:
+            self.flush_now.set()
+        
+        return {"event": "captured", "scale_id": scale_id, "weight_kg": captured,
+                "crates": len(delivery.weights) if delivery else None}
+    
+    def close_delivery(self, scale_id: str):
+        delivery = self.deliveries.pop(scale_id, None)
+        if delivery and delivery.weights:
+            self.pending_intakes.append(delivery)
+            self.flush_now.set()
+    
+    def close_idle_deliveries(self):
+        cutoff = time.monotonic() - IDLE_SECONDS
+        for scale_id in [s for s, d in self.deliveries.items() if d.last_activity < cutoff]:
+            logger.info(f"Closing idle delivery on {scale_id}")
+            self.close_delivery(scale_id)
+    
+    # ---- Write path ----
+    
+    async def flush(self):
+        weighings, self.pending_weighings = self.pending_weighings, []
+        intakes, self.pending_intakes = self.pending_intakes, []
+        if not weighings and not intakes:
+            return
+        
+        started = time.perf_counter()
+        try:
+            if weighings:
+                await insert_new(self.db.weighings, weighings)
+            if intakes:
+                await self.write_intakes(intakes)
+        except Exception:
+            logger.exception("Flush failed, retrying on the next tick")
+            self.pending_weighings = weighings + self.pending_weighings
+            self.pending_intakes = intakes + self.pending_intakes
+            return
+        
+        self.stats["flushes"] += 1
+        self.stats["flush_ms"] += (time.perf_counter() - started) * 1000
+    
+    async def write_intakes(self, intakes: List[Delivery]):
+        # One counter round trip for every batch in this micro-batch. Kept on
+        # the delivery, so a retried flush reuses the same id.
+        unassigned = [delivery for delivery in intakes if not delivery.batch_id]
+        for delivery, batch_id in zip(unassigned, await server.batch_id_allocator.allocate(len(unassigned))):
+            delivery.batch_id = batch_id
+        
+        # Built once and kept on the delivery too: a retried flush inserts the
+        # very same documents, and each is logged once whether the insert
+        # or its retry wrote it
+        def build_docs():
+            for delivery in [delivery for delivery in intakes if delivery.batch_doc is None]:
+                doc = server.build_batch_doc(
+                    delivery.batch_id, delivery.farmer_id, round(sum(delivery.weights), 2),
+                    delivery.size_grade, delivery.location
+                )
+                doc.update({
+                    "client_request_id": delivery.session_id,
+                    "source": "weighbridge",
+                    "scale_id": delivery.scale_id,
+                    "weighing_count": len(delivery.weights)
+                })
+                delivery.batch_doc = doc
+        
+        # QR rendering is CPU work; keep it off the reading loop
+        await asyncio.to_thread(build_docs)
+        docs = [delivery.batch_doc for delivery in intakes]
+        await insert_new(self.db.batches, docs)
+        unlogged = [delivery for delivery in intakes if not delivery.logged]
+        await server.record_events([
+            server.event_doc("batches", "created", delivery.batch_id, delivery.batch_doc) for delivery in unlogged
+        ])
+        for delivery in unlogged:
+            delivery.logged = True
+        
+        await self.db.weighings.bulk_write([
+            UpdateMany({"session_id": doc["client_request_id"]}, {"$set": {"batch_id": doc["batch_id"]}})
+            for doc in docs
+        ], ordered=False)
+        self.stats["batches"] += len(docs)
+        for doc in docs:
+            logger.info(f"Intake {doc['batch_id']}: {doc['weight_kg']} kg in {doc['weighing_count']} weighings from {doc['scale_id']}")
+    
+    async def run_writer(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.flush_now.wait(), timeout=FLUSH_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            self.flush_now.clear()
+            self.close_idle_deliveries()
+            await self.flush()
+    
+    async def report_stats(self, interval: float = 10):
+        last_readings = 0
+        while True:
+            await asyncio.sleep(interval)
+            readings = self.stats["readings"]
+            flushes = self.stats["flushes"] or 1
+            logger.info(
+                f"{(readings - last_readings) / interval:.0f} readings/s, "
+                f"{self.stats['weighings']} weighings, {self.stats['batches']} batches, "
+                f"{self.stats['rejected']} rejected, avg flush {self.stats['flush_ms'] / flushes:.1f} ms, "
+                f"{len(self.deliveries)} open deliveries"
+            )
+            last_readings = readings
+    
+    # ---- Connections ----
+    
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        peer = writer.get_extra_info("peername")
+        logger.info(f"Scale connected from {peer}")
+        buffer = b""
+        try:
+            # Reads in chunks and splits lines here rather than awaiting
+            # readline() per reading
+            while chunk := await reader.read(READ_CHUNK):
+                lines = (buffer + chunk).split(b"\n")
+                buffer = lines.pop()
+                for line in lines:
+                    if not line.strip():
+                        continue
+                    try:
+                        reply = self.handle(json.loads(line))
+                    except (ValueError, KeyError, TypeError):
+                        self.stats["rejected"] += 1
+                        continue
+                    if reply:
+                        writer.write(json.dumps(reply).encode() + b"\n")
+                        # Waits while a slow or stalled scale's buffer is
+                        # full, rather than growing it without bound
+                        await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            logger.info(f"Scale {peer} disconnected")
+            writer.close()
+
+async def main():
+    client = server.create_mongo_client()
+    db = client[os.environ['DB_NAME']]
+    # The batch ID allocator, QR helpers and event log in server.py use its db handle
+    server.db = db
+    await server.load_qr_check_key()
+    await db.weighings.create_index([("scale_id", 1), ("ts", 1)])
+    await db.weighings.create_index("session_id")
+    
+    pipeline = Pipeline(db)
+    tasks = [asyncio.create_task(pipeline.run_writer()), asyncio.create_task(pipeline.report_stats())]
+    tcp_server = await asyncio.start_server(pipeline.handle_connection, HOST, PORT)
+    logger.info(f"Weighbridge listening on {HOST}:{PORT}")
+    
+    try:
+        async with tcp_server:
+            await tcp_server.serve_forever()
+    finally:
+        for scale_id in list(pipeline.deliveries):
+            pipeline.close_delivery(scale_id)
+        await pipeline.flush()
+        for task in tasks:
+            task.cancel()
+        client.close()
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
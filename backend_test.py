@@ -6,11 +6,60 @@ Tests all API endpoints, authentication, role-based access control, and data flo
 
 import requests
 import sys
+import os
 import json
 import uuid
+import base64
+import asyncio
+import hashlib
+import hmac
+import importlib
+from contextlib import contextmanager
+from pathlib import Path
+from urllib.parse import quote
 from datetime import datetime, timedelta, timezone
 from typing import Dict, Any, Optional
 
+BACKEND_DIR = Path(__file__).resolve().parent / "backend"
+
+def import_backend(module: str):
+    """Import a backend module for the unit checks that run in-process"""
+    if str(BACKEND_DIR) not in sys.path:
+        sys.path.insert(0, str(BACKEND_DIR))
+    return importlib.import_module(module)
+
+@contextmanager
+def patched_env(**values):
+    """Set (or, with None, unset) environment variables for the block"""
+    saved = {name: os.environ.get(name) for name in values}
+    try:
+        for name, value in values.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+        yield
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+class RecordingDatabase:
+    """Wraps a Motor database and records which collections are read through it"""
+    def __init__(self, database):
+        self.database = database
+        self.collections = []
+    
+    def __getattr__(self, name):
+        self.collections.append(name)
+        return getattr(self.database, name)
+    
+    def __getitem__(self, name):
+        self.collections.append(name)
+        return self.database[name]
+
 class PrawnProcessingAPITester:
     def __init__(self, base_url="https://shrimp-intake.preview.emergentagent.com"):
         self.base_url = base_url
@@ -19,6 +68,8 @@ class PrawnProcessingAPITester:
         self.test_user_id = None
         self.test_farmer_id = None
         self.test_batch_id = None
+        # The server's key, to print a real AQ1 code for the test batch
+        self.qr_check_key = os.environ.get('QR_CHECK_KEY', '')
         
         self.tests_run = 0
         self.tests_passed = 0
@@ -108,10 +159,27 @@ class PrawnProcessingAPITester:
             response = requests.get(self.base_url, timeout=10)
             success = response.status_code in [200, 404, 405]  # Any response means server is up
             self.log_test("API Server Health", success, f"Status: {response.status_code}")
-            return success
         except Exception as e:
             self.log_test("API Server Health", False, error=str(e))
             return False
+        
+        # Test database health endpoint
+        try:
+            response = requests.get(f"{self.api_url}/health", timeout=10)
+            db_ok = response.status_code == 200 and response.json().get('status') == 'ok'
+            self.log_test("API Database Health", db_ok, f"Status: {response.status_code}")
+        except Exception as e:
+            self.log_test("API Database Health", False, error=str(e))
+        
+        # Test readiness (serving vs warmed)
+        try:
+            response = requests.get(f"{self.api_url}/ready", timeout=10)
+            ready = response.status_code == 200 and response.json().get('status') in ('serving', 'warm')
+            self.log_test("API Readiness", ready, f"State: {response.json().get('status')}")
+        except Exception as e:
+            self.log_test("API Readiness", False, error=str(e))
+        
+        return success
 
     def test_authentication_endpoints(self) -> bool:
         """Test authentication flow"""
@@ -259,6 +327,40 @@ class PrawnProcessingAPITester:
         else:
             self.log_test("Create Inventory Entry", success, error=f"Status: {status}")
         
+        # Test a non-positive quantity
+        rejected, data, status = self.make_request('POST', '/inventory', data={**inventory_data, "quantity": 0}, expected_status=422)
+        self.log_test("Inventory Rejects Zero Quantity", rejected, f"Status: {status}")
+        
+        return success
+
+    def test_storage_location_endpoints(self) -> bool:
+        """Test cold storage occupancy endpoints"""
+        print("\n🧊 Testing Storage Location Endpoints...")
+        
+        if not self.session_token:
+            print("Skipping storage location tests - no valid session")
+            return False
+        
+        # Test location summary
+        success, data, status = self.make_request('GET', '/inventory/locations')
+        if success and isinstance(data, list):
+            occupied = sum(loc.get('occupied_kg', 0) for loc in data)
+            # The inventory test stored 44.5 kg here
+            stored = any(loc.get('location') == 'Cold Storage A' and loc.get('occupied_kg', 0) >= 44.5
+                         and loc.get('item_count', 0) >= 1 for loc in data)
+            self.log_test("Get Storage Locations", stored, f"{len(data)} locations, {occupied} kg stored")
+        else:
+            self.log_test("Get Storage Locations", success, error=f"Status: {status}")
+        
+        # Test capacity update
+        success, data, status = self.make_request('PUT', '/inventory/locations/Cold Storage A',
+                                                  data={"capacity_kg": 5000})
+        self.log_test("Set Location Capacity", success, f"Status: {status}")
+        
+        # Test reconciliation
+        success, data, status = self.make_request('POST', '/inventory/locations/reconcile')
+        self.log_test("Reconcile Locations", success, f"Corrected: {data.get('corrected')}")
+        
         return success
 
     def test_dispatch_endpoints(self) -> bool:
@@ -286,6 +388,47 @@ class PrawnProcessingAPITester:
         
         return success
 
+    def test_lineage_endpoints(self) -> bool:
+        """Test lot genealogy and recall endpoints"""
+        print("\n🧬 Testing Lineage Endpoints...")
+        
+        if not self.session_token or not self.test_batch_id:
+            print("Skipping lineage tests - no valid session or batch")
+            return False
+        
+        # Test splitting the batch into graded lots
+        split_data = {
+            "source_id": self.test_batch_id,
+            "lots": [{"size_grade": "Large", "weight_kg": 1.0}, {"size_grade": "Medium", "weight_kg": 1.0}]
+        }
+        success, data, status = self.make_request('POST', '/lots/split', data=split_data)
+        lot_ids = [lot['lot_id'] for lot in data] if success else []
+        self.log_test("Split Batch Into Lots", success and len(lot_ids) == 2, f"Lots: {lot_ids}")
+        
+        # Test over-splitting is rejected
+        split_data["lots"] = [{"size_grade": "Large", "weight_kg": 100000.0}]
+        success, data, status = self.make_request('POST', '/lots/split', data=split_data, expected_status=400)
+        self.log_test("Reject Over-Split", success, f"Status: {status}")
+        
+        # Test merging the lots into a carton
+        if lot_ids:
+            merge_data = {"sources": [{"id": lot_id, "weight_kg": 1.0} for lot_id in lot_ids], "size_grade": "Mixed"}
+            success, data, status = self.make_request('POST', '/lots/merge', data=merge_data)
+            self.log_test("Merge Lots", success and data.get('weight_kg') == 2.0, f"Lot: {data.get('lot_id')}")
+        
+        # Test downstream traversal reaches the dispatch
+        success, data, status = self.make_request('GET', f'/lineage/{self.test_batch_id}')
+        types = {node['type'] for node in data.get('nodes', [])} if success else set()
+        self.log_test("Downstream Lineage", success and 'lot' in types, f"Node types: {sorted(types)}")
+        
+        # Test recall by farmer
+        if self.test_farmer_id:
+            success, data, status = self.make_request('GET', f'/recall?farmer_id={self.test_farmer_id}')
+            self.log_test("Recall Dispatches", success and self.test_batch_id in data.get('batch_ids', []),
+                          f"{len(data.get('dispatches', []))} dispatches" if success else f"Status: {status}")
+        
+        return success
+
     def test_payments_endpoints(self) -> bool:
         """Test payment management endpoints"""
         print("\n💰 Testing Payment Endpoints...")
@@ -314,6 +457,11 @@ class PrawnProcessingAPITester:
         else:
             self.log_test("Create Payment", success, error=f"Status: {status}")
         
+        # Test a second payment for the same batch
+        if payment_id:
+            success, data, status = self.make_request('POST', '/payments', data=payment_data, expected_status=409)
+            self.log_test("Payment Per Batch Is Unique", success, f"Status: {status}")
+        
         # Test update payment status
         if payment_id:
             success, data, status = self.make_request('PUT', f'/payments/{payment_id}/status?status=paid')
@@ -321,6 +469,398 @@ class PrawnProcessingAPITester:
         
         return payment_id is not None
 
+    def test_pay_cycle_endpoints(self) -> bool:
+        """Test bulk payment settlement endpoints"""
+        print("\n🧾 Testing Pay Cycle Endpoints...")
+        
+        if not self.session_token:
+            print("Skipping pay cycle tests - no valid session")
+            return False
+        
+        # Test price table update
+        price_data = {"prices": {"Small": 8.0, "Medium": 10.0, "Large": 12.5, "Jumbo": 15.0}}
+        success, data, status = self.make_request('PUT', '/payments/price-table', data=price_data)
+        self.log_test("Update Price Table", success, f"Status: {status}")
+        
+        # Test pay cycle preview
+        now = datetime.now(timezone.utc)
+        cycle_data = {
+            "start_date": (now - timedelta(days=7)).isoformat(),
+            "end_date": now.isoformat(),
+            "deduction_percent": 2.0,
+            "dry_run": True
+        }
+        success, data, status = self.make_request('POST', '/payments/pay-cycle', data=cycle_data)
+        if success:
+            totals_match = abs(data.get('total_gross', 0) - data.get('total_deductions', 0) - data.get('total_net', 0)) < 0.05
+            self.log_test("Preview Pay Cycle", totals_match and data.get('dry_run') is True, f"{len(data.get('payments', []))} payments, totals consistent: {totals_match}")
+        else:
+            self.log_test("Preview Pay Cycle", success, error=f"Status: {status}")
+        
+        # Test bulk status update
+        success, data, status = self.make_request('PUT', '/payments/bulk-status',
+                                                  data={"payment_ids": [], "status": "paid"},
+                                                  expected_status=400)
+        self.log_test("Bulk Status Requires Selection", success, f"Status: {status}")
+        
+        return success
+
+    def test_sync_endpoints(self) -> bool:
+        """Test delta sync and offline replay endpoints"""
+        print("\n🔄 Testing Sync Endpoints...")
+        
+        if not self.session_token:
+            print("Skipping sync tests - no valid session")
+            return False
+        
+        # Test full sync
+        success, data, status = self.make_request('GET', '/sync')
+        token = data.get('token') if success else None
+        self.log_test("Full Sync", success and data.get('full') is True, f"Token: {token}")
+        
+        # Test delta sync from the returned token
+        if token:
+            success, data, status = self.make_request('GET', f'/sync?since={token}')
+            changed = sum(len(docs) for docs in data.get('changes', {}).values()) if success else 0
+            self.log_test("Delta Sync", success, f"{changed} changed documents")
+        
+        # Test invalid token
+        success, data, status = self.make_request('GET', '/sync?since=not-a-token', expected_status=400)
+        self.log_test("Sync Rejects Invalid Token", success, f"Status: {status}")
+        
+        # Test replaying the same queued intake twice
+        if self.test_farmer_id:
+            operation = {
+                "client_request_id": f"offline_{uuid.uuid4().hex}",
+                "kind": "batch",
+                "payload": {
+                    "farmer_id": self.test_farmer_id,
+                    "weight_kg": 20.0,
+                    "size_grade": "Medium",
+                    "location": "Pond B2"
+                }
+            }
+            success, first, status = self.make_request('POST', '/sync/upload', data={"operations": [operation]})
+            success, second, status = self.make_request('POST', '/sync/upload', data={"operations": [operation]})
+            if success:
+                first_id = first['results'][0].get('record', {}).get('batch_id')
+                second_id = second['results'][0].get('record', {}).get('batch_id')
+                self.log_test("Idempotent Offline Replay", first_id is not None and first_id == second_id,
+                              f"Batch: {first_id}")
+            else:
+                self.log_test("Idempotent Offline Replay", False, error=f"Status: {status}")
+        
+        return success
+
+    def test_search_endpoints(self) -> bool:
+        """Test typeahead search endpoint"""
+        print("\n🔍 Testing Search Endpoints...")
+        
+        if not self.session_token:
+            print("Skipping search tests - no valid session")
+            return False
+        
+        # Test farmer word prefix (matches "Test Farmer ...")
+        success, data, status = self.make_request('GET', '/search?q=test%20farm')
+        found = any(r['id'] == self.test_farmer_id for r in data.get('results', [])) if success else False
+        self.log_test("Search Farmer Prefix", success and (found or not self.test_farmer_id),
+                      f"{len(data.get('results', []))} results" if success else f"Status: {status}")
+        
+        # Test batch ID prefix
+        if self.test_batch_id:
+            prefix = self.test_batch_id[:12]
+            success, data, status = self.make_request('GET', f'/search?q={prefix}&limit=5')
+            ids = [r['id'] for r in data.get('results', [])] if success else []
+            self.log_test("Search Batch Prefix", success and len(ids) <= 5 and all(i.startswith(prefix) for i in ids if i.startswith('BATCH')),
+                          f"{len(ids)} results")
+        
+        return success
+
+    def test_telemetry_endpoints(self) -> bool:
+        """Test temperature telemetry ingest and batch history"""
+        print("\n🌡️ Testing Telemetry Endpoints...")
+        
+        if not self.session_token:
+            print("Skipping telemetry tests - no valid session")
+            return False
+        
+        # Test ingest
+        readings = {
+            "readings": [
+                {"sensor_id": "test-sensor-1", "location": "Cold Room A", "temperature_c": -19.5},
+                {"sensor_id": "test-sensor-1", "location": "Cold Room A", "temperature_c": -18.9}
+            ]
+        }
+        success, data, status = self.make_request('POST', '/telemetry/temperature', readings, 202)
+        self.log_test("Ingest Temperature", success and data.get('accepted') == 2,
+                      f"Accepted: {data.get('accepted')}" if success else f"Status: {status}")
+        
+        # Test batch history
+        if self.test_batch_id:
+            success, data, status = self.make_request('GET', f'/telemetry/batches/{self.test_batch_id}/temperature')
+            self.log_test("Batch Temperature History", success and 'stays' in data,
+                          f"{len(data.get('stays', []))} stays" if success else f"Status: {status}")
+        
+        success, data, status = self.make_request('GET', '/telemetry/batches/BATCH_MISSING/temperature', expected_status=404)
+        self.log_test("Batch Temperature Not Found", success, f"Status: {status}")
+        
+        return success
+
+    def test_qr_endpoints(self) -> bool:
+        """Test batch QR images and scanner resolution"""
+        print("\n🔳 Testing QR Endpoints...")
+        
+        if not self.session_token or not self.test_batch_id:
+            print("Skipping QR tests - no test batch")
+            return False
+        
+        # Test SVG image
+        try:
+            response = requests.get(
+                f"{self.api_url}/batches/{self.test_batch_id}/qr?format=svg&error_correction=H",
+                headers={'Authorization': f'Bearer {self.session_token}'},
+                timeout=30
+            )
+            success = response.status_code == 200 and response.text.startswith('<svg')
+            self.log_test("Batch QR SVG", success,
+                          f"{len(response.content)} bytes" if success else f"Status: {response.status_code}")
+        except requests.exceptions.RequestException as e:
+            self.log_test("Batch QR SVG", False, error=str(e))
+        
+        success, data, status = self.make_request('GET', f'/batches/{self.test_batch_id}/qr?error_correction=X', expected_status=400)
+        self.log_test("Batch QR Invalid Level", success, f"Status: {status}")
+        
+        # Codes printed before AQ1 hold JSON and still resolve
+        legacy_code = quote(json.dumps({"batch_id": self.test_batch_id}))
+        success, data, status = self.make_request('GET', f'/qr/resolve?code={legacy_code}')
+        self.log_test("Resolve Legacy QR", success and data.get('batch_id') == self.test_batch_id,
+                      f"Batch: {data.get('batch_id')}" if success else f"Status: {status}")
+        
+        # A real AQ1 code for the test batch, made the way its label is
+        if self.qr_check_key:
+            ref = self.test_batch_id[5:]
+            digest = hmac.new(self.qr_check_key.encode(), ref.encode(), hashlib.sha256).digest()
+            code = f"AQ1:{ref}:{base64.b32encode(digest[:5]).decode()[:4]}"
+            success, data, status = self.make_request('GET', f'/qr/resolve?code={quote(code)}')
+            self.log_test("Resolve AQ1 QR", success and data.get('batch_id') == self.test_batch_id,
+                          f"{code} -> {data.get('batch_id')}" if success else f"Status: {status}")
+        else:
+            print("Skipping AQ1 resolve test - QR_CHECK_KEY not set")
+        
+        # A reference with the wrong check code is rejected
+        success, data, status = self.make_request('GET', f'/qr/resolve?code={quote("AQ1:20260218000123:AAAA")}', expected_status=400)
+        self.log_test("Resolve Tampered QR", success, f"Status: {status}")
+        
+        return success
+
+    def test_label_endpoints(self) -> bool:
+        """Test printable label sheets"""
+        print("\n🏷️ Testing Label Endpoints...")
+        
+        if not self.session_token:
+            print("Skipping label tests - no valid session")
+            return False
+        
+        success = False
+        if self.test_batch_id:
+            try:
+                response = requests.get(
+                    f"{self.api_url}/labels?batch_ids={self.test_batch_id}",
+                    headers={'Authorization': f'Bearer {self.session_token}'},
+                    timeout=60
+                )
+                success = (response.status_code == 200
+                           and response.headers.get('content-type') == 'application/pdf'
+                           and response.content.startswith(b'%PDF'))
+                self.log_test("Print Batch Labels", success,
+                              f"{len(response.content)} bytes" if success else f"Status: {response.status_code}")
+            except requests.exceptions.RequestException as e:
+                self.log_test("Print Batch Labels", False, error=str(e))
+        
+        # Test missing selection
+        success, data, status = self.make_request('GET', '/labels', expected_status=400)
+        self.log_test("Labels Without Selection", success, f"Status: {status}")
+        
+        return success
+
+    def test_yield_anomaly_endpoints(self) -> bool:
+        """Test yield anomaly analysis endpoints"""
+        print("\n📉 Testing Yield Anomaly Endpoints...")
+        
+        if not self.session_token:
+            print("Skipping yield anomaly tests - no valid session")
+            return False
+        
+        # Test running a pass
+        success, data, status = self.make_request('POST', '/analytics/yield-anomalies/run')
+        self.log_test("Run Yield Analysis", success,
+                      f"{data.get('stages')} stages, {data.get('flagged')} flagged" if success else f"Status: {status}")
+        
+        # Test listing flags
+        success, data, status = self.make_request('GET', '/analytics/yield-anomalies?limit=10')
+        self.log_test("Get Yield Anomalies", success and 'anomalies' in data and len(data['anomalies']) <= 10,
+                      f"{len(data.get('anomalies', []))} anomalies" if success else f"Status: {status}")
+        
+        return success
+
+    def test_operator_endpoints(self) -> bool:
+        """Test operator productivity leaderboard"""
+        print("\n👷 Testing Operator Productivity Endpoints...")
+        
+        if not self.session_token:
+            print("Skipping operator tests - no valid session")
+            return False
+        
+        # Test leaderboard for today
+        success, data, status = self.make_request('GET', '/analytics/operators/leaderboard?metric=yield_percentage')
+        self.log_test("Operator Leaderboard", success and 'operators' in data,
+                      f"{len(data.get('operators', []))} operators" if success else f"Status: {status}")
+        
+        # Test invalid metric
+        success, data, status = self.make_request('GET', '/analytics/operators/leaderboard?metric=speed', expected_status=400)
+        self.log_test("Operator Leaderboard Invalid Metric", success, f"Status: {status}")
+        
+        return success
+
+    def test_sales_endpoints(self) -> bool:
+        """Test sales cube slice endpoint"""
+        print("\n💹 Testing Sales Cube Endpoints...")
+        
+        if not self.session_token:
+            print("Skipping sales tests - no valid session")
+            return False
+        
+        # Test drill-down by country and month
+        success, data, status = self.make_request('GET', '/analytics/sales?group_by=country,month')
+        self.log_test("Sales By Country And Month", success and 'totals' in data and 'rows' in data,
+                      f"{len(data.get('rows', []))} rows, revenue {data.get('totals', {}).get('revenue')}" if success else f"Status: {status}")
+        
+        # Test invalid dimension
+        success, data, status = self.make_request('GET', '/analytics/sales?group_by=farmer', expected_status=400)
+        self.log_test("Sales Invalid Dimension", success, f"Status: {status}")
+        
+        return success
+
+    def test_expand_endpoints(self) -> bool:
+        """Test expand= reference enrichment on list endpoints"""
+        print("\n🔗 Testing Expand...")
+        
+        if not self.session_token:
+            print("Skipping expand tests - no valid session")
+            return False
+        
+        success, data, status = self.make_request('GET', '/batches?expand=farmer')
+        expanded = success and all('farmer' in batch for batch in data)
+        self.log_test("Batches Expand Farmer", expanded,
+                      f"{len(data)} batches" if success else f"Status: {status}")
+        
+        success, data, status = self.make_request('GET', '/dispatch?expand=batch,batch.farmer')
+        expanded = success and all('batch' in dispatch for dispatch in data)
+        self.log_test("Dispatches Expand Batch", expanded,
+                      f"{len(data)} dispatches" if success else f"Status: {status}")
+        
+        success, data, status = self.make_request('GET', '/payments?expand=farmer,batch')
+        self.log_test("Payments Expand", success, f"Status: {status}")
+        
+        # Test reference the documents don't have
+        success, data, status = self.make_request('GET', '/inventory?expand=farmer', expected_status=400)
+        self.log_test("Expand Invalid Reference", success, f"Status: {status}")
+        
+        return success
+
+    def test_list_format_endpoints(self) -> bool:
+        """Test fields=, MessagePack and compressed list responses"""
+        print("\n🗜️ Testing List Formats...")
+        
+        if not self.session_token:
+            print("Skipping list format tests - no valid session")
+            return False
+        
+        success, data, status = self.make_request('GET', '/batches?fields=status,weight_kg')
+        sparse = success and all(set(batch) <= {'batch_id', 'status', 'weight_kg'} for batch in data)
+        self.log_test("Batches Sparse Fields", sparse,
+                      f"{len(data)} batches" if success else f"Status: {status}")
+        
+        success, data, status = self.make_request('GET', '/payments?fields=qr_code', expected_status=400)
+        self.log_test("Sparse Fields Unknown Field", success, f"Status: {status}")
+        
+        # Test MessagePack and gzip on the same list
+        for name, headers, check in (
+            ("Batches MessagePack", {'Accept': 'application/msgpack'},
+             lambda r: r.headers.get('content-type', '').startswith('application/msgpack')),
+            ("Batches Gzip", {'Accept-Encoding': 'gzip'},
+             lambda r: r.headers.get('content-encoding') in (None, 'gzip') and isinstance(r.json(), list)),
+            ("Batches JSON Varies On Accept", {},
+             lambda r: 'accept' in [value.strip().lower() for value in r.headers.get('vary', '').split(',')]),
+        ):
+            try:
+                response = requests.get(
+                    f"{self.api_url}/dispatch",
+                    headers={'Authorization': f'Bearer {self.session_token}', **headers},
+                    timeout=30
+                )
+                success = response.status_code == 200 and check(response)
+                self.log_test(name, success,
+                              f"{response.headers.get('content-encoding', 'identity')}, {len(response.content)} bytes"
+                              if success else f"Status: {response.status_code}")
+            except requests.exceptions.RequestException as e:
+                self.log_test(name, False, error=str(e))
+        
+        return success
+
+    def test_event_log_endpoints(self) -> bool:
+        """Test mutation event log history"""
+        print("\n📜 Testing Event Log...")
+        
+        if not self.session_token or not self.test_batch_id:
+            print("Skipping event log tests - no test batch")
+            return False
+        
+        # The test batch was created and moved through stages above
+        success, data, status = self.make_request('GET', f'/events?entity=batches&entity_id={self.test_batch_id}')
+        actions = [event.get('action') for event in data.get('events', [])] if success else []
+        self.log_test("Batch History", success and actions[:1] == ['created'],
+                      f"Actions: {actions}" if success else f"Status: {status}")
+        
+        success, data, status = self.make_request('GET', '/events?entity=sessions', expected_status=400)
+        self.log_test("Event Log Unknown Entity", success, f"Status: {status}")
+        
+        return success
+
+    def test_import_endpoints(self) -> bool:
+        """Test bulk CSV import endpoint"""
+        print("\n📥 Testing Import Endpoints...")
+        
+        if not self.session_token:
+            print("Skipping import tests - no valid session")
+            return False
+        
+        # Dry run: one valid row, one missing its address
+        csv_body = "name,contact,address\nImport Farmer,+91 90000 00000,Nellore\nNo Address,12345,\n"
+        try:
+            response = requests.post(
+                f"{self.api_url}/import/farmers?format=csv&dry_run=true",
+                data=csv_body.encode(),
+                headers={'Authorization': f'Bearer {self.session_token}', 'Content-Type': 'text/csv'},
+                timeout=30
+            )
+            lines = [json.loads(line) for line in response.text.splitlines() if line]
+        except (requests.exceptions.RequestException, json.JSONDecodeError) as e:
+            self.log_test("Import Farmers Dry Run", False, error=str(e))
+            return False
+        
+        summary = lines[-1].get('summary', {}) if lines else {}
+        rejected = [line['row'] for line in lines if 'row' in line]
+        success = response.status_code == 200 and summary.get('inserted') == 1 and rejected == [3]
+        self.log_test("Import Farmers Dry Run", success,
+                      f"Summary: {summary}, rejected rows: {rejected}" if response.status_code == 200 else f"Status: {response.status_code}")
+        
+        # Test unknown kind
+        success, data, status = self.make_request('POST', '/import/dispatches', expected_status=404)
+        self.log_test("Import Unknown Kind", success, f"Status: {status}")
+        
+        return success
+
     def test_dashboard_endpoints(self) -> bool:
         """Test dashboard analytics endpoints"""
         print("\n📊 Testing Dashboard Endpoints...")
@@ -339,6 +879,43 @@ class PrawnProcessingAPITester:
         else:
             self.log_test("Admin Dashboard", success, error=f"Status: {status}")
         
+        # Test admission control metrics
+        success, data, status = self.make_request('GET', '/admission/stats')
+        if success:
+            queued = {name: c.get('waiting') for name, c in data.get('classes', {}).items()}
+            valid = ({'critical', 'export', 'dashboard', 'bulk'} <= set(queued)
+                     and all(isinstance(waiting, int) and waiting >= 0 for waiting in queued.values()))
+            self.log_test("Admission Stats", valid, f"Queue lengths: {queued}")
+        else:
+            self.log_test("Admission Stats", success, error=f"Status: {status}")
+        
+        # Test response cache: a repeat request is served from cache
+        self.make_request('GET', '/dashboard/admin')
+        success, data, status = self.make_request('GET', '/cache/stats')
+        if success:
+            valid = (0 <= data.get('hit_rate', -1) <= 1 and data.get('entries', -1) <= data.get('max_entries', 0)
+                     and data.get('hits', 0) + data.get('coalesced', 0) + data.get('misses', 0) >= 1)
+            self.log_test("Response Cache Stats", valid,
+                          f"Hit rate: {data.get('hit_rate', 0):.0%}, DB queries saved: {data.get('db_queries_saved')}")
+        else:
+            self.log_test("Response Cache Stats", success, error=f"Status: {status}")
+        
+        # Test a dashboard date range spanning archived months
+        success, data, status = self.make_request('GET', '/dashboard/admin?start=2020-01-01T00:00:00Z&end=2021-01-01T00:00:00Z')
+        self.log_test("Dashboard Date Range", success, f"Batches in range: {data.get('total_batches')}" if success else f"Status: {status}")
+        
+        # Test archive catalogue
+        success, data, status = self.make_request('GET', '/archive/partitions')
+        if success:
+            valid = isinstance(data, list) and all(
+                p.get('collection') in ('batches', 'processing_stages', 'payments', 'dispatches')
+                and len(p.get('month', '')) == 7 and p.get('files', 0) >= 1 and p.get('rows', -1) >= 0
+                for p in data
+            )
+            self.log_test("Archive Partitions", valid, f"{sum(p['rows'] for p in data)} archived rows in {len(data)} months")
+        else:
+            self.log_test("Archive Partitions", success, error=f"Status: {status}")
+        
         return success
 
     def test_export_endpoints(self) -> bool:
@@ -361,6 +938,24 @@ class PrawnProcessingAPITester:
         success, data, status = self.make_request('POST', '/export/processing', expected_status=200)
         self.log_test("Export Processing", success, f"Status: {status}")
         
+        # Test background export job (identical requests share one job)
+        success, first, status = self.make_request('POST', '/export/batches?background=true', expected_status=202)
+        success, second, status = self.make_request('POST', '/export/batches?background=true', expected_status=202)
+        job_id = first.get('job_id') if success else None
+        if job_id:
+            deduplicated = second.get('job_id') == job_id or first.get('status') == 'done'
+            self.log_test("Queue Export Job", deduplicated, f"Job: {job_id}, deduplicated: {deduplicated}")
+        else:
+            self.log_test("Queue Export Job", success, error=f"Status: {status}")
+        
+        if job_id:
+            success, data, status = self.make_request('GET', f'/export/jobs/{job_id}')
+            self.log_test("Export Job Status", success, f"Status: {data.get('status')}")
+        
+        # Test unknown export kind
+        success, data, status = self.make_request('POST', '/export/unknown', expected_status=404)
+        self.log_test("Unknown Export Rejected", success, f"Status: {status}")
+        
         return True
 
     def run_all_tests(self) -> bool:
@@ -379,22 +974,307 @@ class PrawnProcessingAPITester:
             return False
         
         # Phase 3: Test all endpoints (without real auth, most will fail but we check structure)
-        print(f"\n⚠️  Note: Testing without real authentication - expecting auth errors")
+        authenticated, _, _ = self.make_request('GET', '/auth/me')
+        if not authenticated:
+            print(f"\n⚠️  Note: Testing without real authentication - expecting auth errors")
         
         self.test_authentication_endpoints()
         self.test_farmers_endpoints()
         self.test_batches_endpoints()
         self.test_processing_endpoints()
         self.test_inventory_endpoints()
+        self.test_storage_location_endpoints()
         self.test_dispatch_endpoints()
+        self.test_lineage_endpoints()
         self.test_payments_endpoints()
+        self.test_pay_cycle_endpoints()
+        self.test_sync_endpoints()
+        self.test_search_endpoints()
+        self.test_telemetry_endpoints()
+        self.test_qr_endpoints()
+        self.test_label_endpoints()
+        self.test_yield_anomaly_endpoints()
+        self.test_operator_endpoints()
+        self.test_sales_endpoints()
+        self.test_expand_endpoints()
+        self.test_list_format_endpoints()
+        self.test_event_log_endpoints()
+        self.test_import_endpoints()
         self.test_dashboard_endpoints()
         self.test_export_endpoints()
         
+        api_run, api_passed = self.tests_run, self.tests_passed
+        
+        # Phase 4: In-process unit checks
+        self.test_batch_id_allocator()
+        self.test_read_preference_modes()
+        self.test_lifespan_wiring()
+        self.test_weighbridge_stabilizer()
+        self.test_weighbridge_pipeline()
+        
         # Summary
         self.print_summary()
         
-        return self.tests_passed >= self.tests_run * 0.3  # 30% success rate acceptable for auth issues
+        # With a real session every check must pass; without one, 30% of the
+        # API checks is acceptable for auth issues. The in-process checks need
+        # no auth and must always pass.
+        api_ok = api_passed == api_run if authenticated else api_passed >= api_run * 0.3
+        return api_ok and self.tests_passed - api_passed == self.tests_run - api_run
+
+    def test_batch_id_allocator(self) -> bool:
+        """Unit test: allocators in two workers never hand out the same batch ID"""
+        print("\n🔢 Testing Batch ID Allocator...")
+        
+        if not os.environ.get('MONGO_URL'):
+            print("Skipping allocator test - MONGO_URL not set")
+            return False
+        
+        server = import_backend('server')
+        
+        async def allocate_from_two_workers():
+            client = server.create_mongo_client()
+            server.db = client[f"allocator_test_{uuid.uuid4().hex[:8]}"]
+            try:
+                first, second = server.BatchIdAllocator(), server.BatchIdAllocator()
+                # Interleaved one after the other: ids must sort in issue order
+                ordered = []
+                for allocator, count in ((first, 1), (second, 1), (first, 3), (second, 1), (first, 1)):
+                    ordered += await allocator.allocate(count)
+                batches = await asyncio.gather(*[
+                    allocator.allocate(count)
+                    for _ in range(10)
+                    for allocator, count in ((first, 1), (second, 3), (first, 7), (second, 1))
+                ])
+                return ordered, [batch_id for batch in batches for batch_id in batch]
+            finally:
+                await client.drop_database(server.db.name)
+                client.close()
+        
+        try:
+            ordered, ids = asyncio.run(allocate_from_two_workers())
+        except Exception as e:
+            self.log_test("Batch ID Allocator", False, error=str(e))
+            return False
+        day = datetime.now(server.PLANT_TIMEZONE).strftime("%Y%m%d")
+        success = ordered == sorted(ordered) and len(ordered) == 7 and all(i.startswith(f"BATCH{day}") for i in ordered)
+        self.log_test("Batch ID Allocator Sorts In Issue Order", success, f"IDs: {ordered}")
+        unique = len(ids) == 120 and len(set(ids) | set(ordered)) == 127
+        self.log_test("Batch ID Allocator Unique Across Instances", unique, f"{len(ids)} ids, {len(set(ids))} distinct")
+        return success and unique
+    
+    def test_read_preference_modes(self) -> bool:
+        """Unit test: analytics read preference comes from the environment"""
+        print("\n🧭 Testing Analytics Read Preference...")
+        
+        server = import_backend('server')
+        
+        with patched_env(MONGO_ANALYTICS_READ_PREFERENCE=None, MONGO_MAX_STALENESS_SECONDS=None):
+            preference = server.analytics_read_preference()
+        success = preference.mongos_mode == 'secondaryPreferred' and preference.max_staleness == 90
+        self.log_test("Analytics Read Preference Default", success, f"{preference.mongos_mode}, {preference.max_staleness}s")
+        
+        with patched_env(MONGO_ANALYTICS_READ_PREFERENCE='secondary', MONGO_MAX_STALENESS_SECONDS='120'):
+            preference = server.analytics_read_preference()
+        success = preference.mongos_mode == 'secondary' and preference.max_staleness == 120
+        self.log_test("Analytics Read Preference Secondary", success, f"{preference.mongos_mode}, {preference.max_staleness}s")
+        
+        with patched_env(MONGO_ANALYTICS_READ_PREFERENCE='primary'):
+            preference = server.analytics_read_preference()
+        self.log_test("Analytics Read Preference Primary", preference.mongos_mode == 'primary', preference.mongos_mode)
+        
+        try:
+            with patched_env(MONGO_ANALYTICS_READ_PREFERENCE='secondaryOnly'):
+                server.analytics_read_preference()
+            self.log_test("Analytics Read Preference Invalid", False, error="No error for secondaryOnly")
+            return False
+        except ValueError as e:
+            self.log_test("Analytics Read Preference Invalid", True, str(e))
+        
+        return True
+
+    def test_lifespan_wiring(self) -> bool:
+        """Unit test: lifespan opens the Mongo client, routes analytics reads and shuts down cleanly"""
+        print("\n🔌 Testing Lifespan Wiring...")
+        
+        if not os.environ.get('MONGO_URL'):
+            print("Skipping lifespan test - MONGO_URL not set")
+            return False
+        
+        server = import_backend('server')
+        import pymongo
+        from fastapi.testclient import TestClient
+        
+        scratch = f"lifespan_test_{uuid.uuid4().hex[:8]}"
+        # Periodic jobs off: only the requests below should read
+        settings = {
+            'DB_NAME': scratch, 'MONGO_MAX_POOL_SIZE': '7', 'MONGO_MIN_POOL_SIZE': '2',
+            'MONGO_ANALYTICS_READ_PREFERENCE': None, 'MONGO_MAX_STALENESS_SECONDS': None,
+            'LOCATION_RECONCILE_INTERVAL_SECONDS': '0', 'ARCHIVE_INTERVAL_SECONDS': '0',
+            'TELEMETRY_ROLLUP_SECONDS': '0', 'YIELD_ANALYSIS_INTERVAL_SECONDS': '0', 'WARMUP_ON_STARTUP': '0',
+        }
+        # Started without QR_CHECK_KEY: one is generated into counters
+        key, server.QR_CHECK_KEY = server.QR_CHECK_KEY, b''
+        server.app.dependency_overrides[server.get_current_user] = lambda: {"user_id": "lifespan_test", "role": "admin"}
+        try:
+            with patched_env(**settings), TestClient(server.app) as client:
+                with pymongo.MongoClient(os.environ['MONGO_URL']) as sync_client:
+                    stored = sync_client[scratch].counters.find_one({"_id": "qr_check_key"})
+                generated = bool(stored) and len(stored["key"]) == 64 and server.QR_CHECK_KEY == stored["key"].encode()
+                self.log_test("Lifespan Generates QR Check Key", generated,
+                              "Stored in counters" if generated else f"Stored: {stored}")
+                
+                pool = server.client.delegate.options.pool_options
+                self.log_test("Lifespan Pool Options", (pool.max_pool_size, pool.min_pool_size) == (7, 2),
+                              f"maxPoolSize {pool.max_pool_size}, minPoolSize {pool.min_pool_size}")
+                
+                response = client.get("/api/health")
+                success = response.status_code == 200 and response.json() == {"status": "ok", "pid": os.getpid()}
+                self.log_test("Health Through Lifespan", success, f"Status: {response.status_code}, db: {server.db.name}")
+                
+                routed = (server.db.read_preference.mongos_mode == 'primary'
+                          and server.analytics_db.read_preference.mongos_mode == 'secondaryPreferred'
+                          and server.analytics_db.name == server.db.name == scratch)
+                self.log_test("Analytics Database Reads From Secondaries", routed,
+                              f"db: {server.db.read_preference.mongos_mode}, "
+                              f"analytics_db: {server.analytics_db.read_preference.mongos_mode}")
+                
+                primary, analytics = RecordingDatabase(server.db), RecordingDatabase(server.analytics_db)
+                server.db, server.analytics_db = primary, analytics
+                try:
+                    response = client.get("/api/dashboard/admin")
+                    dashboard = set(analytics.collections)
+                    success = (response.status_code == 200
+                               and {"batches", "processing_stages", "payments", "dispatches", "farmers"} <= dashboard)
+                    self.log_test("Dashboard Reads Routed To Analytics", success,
+                                  f"analytics_db: {sorted(dashboard)}" if response.status_code == 200 else f"Status: {response.status_code}")
+                    
+                    analytics.collections.clear()
+                    response = client.get("/api/batches")
+                    success = (response.status_code == 200 and "batches" in primary.collections
+                               and "batches" not in analytics.collections)
+                    self.log_test("Batch List Reads Stay On Primary", success,
+                                  f"analytics_db: {sorted(set(analytics.collections))}" if response.status_code == 200 else f"Status: {response.status_code}")
+                finally:
+                    server.db, server.analytics_db = primary.database, analytics.database
+            
+            self.log_test("Lifespan Shutdown Stops Tasks", not server.background_tasks,
+                          f"{len(server.background_tasks)} tasks left")
+        except Exception as e:
+            self.log_test("Lifespan Wiring", False, error=str(e))
+            return False
+        finally:
+            server.QR_CHECK_KEY = key
+            server.app.dependency_overrides.pop(server.get_current_user, None)
+            with pymongo.MongoClient(os.environ['MONGO_URL']) as sync_client:
+                sync_client.drop_database(scratch)
+        
+        return True
+
+    def test_weighbridge_stabilizer(self) -> bool:
+        """Unit test: a weighing is captured once per load, after it settles"""
+        print("\n⚖️ Testing Weighbridge Stabilizer...")
+        
+        weighbridge = import_backend('weighbridge')
+        settle, tolerance = weighbridge.SETTLE_SECONDS, weighbridge.TOLERANCE_KG
+        step = settle / 8
+        
+        stabilizer = weighbridge.Stabilizer()
+        captures = []
+        clock = 0.0
+        
+        def feed(weights):
+            nonlocal clock
+            for weight in weights:
+                captured = stabilizer.add(clock, weight)
+                if captured is not None:
+                    captures.append((clock, captured))
+                clock += step
+        
+        # Empty platform, then a crate landing: nothing until it has settled
+        feed([0.0, 0.0, 40.0, 90.0])
+        landed = clock
+        feed([100.0, 100.0 + tolerance / 2] * 10)
+        first = list(captures)
+        success = (len(first) == 1 and landed + settle - 1e-9 <= first[0][0] < landed + settle + step
+                   and 100.0 <= first[0][1] <= round(100.0 + tolerance / 2, 2))
+        self.log_test("Stabilizer Captures Settled Load", success, f"Captures: {first}")
+        
+        # Still loaded, or another crate stacked on top: not captured again
+        feed([100.0] * 20 + [150.0] * 20)
+        self.log_test("Stabilizer Holds Until Emptied", captures == first, f"Captures: {captures}")
+        
+        # Emptied: re-armed. A jump beyond tolerance restarts the settle window
+        feed([weighbridge.MIN_LOAD_KG / 2])
+        feed([80.0] * 5)
+        jumped = clock
+        feed([80.0 + tolerance * 2] * 15)
+        second = captures[len(first):]
+        success = (len(second) == 1 and jumped + settle - 1e-9 <= second[0][0] < jumped + settle + step
+                   and second[0][1] == round(80.0 + tolerance * 2, 2))
+        self.log_test("Stabilizer Re-arms After Empty", success, f"Captures: {second}")
+        
+        return success
+
+    def test_weighbridge_pipeline(self) -> bool:
+        """Unit test: readings become one intake batch, written once across flush retries"""
+        print("\n🚚 Testing Weighbridge Pipeline...")
+        
+        weighbridge = import_backend('weighbridge')
+        server = import_backend('server')
+        step = weighbridge.SETTLE_SECONDS / 4
+        
+        def crate(pipeline, start, weight):
+            replies = [pipeline.handle({"scale_id": "S1", "weight_kg": weight, "ts": start + i * step}) for i in range(6)]
+            pipeline.handle({"scale_id": "S1", "weight_kg": 0.0, "ts": start + 6 * step})
+            return [reply for reply in replies if reply]
+        
+        pipeline = weighbridge.Pipeline(None)
+        pipeline.handle({"weight_kg": 10.0})
+        pipeline.handle({"scale_id": "S1", "weight_kg": "heavy"})
+        pipeline.handle({"scale_id": "S1", "event": "start", "farmer_id": "farmer_wb_test", "size_grade": "Large"})
+        replies = crate(pipeline, 1000.0, 52.5) + crate(pipeline, 1010.0, 47.25)
+        pipeline.handle({"scale_id": "S1", "event": "end"})
+        
+        delivery = pipeline.pending_intakes[0] if len(pipeline.pending_intakes) == 1 else None
+        success = (pipeline.stats["rejected"] == 2
+                   and [(r["weight_kg"], r["crates"]) for r in replies] == [(52.5, 1), (47.25, 2)]
+                   and delivery is not None and delivery.weights == [52.5, 47.25]
+                   and all(w["session_id"] == delivery.session_id for w in pipeline.pending_weighings))
+        self.log_test("Weighbridge Readings To Delivery", success,
+                      f"Replies: {replies}, stats: {pipeline.stats}")
+        if not success:
+            return False
+        
+        if not os.environ.get('MONGO_URL'):
+            print("Skipping weighbridge flush test - MONGO_URL not set")
+            return False
+        
+        async def flush_twice():
+            client = server.create_mongo_client()
+            server.db = pipeline.db = client[f"weighbridge_test_{uuid.uuid4().hex[:8]}"]
+            try:
+                await pipeline.flush()
+                # A retried flush of the same delivery writes and logs nothing new
+                pipeline.pending_intakes.append(delivery)
+                await pipeline.flush()
+                batches = await pipeline.db.batches.find({}, {"_id": 0, "qr_code": 0}).to_list(None)
+                linked = await pipeline.db.weighings.count_documents({"batch_id": delivery.batch_id})
+                logged = await pipeline.db.events.count_documents({"entity": "batches", "entity_id": delivery.batch_id})
+                return batches, linked, logged
+            finally:
+                await client.drop_database(server.db.name)
+                client.close()
+        
+        try:
+            batches, linked, logged = asyncio.run(flush_twice())
+        except Exception as e:
+            self.log_test("Weighbridge Flush", False, error=str(e))
+            return False
+        success = (len(batches) == 1 and batches[0]["weight_kg"] == 99.75 and batches[0]["weighing_count"] == 2
+                   and batches[0]["source"] == "weighbridge" and linked == 2 and logged == 1)
+        self.log_test("Weighbridge Flush Writes One Batch", success,
+                      f"{len(batches)} batches, {linked} weighings linked, {logged} events")
+        return success
 
     def print_summary(self):
         """Print test execution summary"""
@@ -1,21 +1,217 @@
 // Service Worker for PWA
-const CACHE_NAME = 'aquaflow-v1';
+const CACHE_NAME = 'aquaflow-v2';
+const API_CACHE_NAME = 'aquaflow-api-v1';
 const urlsToCache = [
   '/',
   '/static/css/main.css',
   '/static/js/main.js',
 ];
 
+// Per-route freshness for GET /api/* (seconds). Within max-age the cached
+// response is served and revalidated in the background; past it the network
+// is tried first and the stale copy is only used when offline.
+const API_ROUTES = [
+  { pattern: /^\/api\/dashboard\//, maxAge: 60 },
+  { pattern: /^\/api\/farmers\/me\/stats$/, maxAge: 60 },
+  { pattern: /^\/api\/inventory\/locations$/, maxAge: 30 },
+  { pattern: /^\/api\/processing\/batch\//, maxAge: 30 },
+  { pattern: /^\/api\/batches\/[^/]+$/, maxAge: 300 },
+  { pattern: /^\/api\/payments\/price-table$/, maxAge: 3600 },
+  { pattern: /^\/api\//, maxAge: 120 },
+];
+
+// Never cached: auth state, one-off downloads, typeahead search and the delta
+// sync endpoint (each call carries a new token and the page keeps its own copy)
+const API_NETWORK_ONLY = [/^\/api\/auth\//, /^\/api\/export\//, /^\/api\/search/, /^\/api\/sync/];
+
+// Writes that are queued for background sync when the device is offline
+const QUEUEABLE_POSTS = [/^\/api\/batches$/, /^\/api\/processing$/];
+
+const FETCHED_AT_HEADER = 'sw-fetched-at';
+const OUTBOX_SYNC_TAG = 'aquaflow-outbox';
+const OUTBOX_DB = 'aquaflow-outbox';
+const OUTBOX_STORE = 'requests';
+
 self.addEventListener('install', (event) => {
   event.waitUntil(
     caches.open(CACHE_NAME)
       .then((cache) => cache.addAll(urlsToCache))
+      .then(() => self.skipWaiting())
+  );
+});
+
+self.addEventListener('activate', (event) => {
+  event.waitUntil(
+    caches.keys()
+      .then((names) => Promise.all(
+        names
+          .filter((name) => name !== CACHE_NAME && name !== API_CACHE_NAME)
+          .map((name) => caches.delete(name))
+      ))
+      .then(() => self.clients.claim())
   );
 });
 
 self.addEventListener('fetch', (event) => {
+  const url = new URL(event.request.url);
+
+  if (url.pathname.startsWith('/api/')) {
+    if (event.request.method === 'GET') {
+      if (!API_NETWORK_ONLY.some((pattern) => pattern.test(url.pathname))) {
+        event.respondWith(staleWhileRevalidate(event));
+      }
+      return;
+    }
+
+    if (event.request.method === 'POST' && QUEUEABLE_POSTS.some((pattern) => pattern.test(url.pathname))) {
+      event.respondWith(fetchOrQueue(event.request));
+    }
+    return;
+  }
+
   event.respondWith(
     caches.match(event.request)
       .then((response) => response || fetch(event.request))
   );
 });
+
+self.addEventListener('sync', (event) => {
+  if (event.tag === OUTBOX_SYNC_TAG) {
+    event.waitUntil(replayOutbox());
+  }
+});
+
+self.addEventListener('message', (event) => {
+  const { type } = event.data || {};
+
+  if (type === 'replay-outbox') {
+    // Fallback for browsers without Background Sync
+    event.waitUntil(replayOutbox());
+  } else if (type === 'clear-api-cache') {
+    event.waitUntil(caches.delete(API_CACHE_NAME));
+  }
+});
+
+// ============ API runtime caching ============
+
+const maxAgeFor = (pathname) => API_ROUTES.find((route) => route.pattern.test(pathname)).maxAge;
+
+const withFetchedAt = async (response) => {
+  const headers = new Headers(response.headers);
+  headers.set(FETCHED_AT_HEADER, Date.now().toString());
+  return new Response(await response.blob(), {
+    status: response.status,
+    statusText: response.statusText,
+    headers,
+  });
+};
+
+const notifyClients = async (message) => {
+  const clients = await self.clients.matchAll({ type: 'window' });
+  clients.forEach((client) => client.postMessage(message));
+};
+
+const revalidate = async (request, cached) => {
+  const response = await fetch(request);
+  if (!response.ok) return response;
+
+  const cache = await caches.open(API_CACHE_NAME);
+  const fresh = await withFetchedAt(response.clone());
+  const body = await fresh.clone().text();
+  await cache.put(request, fresh);
+
+  if (cached && body !== await cached.clone().text()) {
+    await notifyClients({ type: 'api-updated', url: request.url });
+  }
+  return response;
+};
+
+const staleWhileRevalidate = async (event) => {
+  const { request } = event;
+  const cache = await caches.open(API_CACHE_NAME);
+  const cached = await cache.match(request);
+
+  if (cached) {
+    const age = (Date.now() - Number(cached.headers.get(FETCHED_AT_HEADER) || 0)) / 1000;
+
+    if (age <= maxAgeFor(new URL(request.url).pathname)) {
+      event.waitUntil(revalidate(request, cached).catch(() => undefined));
+      return cached;
+    }
+
+    try {
+      return await revalidate(request, cached);
+    } catch (error) {
+      return cached;
+    }
+  }
+
+  return revalidate(request, null);
+};
+
+// ============ Background sync outbox ============
+
+const openOutbox = () => new Promise((resolve, reject) => {
+  const open = indexedDB.open(OUTBOX_DB, 1);
+  open.onupgradeneeded = () => open.result.createObjectStore(OUTBOX_STORE, { keyPath: 'id', autoIncrement: true });
+  open.onsuccess = () => resolve(open.result);
+  open.onerror = () => reject(open.error);
+});
+
+const outboxTransaction = async (mode, action) => {
+  const database = await openOutbox();
+  return new Promise((resolve, reject) => {
+    const transaction = database.transaction(OUTBOX_STORE, mode);
+    const result = action(transaction.objectStore(OUTBOX_STORE));
+    transaction.oncomplete = () => resolve(result.result);
+    transaction.onerror = () => reject(transaction.error);
+  });
+};
+
+const fetchOrQueue = async (request) => {
+  const queued = request.clone();
+
+  try {
+    return await fetch(request);
+  } catch (error) {
+    // Offline: keep the request (including its Idempotency-Key) for replay
+    const entry = {
+      url: queued.url,
+      method: queued.method,
+      headers: [...queued.headers.entries()],
+      body: await queued.text(),
+      queued_at: Date.now(),
+    };
+    await outboxTransaction('readwrite', (store) => store.add(entry));
+
+    if (self.registration.sync) {
+      await self.registration.sync.register(OUTBOX_SYNC_TAG);
+    }
+
+    return new Response(JSON.stringify({ queued: true, detail: 'Saved offline, will sync when back online' }), {
+      status: 202,
+      headers: { 'Content-Type': 'application/json' },
+    });
+  }
+};
+
+const replayOutbox = async () => {
+  const entries = await outboxTransaction('readonly', (store) => store.getAll());
+
+  for (const entry of entries) {
+    // A network error here rejects the sync event, so the browser retries later
+    const response = await fetch(entry.url, {
+      method: entry.method,
+      headers: entry.headers,
+      body: entry.body,
+      credentials: 'include',
+    });
+
+    // 5xx may be transient, keep it queued. Anything else (including
+    // validation errors) is final; the server deduplicates on the key.
+    if (response.status >= 500) continue;
+
+    await outboxTransaction('readwrite', (store) => store.delete(entry.id));
+    await notifyClients({ type: 'outbox-replayed', url: entry.url, status: response.status });
+  }
+};
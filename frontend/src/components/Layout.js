@@ -1,4 +1,4 @@
-import React, { useState } from 'react';
+import React, { useEffect, useState } from 'react';
 import { useNavigate } from 'react-router-dom';
 import { 
   Package, 
@@ -20,6 +20,15 @@ function Layout({ children, user, activePage }) {
   const navigate = useNavigate();
   const [sidebarOpen, setSidebarOpen] = useState(false);
 
+  // Raised by syncAPI when the offline copy cannot be stored (quota full)
+  useEffect(() => {
+    const handleStorageFailed = () => {
+      toast.warning('Offline copy could not be saved; lists need a connection after a reload', { id: 'sync-storage-failed' });
+    };
+    window.addEventListener('aquaflow:sync-storage-failed', handleStorageFailed);
+    return () => window.removeEventListener('aquaflow:sync-storage-failed', handleStorageFailed);
+  }, []);
+
   const handleLogout = async () => {
     try {
       await authAPI.logout();
@@ -9,3 +9,24 @@ root.render(
     <App />
   </React.StrictMode>,
 );
+
+if ('serviceWorker' in navigator && process.env.NODE_ENV === 'production') {
+  window.addEventListener('load', () => {
+    navigator.serviceWorker.register('/service-worker.js');
+  });
+
+  // Re-broadcast worker messages ('api-updated', 'outbox-replayed') so pages
+  // showing cached data can refetch when fresher data arrives
+  navigator.serviceWorker.addEventListener('message', (event) => {
+    if (event.data && event.data.type) {
+      window.dispatchEvent(new CustomEvent(`aquaflow:${event.data.type}`, { detail: event.data }));
+    }
+  });
+
+  // Browsers without Background Sync replay the offline queue on reconnect
+  window.addEventListener('online', () => {
+    navigator.serviceWorker.ready.then((registration) => {
+      if (registration.active) registration.active.postMessage({ type: 'replay-outbox' });
+    });
+  });
+}
@@ -13,6 +13,14 @@ function AdminDashboard({ user }) {
 
   useEffect(() => {
     fetchStats();
+
+    // The service worker paints this page from cache; refetch when it
+    // reports a fresher dashboard response
+    const handleUpdate = (event) => {
+      if (event.detail.url.includes('/dashboard/admin')) fetchStats();
+    };
+    window.addEventListener('aquaflow:api-updated', handleUpdate);
+    return () => window.removeEventListener('aquaflow:api-updated', handleUpdate);
   }, []);
 
   const fetchStats = async () => {
@@ -58,13 +58,17 @@ function ProcessingDashboard({ user }) {
     setLoading(true);
 
     try {
-      await processingAPI.createStage({
+      const stage = await processingAPI.createStage({
         ...formData,
         input_weight: parseFloat(formData.input_weight),
         output_weight: parseFloat(formData.output_weight),
       });
 
-      toast.success('Processing stage added successfully!');
+      if (stage.queued) {
+        toast.info('Stage saved offline, will sync when back online');
+      } else {
+        toast.success('Processing stage added successfully!');
+      }
       setFormData({
         batch_id: '',
         stage_name: '',
@@ -4,6 +4,7 @@ import Layout from '../components/Layout';
 import { Card, CardContent, CardHeader, CardTitle } from '../components/ui/card';
 import { Button } from '../components/ui/button';
 import { toast } from 'sonner';
+import { batchAPI } from '../services/api';
 
 function QRScanner({ user }) {
   const scannerRef = useRef(null);
@@ -31,15 +32,18 @@ function QRScanner({ user }) {
       false
     );
 
-    const onScanSuccess = (decodedText) => {
+    const onScanSuccess = async (decodedText) => {
+      html5QrcodeScanner.pause();
       try {
-        const data = JSON.parse(decodedText);
-        setScannedData(data);
-        html5QrcodeScanner.pause();
+        // Codes hold a short batch reference; the server checks it and
+        // returns the batch
+        const batch = await batchAPI.resolveQr(decodedText);
+        setScannedData(batch);
         setScanning(false);
         toast.success('QR code scanned successfully!');
       } catch (error) {
-        toast.error('Invalid QR code format');
+        toast.error(error.response?.data?.detail || 'Invalid QR code format');
+        html5QrcodeScanner.resume();
       }
     };
 
@@ -146,6 +150,10 @@ function QRScanner({ user }) {
                     <p className="text-sm text-slate-600">Size Grade</p>
                     <p className="text-lg font-semibold text-slate-900">{scannedData.size_grade}</p>
                   </div>
+                  <div>
+                    <p className="text-sm text-slate-600">Status</p>
+                    <p className="text-lg font-semibold text-slate-900">{scannedData.status}</p>
+                  </div>
                   <div>
                     <p className="text-sm text-slate-600">Intake Date</p>
                     <p className="text-lg font-semibold text-slate-900">
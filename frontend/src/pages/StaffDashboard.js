@@ -7,7 +7,7 @@ import { Label } from '../components/ui/label';
 import { Select, SelectContent, SelectItem, SelectTrigger, SelectValue } from '../components/ui/select';
 import { farmerAPI, batchAPI } from '../services/api';
 import { toast } from 'sonner';
-import { Package, Plus, QrCode as QrCodeIcon } from 'lucide-react';
+import { Package, Plus, Printer, QrCode as QrCodeIcon } from 'lucide-react';
 
 function StaffDashboard({ user }) {
   const [farmers, setFarmers] = useState([]);
@@ -55,7 +55,13 @@ function StaffDashboard({ user }) {
         weight_kg: parseFloat(formData.weight_kg),
       });
 
-      toast.success('Batch created successfully!');
+      // Offline, the service worker queues the intake and answers 202
+      // { queued: true }: there is no batch ID or QR code until it syncs
+      if (batch.queued) {
+        toast.info('Batch saved offline, will sync when back online');
+      } else {
+        toast.success('Batch created successfully!');
+      }
       setFormData({
         farmer_id: '',
         weight_kg: '',
@@ -66,7 +72,7 @@ function StaffDashboard({ user }) {
       fetchData();
 
       // Show QR code
-      if (batch.qr_code) {
+      if (!batch.queued && batch.qr_code) {
         const modal = document.createElement('div');
         modal.className = 'fixed inset-0 bg-black bg-opacity-50 flex items-center justify-center z-50';
         modal.innerHTML = `
@@ -289,8 +295,25 @@ function StaffDashboard({ user }) {
 
         {/* Batches List */}
         <Card className="border-slate-200 shadow-sm">
-          <CardHeader>
+          <CardHeader className="flex flex-row items-center justify-between">
             <CardTitle className="text-xl font-heading font-semibold">Recent Batches</CardTitle>
+            {batches.length > 0 && (
+              <Button
+                data-testid="print-labels-btn"
+                variant="outline"
+                onClick={async () => {
+                  try {
+                    await batchAPI.printLabels(batches.slice(0, 20).map((batch) => batch.batch_id));
+                  } catch (error) {
+                    console.error('Failed to print labels:', error);
+                    toast.error('Failed to generate labels');
+                  }
+                }}
+              >
+                <Printer size={18} className="mr-2" />
+                Print Labels
+              </Button>
+            )}
           </CardHeader>
           <CardContent>
             {batches.length > 0 ? (
@@ -10,6 +10,164 @@ const api = axios.create({
   },
 });
 
+// ============ Offline sync store ============
+
+// Kept in IndexedDB: the synced lists (with each batch's QR image) outgrow
+// the ~5 MB localStorage allows per origin
+const SYNC_DB = 'aquaflow-sync';
+const SYNC_STORE = 'state';
+const SYNC_STATE_KEY = 'current';
+// Where earlier versions kept it
+const LEGACY_SYNC_STORAGE_KEY = 'aquaflow-sync';
+
+// Response key -> id field, matching SYNC_COLLECTIONS in server.py
+const SYNC_COLLECTIONS = {
+  farmers: 'farmer_id',
+  batches: 'batch_id',
+  processing_stages: 'stage_id',
+  inventory: 'inventory_id',
+  dispatches: 'dispatch_id',
+  payments: 'payment_id',
+};
+
+const emptySyncState = () => ({
+  token: null,
+  collections: Object.fromEntries(Object.keys(SYNC_COLLECTIONS).map((key) => [key, {}])),
+});
+
+const openSyncDb = () => new Promise((resolve, reject) => {
+  const open = indexedDB.open(SYNC_DB, 1);
+  open.onupgradeneeded = () => open.result.createObjectStore(SYNC_STORE);
+  open.onsuccess = () => resolve(open.result);
+  open.onerror = () => reject(open.error);
+});
+
+const syncTransaction = async (mode, action) => {
+  const database = await openSyncDb();
+  return new Promise((resolve, reject) => {
+    const transaction = database.transaction(SYNC_STORE, mode);
+    const result = action(transaction.objectStore(SYNC_STORE));
+    transaction.oncomplete = () => {
+      database.close();
+      resolve(result.result);
+    };
+    // A full quota aborts the transaction
+    transaction.onerror = transaction.onabort = () => {
+      database.close();
+      reject(transaction.error);
+    };
+  });
+};
+
+const loadSyncState = async () => {
+  try {
+    localStorage.removeItem(LEGACY_SYNC_STORAGE_KEY);
+    const stored = await syncTransaction('readonly', (store) => store.get(SYNC_STATE_KEY));
+    if (stored && stored.collections) return { ...emptySyncState(), ...stored };
+  } catch (error) {
+    // Corrupt or unavailable storage: start from a full sync
+  }
+  return emptySyncState();
+};
+
+const saveSyncState = async (state) => {
+  try {
+    await syncTransaction('readwrite', (store) => store.put(state, SYNC_STATE_KEY));
+  } catch (error) {
+    // Quota exceeded or storage blocked: the in-memory copy still serves this
+    // session, but the app cannot open offline with it. Layout tells the user.
+    console.error('Failed to save the offline copy:', error);
+    window.dispatchEvent(new CustomEvent('aquaflow:sync-storage-failed', { detail: { error: error && error.name } }));
+  }
+};
+
+let syncState = null;
+let pendingPull = null;
+
+const newRequestId = () => (
+  window.crypto && window.crypto.randomUUID
+    ? window.crypto.randomUUID()
+    : `${Date.now()}-${Math.random().toString(16).slice(2)}`
+);
+
+const byCreatedAtDesc = (a, b) => new Date(b.created_at) - new Date(a.created_at);
+
+// Batch ID from a scanned code, matching decode_batch_qr in server.py
+// (without the check, which needs the server's key)
+const batchIdFromQr = (code) => {
+  const text = code.trim();
+  if (text.startsWith('{')) {
+    try {
+      return JSON.parse(text).batch_id || null;
+    } catch (error) {
+      return null;
+    }
+  }
+  const [version, ...rest] = text.split(':');
+  if (version !== 'AQ1' || rest.length < 2) return null;
+  const ref = rest.slice(0, -1).join(':');
+  return ref.startsWith('-') ? ref.slice(1) : `BATCH${ref}`;
+};
+
+export const syncAPI = {
+  getChanges: async (since) => {
+    const response = await api.get('/sync', { params: since ? { since } : {} });
+    return response.data;
+  },
+
+  upload: async (operations) => {
+    const response = await api.post('/sync/upload', { operations });
+    return response.data;
+  },
+
+  // Fetches only what changed since the last pull and merges it into the
+  // local copy. Concurrent callers share one request.
+  pull: async () => {
+    if (pendingPull) return pendingPull;
+
+    pendingPull = (async () => {
+      if (!syncState) syncState = await loadSyncState();
+
+      let hasMore = true;
+      while (hasMore) {
+        const data = await syncAPI.getChanges(syncState.token);
+        if (data.full) syncState = emptySyncState();
+
+        Object.entries(SYNC_COLLECTIONS).forEach(([key, idField]) => {
+          (data.changes[key] || []).forEach((doc) => {
+            syncState.collections[key][doc[idField]] = doc;
+          });
+          // Deleted or archived on the server
+          ((data.deleted || {})[key] || []).forEach((id) => {
+            delete syncState.collections[key][id];
+          });
+        });
+
+        syncState.token = data.token;
+        hasMore = data.has_more;
+      }
+
+      await saveSyncState(syncState);
+      return Object.fromEntries(
+        Object.entries(syncState.collections).map(([key, docs]) => [key, Object.values(docs)])
+      );
+    })().finally(() => {
+      pendingPull = null;
+    });
+
+    return pendingPull;
+  },
+
+  reset: () => {
+    syncState = null;
+    syncTransaction('readwrite', (store) => store.delete(SYNC_STATE_KEY)).catch(() => {});
+    // Cached API responses belong to the signed-out user
+    if (navigator.serviceWorker && navigator.serviceWorker.controller) {
+      navigator.serviceWorker.controller.postMessage({ type: 'clear-api-cache' });
+    }
+  },
+};
+
 export const authAPI = {
   createSession: async (sessionId) => {
     const response = await api.post('/auth/session', { session_id: sessionId });
@@ -23,6 +181,7 @@ export const authAPI = {
 
   logout: async () => {
     const response = await api.post('/auth/logout');
+    syncAPI.reset();
     return response.data;
   },
 };
@@ -34,8 +193,8 @@ export const farmerAPI = {
   },
 
   getFarmers: async () => {
-    const response = await api.get('/farmers');
-    return response.data;
+    const { farmers } = await syncAPI.pull();
+    return farmers;
   },
 
   getFarmerStats: async () => {
@@ -46,24 +205,55 @@ export const farmerAPI = {
 
 export const batchAPI = {
   createBatch: async (data) => {
-    const response = await api.post('/batches', data);
+    const response = await api.post('/batches', data, {
+      headers: { 'Idempotency-Key': newRequestId() },
+    });
     return response.data;
   },
 
   getBatches: async () => {
-    const response = await api.get('/batches');
-    return response.data;
+    const { batches } = await syncAPI.pull();
+    return batches.sort(byCreatedAtDesc);
   },
 
   getBatch: async (batchId) => {
     const response = await api.get(`/batches/${batchId}`);
     return response.data;
   },
+
+  // Looks up the batch behind a scanned QR code (AQ1 reference or old JSON).
+  // Offline, falls back to the synced copy; only the server can verify the
+  // code's check characters.
+  resolveQr: async (code) => {
+    try {
+      const response = await api.get('/qr/resolve', { params: { code } });
+      return response.data;
+    } catch (error) {
+      if (error.response) throw error;
+      const batchId = batchIdFromQr(code);
+      const batch = batchId && (syncState || await loadSyncState()).collections.batches[batchId];
+      if (!batch) throw error;
+      return batch;
+    }
+  },
+
+  // Opens a printable PDF sheet of QR labels for the given batches
+  printLabels: async (batchIds) => {
+    const response = await api.get('/labels', {
+      params: { batch_ids: batchIds.join(',') },
+      responseType: 'blob',
+    });
+    const url = window.URL.createObjectURL(response.data);
+    window.open(url, '_blank');
+    setTimeout(() => window.URL.revokeObjectURL(url), 60000);
+  },
 };
 
 export const processingAPI = {
   createStage: async (data) => {
-    const response = await api.post('/processing', data);
+    const response = await api.post('/processing', data, {
+      headers: { 'Idempotency-Key': newRequestId() },
+    });
     return response.data;
   },
 
@@ -80,8 +270,8 @@ export const inventoryAPI = {
   },
 
   getInventory: async () => {
-    const response = await api.get('/inventory');
-    return response.data;
+    const { inventory } = await syncAPI.pull();
+    return inventory;
   },
 };
 
@@ -92,8 +282,8 @@ export const dispatchAPI = {
   },
 
   getDispatches: async () => {
-    const response = await api.get('/dispatch');
-    return response.data;
+    const { dispatches } = await syncAPI.pull();
+    return dispatches;
   },
 };
 
@@ -109,7 +299,23 @@ export const paymentAPI = {
   },
 
   getPayments: async () => {
-    const response = await api.get('/payments');
+    const { payments } = await syncAPI.pull();
+    return payments;
+  },
+};
+
+// Typeahead search. Each call aborts the previous in-flight one, so a
+// debounced input only ever resolves with results for the latest text.
+let searchController = null;
+
+export const searchAPI = {
+  search: async (q, limit = 10) => {
+    if (searchController) searchController.abort();
+    searchController = new AbortController();
+    const response = await api.get('/search', {
+      params: { q, limit },
+      signal: searchController.signal,
+    });
     return response.data;
   },
 };
@@ -119,6 +325,18 @@ export const dashboardAPI = {
     const response = await api.get('/dashboard/admin');
     return response.data;
   },
+
+  // params: { start_date, end_date, shift, stage_name, metric, limit }
+  getOperatorLeaderboard: async (params = {}) => {
+    const response = await api.get('/analytics/operators/leaderboard', { params });
+    return response.data;
+  },
+
+  // params: { group_by: 'country,month', customer_name, country, size_grade, start_month, end_month }
+  getSales: async (params = {}) => {
+    const response = await api.get('/analytics/sales', { params });
+    return response.data;
+  },
 };
 
 export const exportAPI = {